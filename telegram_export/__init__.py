@@ -1,2 +1,13 @@
 """Components for telegram-export"""
-from . import formatters, dumper, downloader, exporter
+import importlib
+
+# The submodules are imported on first access instead of here, so that the
+# offline commands (such as formatting) don't pull in the network stack.
+__all__ = ['formatters', 'dumper', 'downloader', 'exporter']
+
+
+def __getattr__(name):
+    if name in __all__:
+        return importlib.import_module('.' + name, __name__)
+    raise AttributeError(
+        'module {!r} has no attribute {!r}'.format(__name__, name))
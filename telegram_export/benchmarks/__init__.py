@@ -0,0 +1,7 @@
+"""
+Offline benchmarks for telegram-export. These drive the real Exporter,
+Downloader and Dumper against an in-process fake client, so that neither
+the network nor an account are needed. Run them with:
+
+    python -m telegram_export.benchmarks --help
+"""
@@ -0,0 +1,294 @@
+"""
+Runs the offline benchmarks, printing their results and optionally
+comparing them against a previous run to catch performance regressions.
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+from contextlib import contextmanager
+
+from .database import DatabaseScenario
+from .fakeclient import FakeClient, Scenario, parse_media_mix, \
+    DEFAULT_MEDIA_MIX
+
+# Which results are compared against a baseline, and whether higher is better.
+# Results with a prefix (such as "text_messages_per_second") count as well.
+COMPARED = (
+    ('messages_per_second', True),
+    ('db_bytes', False),
+    ('peak_rss_bytes', False),
+    ('_ns', False),
+)
+
+
+def parse_args():
+    """Parse command-line arguments to the benchmarks"""
+    parser = argparse.ArgumentParser(
+        prog='python -m telegram_export.benchmarks',
+        description='Offline benchmarks for telegram-export')
+    parser.add_argument('--json', metavar='FILE',
+                        help='also save the results as JSON into FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='compare the results against the JSON of a '
+                             'previous run, failing on regressions')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative change allowed by --compare before '
+                             'considering it a regression. Default 0.1')
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+
+    export = commands.add_parser(
+        'export', help='export the dialogs served by a fake client')
+    export.add_argument('--dialogs', type=int, default=4,
+                        help='amount of dialogs, cycling between users, '
+                             'chats, megagroups and channels. Default 4')
+    export.add_argument('--messages', type=int, default=2000,
+                        help='messages in the history of each dialog. '
+                             'Default 2000')
+    export.add_argument('--media', type=parse_media_mix,
+                        default=DEFAULT_MEDIA_MIX,
+                        help='ratio of messages with each type of media, '
+                             'e.g. "photo=0.1, document=0.02, sticker=0.04, '
+                             'voice=0.02, video=0.01"')
+    export.add_argument('--media-size', type=int, default=64 * 1024,
+                        help='average size of the media in bytes')
+    export.add_argument('--media-whitelist', default='chatphoto, photo, '
+                                                     'sticker',
+                        help='the MediaWhitelist to use (same as default)')
+    export.add_argument('--participants', type=int, default=100,
+                        help='members of every group. Default 100')
+    export.add_argument('--latency', type=float, default=0,
+                        help='milliseconds to answer every request')
+    export.add_argument('--bandwidth', type=float, default=0,
+                        help='download speed in KB/s. Default unlimited')
+    export.add_argument('--chunk-size', type=int, default=100,
+                        help='messages per history request. Default 100')
+    export.add_argument('--throttle', action='store_true',
+                        help="keep the exporter's delays between requests")
+    export.add_argument('--seed', type=int, default=0,
+                        help='seed for the generated data')
+    export.add_argument('--output', metavar='DIR',
+                        help='export into DIR and keep it, instead of '
+                             'using a temporary directory')
+
+    replay = commands.add_parser(
+        'replay', help='export what was saved with --record, offline')
+    replay.add_argument('recording', help='the file saved with --record')
+    replay.add_argument('--realtime', action='store_true',
+                        help='answer every request in as long as it took '
+                             'while recording, instead of immediately')
+    replay.add_argument('--throttle', action='store_true',
+                        help="keep the exporter's delays between requests")
+    replay.add_argument('--output', metavar='DIR',
+                        help='export into DIR and keep it, instead of using '
+                             'a temporary directory. To reproduce an export '
+                             'which resumed from a previous one, copy its '
+                             'database into DIR first')
+
+    classify = commands.add_parser(
+        'classify', help='tell apart the kinds of media and actions of the '
+                         'messages served by a fake client')
+    classify.add_argument('--dialogs', type=int, default=4,
+                          help='amount of dialogs. Default 4')
+    classify.add_argument('--messages', type=int, default=5000,
+                          help='messages in each dialog. Default 5000')
+    classify.add_argument('--media', type=parse_media_mix,
+                          default=DEFAULT_MEDIA_MIX,
+                          help='ratio of messages with each type of media, '
+                               'like for export')
+    classify.add_argument('--service', type=float, default=0.01,
+                          help='ratio of service messages. Default 0.01')
+    classify.add_argument('--rounds', type=int, default=10,
+                          help='times every message is classified. '
+                               'Default 10')
+    classify.add_argument('--seed', type=int, default=0,
+                          help='seed for the generated data')
+
+    database = argparse.ArgumentParser(add_help=False)
+    database.add_argument('--contexts', type=int, default=10,
+                          help='amount of contexts, cycling between users, '
+                               'chats, megagroups and channels. Default 10')
+    database.add_argument('--messages', type=int, default=10000,
+                          help='messages in total, split between the '
+                               'contexts with a long tail. Default 10000')
+    database.add_argument('--users', type=int, default=200,
+                          help='amount of users. Default 200')
+    database.add_argument('--snapshots', type=int, default=3,
+                          help='versions of every user and context saved '
+                               'at different dates. Default 3')
+    database.add_argument('--seed', type=int, default=0,
+                          help='seed for the generated data')
+
+    generate = commands.add_parser(
+        'generate', parents=[database],
+        help='generate a synthetic export database')
+    generate.add_argument('database', help='where to save the new database')
+
+    fmt = commands.add_parser(
+        'format', parents=[database],
+        help='format an export database with every formatter')
+    fmt.add_argument('--database', metavar='FILE',
+                     help='format this database (e.g. one made with '
+                          '"generate") instead of generating a temporary '
+                          'one as described by the other options')
+    fmt.add_argument('--formatters', type=lambda s: [
+                         x.strip() for x in s.split(',') if x.strip()],
+                     help='comma separated formatters to run. Default all')
+    fmt.add_argument('--output', metavar='DIR',
+                     help='save the formatted contexts into DIR instead of '
+                          'discarding them')
+    return parser.parse_args()
+
+
+@contextmanager
+def output_directory(path):
+    """
+    Yields the given output directory, creating it if needed, or a
+    temporary directory that is deleted afterwards if path is empty.
+    """
+    if path:
+        os.makedirs(path, exist_ok=True)
+        yield path
+    else:
+        path = tempfile.mkdtemp(prefix='telegram-export-bench')
+        try:
+            yield path
+        finally:
+            shutil.rmtree(path)
+
+
+def run_export(args):
+    """Runs the export benchmark as configured in the arguments"""
+    from .export import make_config, run_export
+    scenario = Scenario(
+        dialogs=args.dialogs, messages=args.messages, media_mix=args.media,
+        media_size=args.media_size, participants=args.participants,
+        latency=args.latency / 1000, bandwidth=args.bandwidth * 1000,
+        seed=args.seed
+    )
+    with output_directory(args.output) as output:
+        return run_export(FakeClient(scenario),
+                          make_config(output, args.media_whitelist,
+                                      args.chunk_size),
+                          throttle=args.throttle)
+
+
+def run_replay(args):
+    """Runs the replay benchmark as configured in the arguments"""
+    from ..recording import ReplayClient
+    from .export import make_config, run_export
+    client = ReplayClient(args.recording, realtime=args.realtime)
+    with output_directory(args.output) as output:
+        config = make_config(output)
+        config['Dumper'].update(client.header['settings'])
+        for name, ids in client.lists.items():
+            if ids:
+                config['Dumper'][name] = ', '.join(map(str, ids))
+        return run_export(client, config, throttle=args.throttle)
+
+
+def run_classify(args):
+    """Runs the classification benchmark as configured in the arguments"""
+    from .classification import run_classify
+    scenario = Scenario(
+        dialogs=args.dialogs, messages=args.messages, media_mix=args.media,
+        service_ratio=args.service, seed=args.seed
+    )
+    return run_classify(scenario, args.rounds)
+
+
+def database_scenario(args):
+    """Returns the DatabaseScenario described by the arguments"""
+    return DatabaseScenario(
+        contexts=args.contexts, messages=args.messages, users=args.users,
+        snapshots=args.snapshots, seed=args.seed
+    )
+
+
+def run_generate(args):
+    """Generates the database as configured in the arguments"""
+    from .database import generate_database
+    return generate_database(args.database, database_scenario(args))
+
+
+def run_format(args):
+    """Runs the formatter benchmark as configured in the arguments"""
+    from .formatting import run_format
+    if args.database:
+        return run_format(args.database, args.formatters, args.output)
+
+    from .database import generate_database
+    with output_directory(None) as directory:
+        path = os.path.join(directory, 'export.db')
+        generate_database(path, database_scenario(args))
+        return run_format(path, args.formatters, args.output)
+
+
+def fmt_value(name, value):
+    """Formats a single result for humans to read."""
+    if value is None:
+        return 'unknown'
+    if name.endswith('_bytes'):
+        return '{:.2f} MB'.format(value / 1000 ** 2)
+    if isinstance(value, float):
+        return '{:.2f}'.format(value)
+    return str(value)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Prints how the results changed from the baseline, and returns
+    whether any of them got worse by more than the tolerance.
+    """
+    regressed = False
+    for name in sorted(results):
+        higher_is_better = next((better for suffix, better in COMPARED
+                                 if name.endswith(suffix)), None)
+        new, old = results[name], baseline.get(name)
+        if higher_is_better is None or not new or not old:
+            continue
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        status = 'REGRESSION' if worse > tolerance else 'ok'
+        regressed |= worse > tolerance
+        print('{:<30} {:>+7.1%}  {}'.format(name, change, status))
+    return regressed
+
+
+def main():
+    """Runs the benchmark given in the arguments, returning the exit code"""
+    args = parse_args()
+    results = {
+        'export': run_export,
+        'replay': run_replay,
+        'classify': run_classify,
+        'generate': run_generate,
+        'format': run_format
+    }[args.command](args)
+    results['command'] = args.command
+
+    width = max(map(len, results))
+    for name, value in results.items():
+        print('{:<{}} {}'.format(name, width, fmt_value(name, value)))
+
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(results, file, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline.get('command') != args.command:
+            print('Cannot compare against the results of a different '
+                  'benchmark', file=sys.stderr)
+            return 2
+        if compare(results, baseline, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    exit(main())
@@ -0,0 +1,163 @@
+"""
+Benchmarks telling apart the kinds of media and actions of the messages,
+which the exporter does for every message it dumps, without the database
+(so that the cost of the classification itself can be seen).
+"""
+import random
+import time
+
+from telethon.tl import types
+
+from .fakeclient import FakeClient, Scenario
+from .. import utils
+
+
+def make_messages(scenario):
+    """Returns the messages of the dialogs the scenario describes."""
+    client = FakeClient(scenario)
+    rng = random.Random(scenario.seed)
+    return [client._make_message(rng, dialog, msg_id)[0]
+            for dialog in client.dialogs
+            for msg_id in range(1, scenario.messages + 1)]
+
+
+def baseline_get_media_type(media):
+    """
+    `utils.get_media_type` as it was before the `utils.TL_TYPES` registry,
+    kept as it was (even where it can never tell apart the documents) so
+    that both can be compared.
+    """
+    if not media:
+        return ''
+
+    if isinstance(media, types.MessageMediaPhoto):
+        return 'photo'
+
+    elif isinstance(media, types.MessageMediaDocument):
+        if isinstance(media, types.Document):
+            for attr in media.attributes:
+                if isinstance(attr, types.DocumentAttributeSticker):
+                    return 'document.sticker'
+                elif isinstance(attr, types.DocumentAttributeVideo):
+                    return 'document.video'
+                elif isinstance(attr, types.DocumentAttributeAnimated):
+                    return 'document.animated'
+                elif isinstance(attr, types.DocumentAttributeAudio):
+                    if attr.voice:
+                        return 'document.voice'
+                    return 'document.audio'
+        return 'document'
+
+    if isinstance(media, (types.Photo,
+                          types.UserProfilePhoto, types.ChatPhoto)):
+        return 'chatphoto'
+
+    return 'unknown'
+
+
+def baseline_action_to_name(action):
+    """
+    `utils.action_to_name` as it was before the `utils.TL_TYPES` registry,
+    which made the dictionary of names again on every call.
+    """
+    return {
+        types.MessageActionChannelCreate: 'channel.create',
+        types.MessageActionChannelMigrateFrom: 'channel.migratefrom',
+        types.MessageActionChatAddUser: 'chat.adduser',
+        types.MessageActionChatCreate: 'chat.create',
+        types.MessageActionChatDeletePhoto: 'chat.deletephoto',
+        types.MessageActionChatDeleteUser: 'chat.deleteuser',
+        types.MessageActionChatEditPhoto: 'chat.editphoto',
+        types.MessageActionChatEditTitle: 'chat.edittitle',
+        types.MessageActionChatJoinedByLink: 'chat.joinedbylink',
+        types.MessageActionChatMigrateTo: 'chat.migrateto',
+        types.MessageActionCustomAction: 'custom',
+        types.MessageActionEmpty: 'empty',
+        types.MessageActionGameScore: 'game.score',
+        types.MessageActionHistoryClear: 'history.clear',
+        types.MessageActionPaymentSent: 'payment.sent',
+        types.MessageActionPaymentSentMe: 'payment.sentme',
+        types.MessageActionPhoneCall: 'phone.call',
+        types.MessageActionPinMessage: 'pin.message',
+        types.MessageActionScreenshotTaken: 'screenshottaken',
+
+        types.ChannelAdminLogEventActionChangeAbout: 'change.about',
+        types.ChannelAdminLogEventActionChangePhoto: 'change.photo',
+        types.ChannelAdminLogEventActionChangeStickerSet: 'change.stickerset',
+        types.ChannelAdminLogEventActionChangeTitle: 'change.title',
+        types.ChannelAdminLogEventActionChangeUsername: 'change.username',
+        types.ChannelAdminLogEventActionDeleteMessage: 'delete.message',
+        types.ChannelAdminLogEventActionEditMessage: 'edit.message',
+        types.ChannelAdminLogEventActionParticipantInvite: 'participant.invite',
+        types.ChannelAdminLogEventActionParticipantJoin: 'participant.join',
+        types.ChannelAdminLogEventActionParticipantLeave: 'participant.leave',
+        types.ChannelAdminLogEventActionParticipantToggleAdmin: 'participant.toggleadmin',
+        types.ChannelAdminLogEventActionParticipantToggleBan: 'participant.toggleban',
+        types.ChannelAdminLogEventActionToggleInvites: 'toggle.invites',
+        types.ChannelAdminLogEventActionTogglePreHistoryHidden: 'toggle.prehistoryhidden',
+        types.ChannelAdminLogEventActionToggleSignatures: 'toggle.signatures',
+        types.ChannelAdminLogEventActionUpdatePinned: 'update.pinned',
+    }.get(type(action), None)
+
+
+def _dump_nothing(media, media_type=None):
+    return None
+
+
+def _time(function, items, rounds):
+    """Returns how many nanoseconds calling function takes per item."""
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for item in items:
+            function(item)
+    elapsed = time.perf_counter() - start
+    return elapsed * 1e9 / (rounds * len(items)) if items else None
+
+
+def run_classify(scenario, rounds=10):
+    """
+    Classifies the media and actions of the messages served for the given
+    scenario as many times as rounds, and returns a dictionary with the
+    results of the benchmark: how long `utils.get_media_type`,
+    `utils.action_to_name` and `utils.media_to_row` take on average, and
+    how many messages all of them classify per second.
+
+    The first two are also timed as they were before the registry (the
+    ``baseline_`` results), and how many times faster they are now is
+    given as the ``_speedup`` of each.
+    """
+    messages = make_messages(scenario)
+    media = [m.media for m in messages if getattr(m, 'media', None)]
+    actions = [m.action for m in messages if getattr(m, 'action', None)]
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for message in messages:
+            action = getattr(message, 'action', None)
+            if action:
+                utils.action_to_name(action)
+            elif message.media:
+                utils.get_media_type(message.media)
+                utils.media_to_row(message.media, _dump_nothing)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        'messages': len(messages),
+        'media': len(media),
+        'actions': len(actions),
+        'seconds': elapsed,
+        'messages_per_second': rounds * len(messages) / elapsed
+        if elapsed else None,
+        'media_type_ns': _time(utils.get_media_type, media, rounds),
+        'action_name_ns': _time(utils.action_to_name, actions, rounds),
+        'media_row_ns': _time(
+            lambda m: utils.media_to_row(m, _dump_nothing), media, rounds),
+        'baseline_media_type_ns': _time(
+            baseline_get_media_type, media, rounds),
+        'baseline_action_name_ns': _time(
+            baseline_action_to_name, actions, rounds)
+    }
+    for name in ('media_type', 'action_name'):
+        new, old = results[name + '_ns'], results['baseline_' + name + '_ns']
+        results[name + '_speedup'] = old / new if new and old else None
+    return results
@@ -0,0 +1,312 @@
+"""
+Generates synthetic export databases of any size, with the same schema the
+Dumper creates, so that the formatters can be benchmarked without a real
+export (or the days it would take to make one with millions of messages).
+"""
+import json
+import os
+import random
+import time
+from datetime import datetime
+
+from ..dumper import Dumper
+from ..formatting import MessageEntity, encode_formatting
+from .export import make_config
+from .fakeclient import DIALOG_KINDS, SELF_ID
+
+# Rows are inserted in batches of this size
+BATCH_SIZE = 10000
+
+# The generated histories span these dates
+START_DATE = datetime(2015, 1, 1).timestamp()
+END_DATE = datetime(2018, 6, 1).timestamp()
+
+# (type, mime type, file name, weight) of the generated media. The Dumper
+# saves everything but photos as documents (see `utils.get_media_type`),
+# telling stickers, voice notes and videos apart only by their mime type
+# and file name, if they have one. Photos are named after their date, and
+# the "{}" in the file names is replaced with a random word.
+MEDIA_TYPES = (
+    ('photo', 'image/jpeg', None, 10),
+    ('document', 'application/pdf', '{}.pdf', 2),
+    ('document', 'image/webp', 'sticker.webp', 4),
+    ('document', 'audio/ogg', None, 2),
+    ('document', 'video/mp4', None, 1),
+)
+
+ENTITY_KINDS = ('bold', 'italic', 'code', 'pre', 'url', 'texturl',
+                'mentionname')
+
+# Groups never have more members speaking than this
+MAX_MEMBERS = 50
+
+
+class DatabaseScenario:
+    """
+    Describes the export database to generate. The messages are split
+    between the contexts with a long tail like in real archives (a few
+    huge groups and many small chats), and every user and context has
+    ``snapshots`` versions saved at different dates, as if it had been
+    exported that many times while it changed its name.
+    """
+    def __init__(self, contexts=10, messages=10000, users=200, snapshots=3,
+                 reply_ratio=0.15, forward_ratio=0.05, media_ratio=0.1,
+                 entities_ratio=0.1, service_ratio=0.01, seed=0):
+        self.contexts = contexts
+        self.messages = messages
+        self.users = max(users, 1)
+        self.snapshots = max(snapshots, 1)
+        self.reply_ratio = reply_ratio
+        self.forward_ratio = forward_ratio
+        self.media_ratio = media_ratio
+        self.entities_ratio = entities_ratio
+        self.service_ratio = service_ratio
+        self.seed = seed
+
+
+class DatabaseGenerator:
+    """Writes the rows described by a `DatabaseScenario` into a database."""
+    def __init__(self, conn, scenario):
+        self.conn = conn
+        self.scenario = scenario
+        self.rng = random.Random(scenario.seed)
+        self.words = [self._word() for _ in range(1000)]
+        self.user_ids = [SELF_ID] + [
+            1000 + i for i in range(1, scenario.users)]
+        self.free_users = self.user_ids[:0:-1]
+        self.next_media_id = 1
+        self.next_forward_id = 1
+        self.media = []
+        self.forwards = []
+
+    def _word(self):
+        return ''.join(self.rng.choice('bcdfghjklmnprstvz') +
+                       self.rng.choice('aeiou')
+                       for _ in range(self.rng.randint(1, 4)))
+
+    def _text(self, low=1, high=30):
+        return ' '.join(self.rng.choice(self.words)
+                        for _ in range(self.rng.randint(low, high)))
+
+    def _snapshot_dates(self):
+        step = (END_DATE - START_DATE) / self.scenario.snapshots
+        return [int(START_DATE + step * (i + 1))
+                for i in range(self.scenario.snapshots)]
+
+    def _flush(self, force=False):
+        if force or len(self.media) >= BATCH_SIZE:
+            self.conn.executemany('INSERT INTO Media VALUES '
+                                  '(?,?,?,?,?,?,?,?,?,?)', self.media)
+            self.media.clear()
+        if force or len(self.forwards) >= BATCH_SIZE:
+            self.conn.executemany('INSERT INTO Forward VALUES (?,?,?,?,?)',
+                                  self.forwards)
+            self.forwards.clear()
+
+    def add_media(self, date):
+        """Adds a random Media row and returns its ID."""
+        kind, mime, name, _ = self.rng.choices(
+            MEDIA_TYPES, weights=[m[3] for m in MEDIA_TYPES])[0]
+        if kind == 'photo':
+            name = str(datetime.fromtimestamp(date))
+        elif name:
+            name = name.format(self.rng.choice(self.words))
+        media_id = self.next_media_id
+        self.next_media_id += 1
+        self.media.append((
+            media_id, name, mime, self.rng.randint(1000, 2 * 1024 ** 2),
+            None, kind, self.rng.getrandbits(31), self.rng.getrandbits(31),
+            self.rng.getrandbits(63), '{}'
+        ))
+        self._flush()
+        return media_id
+
+    def add_forward(self, date):
+        """Adds a random Forward row and returns its ID."""
+        forward_id = self.next_forward_id
+        self.next_forward_id += 1
+        self.forwards.append((
+            forward_id, int(date - self.rng.uniform(0, 30 * 86400)),
+            self.rng.choice(self.user_ids), None, None
+        ))
+        self._flush()
+        return forward_id
+
+    def add_users(self):
+        """Adds every user, once per snapshot."""
+        rows = []
+        for uid in self.user_ids:
+            first, last = self._text(1, 1).title(), self._text(1, 1).title()
+            has_photo = self.rng.random() < 0.5
+            for i, date in enumerate(self._snapshot_dates()):
+                rows.append((
+                    uid, date, '{}{}'.format(first, i or ''),
+                    last if self.rng.random() < 0.7 else None,
+                    '{}{}'.format(first.lower(), uid)
+                    if self.rng.random() < 0.6 else None,
+                    '+{}'.format(10000000 + uid), self._text(0, 10),
+                    uid % 50 == 0, self.rng.randint(0, 10),
+                    self.add_media(date) if has_photo else None
+                ))
+        self.conn.executemany('INSERT INTO User VALUES (?,?,?,?,?,?,?,?,?,?)',
+                              rows)
+        self.conn.execute('INSERT INTO SelfInformation VALUES (?)', (SELF_ID,))
+
+    def add_context(self, index):
+        """
+        Adds the entity for the context with the given index, once per
+        snapshot, and returns its (marked ID, kind, members). Every user
+        has at most one dialog, so chats are made instead once they run out.
+        """
+        kind = DIALOG_KINDS[index % len(DIALOG_KINDS)]
+        title = self._text(1, 3).title()
+        if kind == 'user':
+            if self.free_users:
+                peer = self.free_users.pop()
+                return peer, kind, [SELF_ID, peer]
+            kind = 'chat'  # Not enough users to talk with all of them
+
+        members = self.rng.sample(self.user_ids[1:], min(
+            MAX_MEMBERS, len(self.user_ids) - 1)) + [SELF_ID]
+        for i, date in enumerate(self._snapshot_dates()):
+            title_at = '{}{}'.format(title, i or '')
+            if kind == 'chat':
+                peer = -(100 + index)
+                self.conn.execute('INSERT INTO Chat VALUES (?,?,?,?,?)',
+                                  (peer, date, title_at, None, None))
+            else:
+                peer = int('-100{}'.format(1000000 + index))
+                self.conn.execute(
+                    'INSERT INTO {} VALUES (?,?,?,?,?,?,?)'.format(
+                        'Supergroup' if kind == 'megagroup' else 'Channel'),
+                    (peer, date, self._text(0, 15), title_at,
+                     None, None, None)
+                )
+        if kind != 'channel':
+            self.conn.execute(
+                'INSERT INTO ChatParticipants VALUES (?,?,?,?)',
+                (peer, self._snapshot_dates()[-1],
+                 ','.join(map(str, members)), '')
+            )
+        return peer, kind, members
+
+    def _formatting(self, text):
+        entities = []
+        for _ in range(self.rng.randint(1, 3)):
+            kind = self.rng.choice(ENTITY_KINDS)
+            offset = self.rng.randrange(len(text))
+            length = self.rng.randint(1, len(text) - offset)
+            url = user_id = None
+            if kind == 'texturl':
+                url = 'https://example.com/' + self.rng.choice(self.words)
+            elif kind == 'mentionname':
+                user_id = self.rng.choice(self.user_ids)
+            entities.append(MessageEntity(kind, offset, length, url, user_id,
+                                          None))
+        return encode_formatting(entities)
+
+    def _service(self, kind, members):
+        if kind == 'user':
+            return 'phone.call', json.dumps({
+                'call_id': self.rng.getrandbits(63), 'reason': None,
+                'duration': self.rng.randint(1, 3600)})
+        action = self.rng.choice(('chat.adduser', 'chat.edittitle',
+                                  'pin.message'))
+        if action == 'chat.adduser':
+            extra = {'users': [self.rng.choice(members)]}
+        elif action == 'chat.edittitle':
+            extra = {'title': self._text(1, 3).title()}
+        else:
+            extra = {}
+        return action, json.dumps(extra)
+
+    def add_messages(self, peer, kind, members, count):
+        """Adds the given amount of messages to the context."""
+        s, rng = self.scenario, self.rng
+        date = rng.uniform(START_DATE, END_DATE - (END_DATE - START_DATE) / 4)
+        gap = (END_DATE - date) / max(count, 1)
+        rows = []
+        for msg_id in range(1, count + 1):
+            date += rng.expovariate(1 / gap) if gap else 0
+            from_id = None if kind == 'channel' else rng.choice(members)
+            if rng.random() < s.service_ratio:
+                action, text = self._service(kind, members)
+                rows.append((msg_id, peer, int(date), from_id, text, None,
+                             None, None, None, None, None, action))
+            else:
+                text = self._text()
+                rows.append((
+                    msg_id, peer, int(date), from_id, text,
+                    rng.randint(max(1, msg_id - 100), msg_id - 1)
+                    if msg_id > 1 and rng.random() < s.reply_ratio else None,
+                    self.add_forward(date)
+                    if rng.random() < s.forward_ratio else None,
+                    self._text(1, 2).title()
+                    if kind == 'channel' and rng.random() < 0.3 else None,
+                    rng.randint(1, 100000) if kind == 'channel' else None,
+                    self.add_media(date)
+                    if rng.random() < s.media_ratio else None,
+                    self._formatting(text)
+                    if rng.random() < s.entities_ratio else None,
+                    None
+                ))
+            if len(rows) >= BATCH_SIZE:
+                self.conn.executemany('INSERT INTO Message VALUES '
+                                      '(?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+                rows.clear()
+        self.conn.executemany('INSERT INTO Message VALUES '
+                              '(?,?,?,?,?,?,?,?,?,?,?,?)', rows)
+
+    def split_messages(self):
+        """Splits the messages between the contexts with a long tail."""
+        s = self.scenario
+        weights = [self.rng.paretovariate(1.2) for _ in range(s.contexts)]
+        total = sum(weights)
+        counts = [int(s.messages * w / total) for w in weights]
+        counts[weights.index(max(weights))] += s.messages - sum(counts)
+        return counts
+
+    def generate(self):
+        """Generates the whole database."""
+        self.add_users()
+        for index, count in enumerate(self.split_messages()):
+            peer, kind, members = self.add_context(index)
+            self.add_messages(peer, kind, members, count)
+        self._flush(force=True)
+        self.conn.commit()
+
+
+def generate_database(path, scenario):
+    """
+    Generates a new export database at the given path (which must not
+    exist) as described by the scenario, and returns a dictionary with
+    the results of the generation.
+    """
+    if os.path.exists(path):
+        raise FileExistsError('{} already exists'.format(path))
+
+    directory, name = os.path.split(os.path.abspath(path))
+    if name.endswith('.db'):
+        name = name[:-3]
+    config = make_config(directory)
+    config['Dumper']['DBFileName'] = name
+    conn = Dumper(config['Dumper']).conn
+    try:
+        # Losing the database if we crash is fine, it will be made again
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA journal_mode = MEMORY')
+        start = time.perf_counter()
+        DatabaseGenerator(conn, scenario).generate()
+        elapsed = time.perf_counter() - start
+    finally:
+        conn.close()
+
+    return {
+        'contexts': scenario.contexts,
+        'users': scenario.users,
+        'messages': scenario.messages,
+        'seconds': elapsed,
+        'messages_per_second': scenario.messages / elapsed
+        if elapsed else None,
+        'db_bytes': os.path.getsize(os.path.join(directory, name + '.db'))
+    }
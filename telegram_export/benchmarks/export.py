@@ -0,0 +1,118 @@
+"""Benchmarks a full export of the dialogs served by a FakeClient."""
+import asyncio
+import configparser
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+from .. import downloader
+from ..dumper import Dumper
+from ..exporter import Exporter
+from ..metrics import METRICS
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Not available on Windows
+
+DELAYS = ('USER_FULL_DELAY', 'CHAT_FULL_DELAY', 'MEDIA_DELAY', 'HISTORY_DELAY')
+
+
+def make_config(output_dir, media_whitelist='chatphoto, photo, sticker',
+                chunk_size=100, max_size=1024 ** 2):
+    """
+    Returns a config like the one `load_config` would return with the
+    default values, saving into the given output directory.
+    """
+    config = configparser.ConfigParser()
+    config.read_dict({
+        'TelegramAPI': {'SessionName': 'benchmark'},
+        'Dumper': {
+            'OutputDirectory': output_dir,
+            'MediaWhitelist': media_whitelist,
+            'MaxSize': str(max_size),
+            'DBFileName': 'export',
+            'InvalidationTime': str(7200 * 60),
+            'ChunkSize': str(chunk_size),
+            'MaxChunks': '0',
+            'MediaFilenameFmt':
+                'usermedia/{name}-{context_id}/{type}-{filename}'
+        }
+    })
+    return config
+
+
+@contextmanager
+def downloader_delays(enabled):
+    """
+    Sets the delays the Downloader sleeps for between requests to zero
+    within the ``with`` block, unless enabled, so that the benchmark
+    measures the exporter rather than its deliberate throttling.
+    """
+    if enabled:
+        yield
+        return
+
+    old = {name: getattr(downloader, name) for name in DELAYS}
+    try:
+        for name in DELAYS:
+            setattr(downloader, name, 0)
+        yield
+    finally:
+        for name, value in old.items():
+            setattr(downloader, name, value)
+
+
+def peak_rss():
+    """Returns the peak resident memory of this process in bytes, if known."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def directory_size(path):
+    """Returns the total size and amount of files under the given path."""
+    size = count = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            size += os.path.getsize(os.path.join(root, name))
+            count += 1
+    return size, count
+
+
+def run_export(client, config, throttle=False):
+    """
+    Exports everything the given client serves with the given config,
+    and returns a dictionary with the results of the benchmark.
+    """
+    METRICS.reset()
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    dumper = Dumper(config['Dumper'])
+    exporter = Exporter(client, config, dumper, loop)
+    try:
+        with downloader_delays(throttle):
+            start = time.perf_counter()
+            loop.run_until_complete(exporter.start())
+            elapsed = time.perf_counter() - start
+        messages = dumper.conn.execute(
+            'SELECT COUNT(*) FROM Message').fetchone()[0]
+    finally:
+        loop.run_until_complete(exporter.close())
+        loop.close()
+
+    output = config['Dumper']['OutputDirectory']
+    db_path = os.path.join(output, config['Dumper']['DBFileName'] + '.db')
+    media_bytes, media_files = directory_size(os.path.join(output, 'usermedia'))
+    return {
+        'messages': messages,
+        'seconds': elapsed,
+        'messages_per_second': messages / elapsed if elapsed else None,
+        'requests': client.requests,
+        'db_bytes': os.path.getsize(db_path),
+        'media_files': media_files,
+        'media_bytes': media_bytes,
+        'peak_rss_bytes': peak_rss()
+    }
@@ -0,0 +1,447 @@
+"""
+A fake TelegramClient answering the requests made by the exporter with
+synthetic (but realistic looking) data, generated on demand in-process.
+"""
+import asyncio
+import datetime
+import itertools
+import os
+import random
+
+from async_generator import yield_, async_generator
+from telethon import utils
+from telethon.errors import ChatAdminRequiredError
+from telethon.tl import types, functions
+
+from ..recording import OfflineDialog
+
+SELF_ID = 1
+
+# The kinds of dialog the scenario cycles through, so that every code path
+# (private chats, small groups, megagroups and broadcast channels) is hit.
+DIALOG_KINDS = ('user', 'chat', 'megagroup', 'channel')
+
+# Relative frequencies of the media attached to messages, {type: ratio}.
+DEFAULT_MEDIA_MIX = {
+    'photo': 0.08, 'document': 0.02, 'sticker': 0.04,
+    'voice': 0.02, 'video': 0.01
+}
+
+WORDS = (
+    'the of and to in is you that it he was for on are as with his they at '
+    'be this have from or one had by word but not what all were we when your '
+    'can said there use an each which she do how their if will up other '
+    'about out many then them these so some her would make like him into '
+    'time has look two more write go see number no way could people my than '
+    'first water been call who oil its now find long down day did get come '
+    'made may part telegram export message chat channel group sticker photo '
+    'meeting tomorrow lunch python database sqlite release weekend'
+).split()
+
+FIRST_NAMES = ('Alice', 'Bob', 'Carol', 'Dave', 'Eve', 'Frank', 'Grace',
+               'Heidi', 'Ivan', 'Judy', 'Mallory', 'Niaj', 'Olivia', 'Peggy')
+LAST_NAMES = ('Smith', 'Jones', 'Taylor', 'Brown', 'Garcia', 'Miller',
+              'Davis', 'Wilson', 'Moore', 'Clark', None, None, None)
+
+BASE_DATE = datetime.datetime(2018, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def parse_media_mix(string):
+    """Parses a media mix such as ``'photo=0.1, voice=0.02'`` into a dict."""
+    mix = {}
+    for item in string.split(','):
+        if item.strip():
+            kind, ratio = item.split('=')
+            mix[kind.strip()] = float(ratio)
+    return mix
+
+
+class Scenario:
+    """
+    Describes the data that the `FakeClient` should serve: how many dialogs
+    and messages there are, how they look, and how slow the network is.
+    """
+    def __init__(self, dialogs=4, messages=2000, media_mix=None,
+                 media_size=64 * 1024, reply_ratio=0.15, forward_ratio=0.05,
+                 entities_ratio=0.1, service_ratio=0.01, participants=100,
+                 admin_log=50, latency=0.0, bandwidth=0, seed=0):
+        self.dialogs = dialogs
+        self.messages = messages
+        self.media_mix = DEFAULT_MEDIA_MIX if media_mix is None else media_mix
+        self.media_size = media_size
+        self.reply_ratio = reply_ratio
+        self.forward_ratio = forward_ratio
+        self.entities_ratio = entities_ratio
+        self.service_ratio = service_ratio
+        self.participants = participants
+        self.admin_log = admin_log
+        self.latency = latency  # Seconds per request
+        self.bandwidth = bandwidth  # Bytes per second, 0 for unlimited
+        self.seed = seed
+
+
+class FakeSender:
+    """Stands in for the sender of a TelegramClient, to reconnect."""
+    def __init__(self):
+        self._auto_reconnect_callback = None
+
+
+class FakeClient:
+    """
+    Stands in for a connected TelegramClient. Only the methods used by the
+    Exporter and Downloader are implemented. Every request (and every part
+    of a download) waits for the scenario's latency before being answered.
+
+    Messages are generated for each chunk as it's requested, always in the
+    same way for the same chunk, so that serving large histories doesn't
+    use more memory than the exporter itself would.
+    """
+    def __init__(self, scenario):
+        self.scenario = scenario
+        self.requests = 0
+        rng = random.Random(scenario.seed)
+
+        self.me = types.User(id=SELF_ID, is_self=True, access_hash=SELF_ID,
+                             first_name='Me', username='me')
+        self.members = [self._make_user(rng, 1000 + i)
+                        for i in range(scenario.participants)]
+
+        self.dialogs = []
+        for i in range(scenario.dialogs):
+            kind = DIALOG_KINDS[i % len(DIALOG_KINDS)]
+            self.dialogs.append(self._make_dialog(rng, kind, i))
+
+        self._entities = {utils.get_peer_id(x): x for x in itertools.chain(
+            (self.me,), self.members, self.dialogs)}
+
+        self.connects = 0
+        self.event_handlers = []
+        self._sender = FakeSender()
+        self._connected = True
+        self._disconnected = None
+
+    # Data generation
+    @staticmethod
+    def _make_user(rng, user_id):
+        photo = types.UserProfilePhotoEmpty()
+        if rng.random() < 0.5:
+            photo = types.UserProfilePhoto(
+                photo_id=user_id,
+                photo_small=types.FileLocation(2, user_id, 1, user_id),
+                photo_big=types.FileLocation(2, user_id, 2, user_id)
+            )
+        return types.User(
+            id=user_id, access_hash=user_id,
+            first_name=rng.choice(FIRST_NAMES),
+            last_name=rng.choice(LAST_NAMES),
+            username='user{}'.format(user_id) if rng.random() < 0.6 else None,
+            phone=str(440000000 + user_id) if rng.random() < 0.3 else None,
+            photo=photo
+        )
+
+    def _make_dialog(self, rng, kind, index):
+        title = ' '.join(rng.choice(WORDS).title() for _ in range(2))
+        if kind == 'user':
+            return self._make_user(rng, 10000 + index)
+        if kind == 'chat':
+            return types.Chat(
+                id=20000 + index, title=title, photo=types.ChatPhotoEmpty(),
+                participants_count=len(self.members), date=BASE_DATE,
+                version=1
+            )
+        return types.Channel(
+            id=30000 + index, title=title, photo=types.ChatPhotoEmpty(),
+            date=BASE_DATE, version=0, access_hash=index,
+            megagroup=kind == 'megagroup', broadcast=kind == 'channel',
+            username='group{}'.format(index) if index % 2 else None
+        )
+
+    def _make_media(self, rng, kind, media_id, date):
+        size = rng.randint(self.scenario.media_size // 2,
+                           self.scenario.media_size * 3 // 2)
+        if kind == 'photo':
+            return types.MessageMediaPhoto(photo=types.Photo(
+                id=media_id, access_hash=media_id, date=date, sizes=[
+                    types.PhotoSize('s', types.FileLocation(
+                        2, media_id, 1, media_id), 90, 90, size // 50),
+                    types.PhotoSize('x', types.FileLocation(
+                        2, media_id, 2, media_id), 800, 600, size)
+                ]
+            ))
+
+        attributes = {
+            'sticker': [types.DocumentAttributeSticker(
+                '\U0001F600', types.InputStickerSetEmpty())],
+            'voice': [types.DocumentAttributeAudio(
+                duration=rng.randint(1, 60), voice=True)],
+            'video': [types.DocumentAttributeVideo(
+                duration=rng.randint(1, 120), w=640, h=360)],
+        }.get(kind, [types.DocumentAttributeFilename(
+            'file{}.pdf'.format(media_id))])
+        mime = {'sticker': 'image/webp', 'voice': 'audio/ogg',
+                'video': 'video/mp4'}.get(kind, 'application/pdf')
+        return types.MessageMediaDocument(document=types.Document(
+            id=media_id, access_hash=media_id, date=date, mime_type=mime,
+            size=size, thumb=types.PhotoSizeEmpty('s'), dc_id=2, version=0,
+            attributes=attributes
+        ))
+
+    def _make_message(self, rng, dialog, msg_id):
+        scenario = self.scenario
+        peer = utils.get_peer(dialog)
+        date = BASE_DATE + datetime.timedelta(minutes=msg_id)
+        if isinstance(dialog, types.User):
+            sender = rng.choice((self.me, dialog))
+        elif isinstance(dialog, types.Channel) and dialog.broadcast:
+            sender = None
+        else:
+            sender = rng.choice(self.members)
+        from_id = sender.id if sender else None
+
+        if (not isinstance(dialog, types.User)
+                and rng.random() < scenario.service_ratio):
+            return types.MessageService(
+                id=msg_id, to_id=peer, date=date, from_id=from_id,
+                action=types.MessageActionChatEditTitle(
+                    ' '.join(rng.choice(WORDS) for _ in range(3)))
+            ), sender
+
+        words = [rng.choice(WORDS)
+                 for _ in range(1 + int(rng.expovariate(1 / 12)))]
+        text = ' '.join(words)
+        entities = None
+        if rng.random() < scenario.entities_ratio:
+            entities = [types.MessageEntityBold(0, len(words[0]))]
+            if len(words) > 2:
+                offset = len(words[0]) + 1
+                entities.append(types.MessageEntityTextUrl(
+                    offset, len(words[1]), 'https://example.com/' + words[1]))
+
+        media = None
+        roll = rng.random()
+        for kind, ratio in scenario.media_mix.items():
+            if roll < ratio:
+                media = self._make_media(
+                    rng, kind, dialog.id * 1000000 + msg_id, date)
+                break
+            roll -= ratio
+
+        reply_to = None
+        if msg_id > 1 and rng.random() < scenario.reply_ratio:
+            reply_to = max(1, msg_id - rng.randint(1, 20))
+
+        fwd_from = None
+        if rng.random() < scenario.forward_ratio:
+            fwd_from = types.MessageFwdHeader(
+                date=date - datetime.timedelta(days=rng.randint(1, 30)),
+                from_id=rng.choice(self.members).id
+            )
+
+        broadcast = sender is None
+        return types.Message(
+            id=msg_id, to_id=peer, date=date, out=from_id == SELF_ID,
+            from_id=from_id, message=text, entities=entities, media=media,
+            reply_to_msg_id=reply_to, fwd_from=fwd_from, post=broadcast,
+            views=rng.randint(100, 10000) if broadcast else None
+        ), sender
+
+    def _get_history(self, request):
+        dialog = self._entities[utils.get_peer_id(request.peer)]
+        total = self.scenario.messages
+        top = request.offset_id - 1 if request.offset_id else total
+        bottom = max(top - request.limit, 0)
+
+        messages, users = [], {}
+        for msg_id in range(top, bottom, -1):
+            # Seeded by message so that it's always the same, whichever
+            # chunk it's in (the newest ones are fetched again every run)
+            rng = random.Random('{}:{}:{}'.format(
+                self.scenario.seed, dialog.id, msg_id))
+            message, sender = self._make_message(rng, dialog, msg_id)
+            messages.append(message)
+            if sender:
+                users[sender.id] = sender
+        if isinstance(dialog, types.User):
+            users[dialog.id] = dialog
+            chats = []
+        else:
+            chats = [dialog]
+
+        return types.messages.MessagesSlice(
+            count=total, messages=messages, chats=chats,
+            users=list(users.values())
+        )
+
+    def _get_admin_log(self, request):
+        channel = self._entities[utils.get_peer_id(request.channel)]
+        if not channel.megagroup:
+            # Pretend we're not an admin of the broadcast channels
+            raise ChatAdminRequiredError(request)
+
+        top = request.max_id - 1 if request.max_id else self.scenario.admin_log
+        bottom = max(top - request.limit, 0)
+        rng = random.Random('{}:{}:log{}'.format(
+            self.scenario.seed, channel.id, top))
+        events, users = [], {}
+        for event_id in range(top, bottom, -1):
+            user = rng.choice(self.members)
+            users[user.id] = user
+            events.append(types.ChannelAdminLogEvent(
+                id=event_id, user_id=user.id,
+                date=BASE_DATE + datetime.timedelta(hours=event_id),
+                action=types.ChannelAdminLogEventActionChangeTitle(
+                    prev_value=rng.choice(WORDS), new_value=channel.title)
+            ))
+        return types.channels.AdminLogResults(
+            events=events, chats=[channel], users=list(users.values()))
+
+    def _get_full_user(self, request):
+        user = self._entities[getattr(request.id, 'user_id', SELF_ID)]
+        rng = random.Random('{}:{}'.format(self.scenario.seed, user.id))
+        photo = None
+        if isinstance(user.photo, types.UserProfilePhoto):
+            photo = types.Photo(
+                id=user.id, access_hash=user.id, date=BASE_DATE,
+                sizes=[types.PhotoSize('c', user.photo.photo_big,
+                                       160, 160, 8192)]
+            )
+        return types.UserFull(
+            user=user,
+            link=types.contacts.Link(types.ContactLinkNone(),
+                                     types.ContactLinkNone(), user),
+            notify_settings=types.PeerNotifySettings(),
+            common_chats_count=rng.randint(0, 10),
+            about=' '.join(rng.choice(WORDS) for _ in range(8)),
+            profile_photo=photo
+        )
+
+    def _get_full_channel(self, request):
+        channel = self._entities[utils.get_peer_id(request.channel)]
+        return types.messages.ChatFull(
+            full_chat=types.ChannelFull(
+                id=channel.id, about='About ' + channel.title,
+                read_inbox_max_id=0, read_outbox_max_id=0, unread_count=0,
+                chat_photo=types.PhotoEmpty(0),
+                notify_settings=types.PeerNotifySettings(),
+                exported_invite=types.ChatInviteEmpty(), bot_info=[],
+                participants_count=len(self.members),
+                pinned_msg_id=self.scenario.messages or None
+            ),
+            chats=[channel], users=[]
+        )
+
+    # Client API
+    async def __call__(self, request):
+        self.requests += 1
+        if self.scenario.latency:
+            await asyncio.sleep(self.scenario.latency)
+
+        if hasattr(request, 'resolve'):
+            await request.resolve(self, utils)
+        if isinstance(request, functions.messages.GetHistoryRequest):
+            return self._get_history(request)
+        if isinstance(request, functions.channels.GetAdminLogRequest):
+            return self._get_admin_log(request)
+        if isinstance(request, functions.users.GetFullUserRequest):
+            return self._get_full_user(request)
+        if isinstance(request, functions.channels.GetFullChannelRequest):
+            return self._get_full_channel(request)
+        raise NotImplementedError(
+            'FakeClient cannot answer {}'.format(type(request).__name__))
+
+    async def get_me(self, input_peer=False):
+        if input_peer:
+            return types.InputPeerUser(self.me.id, self.me.access_hash)
+        return self.me
+
+    async def get_input_entity(self, peer):
+        if isinstance(peer, int):
+            peer = self._entities[peer]
+        return utils.get_input_peer(peer)
+
+    async def get_entity(self, peer):
+        if not isinstance(peer, int):
+            peer = utils.get_peer_id(peer)
+        return self._entities[peer]
+
+    async def get_peer_id(self, peer):
+        if isinstance(peer, int):
+            return peer
+        return utils.get_peer_id(peer)
+
+    async def get_dialogs(self, limit=None):
+        return [OfflineDialog(x) for x in self.dialogs[:limit]]
+
+    @async_generator
+    async def iter_dialogs(self):
+        for dialog in await self.get_dialogs():
+            await yield_(dialog)
+
+    async def get_participants(self, entity):
+        # Telethon fetches them in chunks of 200
+        for _ in range(0, len(self.members), 200):
+            self.requests += 1
+            if self.scenario.latency:
+                await asyncio.sleep(self.scenario.latency)
+        return list(self.members)
+
+    async def download_file(self, location, file, file_size=None,
+                            part_size_kb=64, progress_callback=None):
+        part_size = part_size_kb * 1024
+        size = file_size or part_size
+        saved = 0
+        with open(file, 'wb') as fd:
+            while saved < size:
+                self.requests += 1
+                part = min(part_size, size - saved)
+                delay = self.scenario.latency
+                if self.scenario.bandwidth:
+                    delay += part / self.scenario.bandwidth
+                if delay:
+                    await asyncio.sleep(delay)
+                fd.write(os.urandom(part))
+                saved += part
+                if progress_callback:
+                    progress_callback(saved, file_size)
+        return file
+
+    # Connection, going away and coming back like telethon's does
+    def is_connected(self):
+        return self._connected
+
+    async def connect(self):
+        self.connects += 1
+        self._connected = True
+        self._disconnected = None
+
+    @property
+    def disconnected(self):
+        if self._disconnected is None:
+            self._disconnected = asyncio.get_event_loop().create_future()
+            if not self._connected:
+                self._disconnected.set_result(None)
+        return asyncio.shield(self._disconnected)
+
+    def add_event_handler(self, callback, event):
+        self.event_handlers.append((callback, event))
+
+    def reconnect(self):
+        """Pretends the connection dropped and came back on its own."""
+        callback = self._sender._auto_reconnect_callback
+        if callback:
+            asyncio.get_event_loop().create_task(callback())
+
+    def lose_connection(self):
+        """Pretends the connection dropped and couldn't come back."""
+        self._connected = False
+        if self._disconnected is not None \
+                and not self._disconnected.done():
+            self._disconnected.set_exception(ConnectionError())
+        self._disconnected = None
+
+    async def disconnect(self):
+        self._connected = False
+        if self._disconnected is not None \
+                and not self._disconnected.done():
+            self._disconnected.set_result(None)
+
@@ -0,0 +1,79 @@
+"""
+Benchmarks the formatters over every context of an export database.
+
+Every formatter runs in a new process of its own, so that the peak memory
+measured is only its own (and that of a bare interpreter), and so that no
+formatter benefits from what the one before it left in the page cache of
+SQLite or Python's allocator.
+"""
+import multiprocessing
+import os
+import tempfile
+import time
+
+from .export import peak_rss
+
+
+def _format_all(name, db_path, output):
+    """
+    Formats every context with the named formatter, in a new process. The
+    output is discarded if there's no directory to save it into, which
+    for formatters that write directories means a temporary one.
+    """
+    from ..formatters import NAME_TO_FORMATTER
+    formatter = NAME_TO_FORMATTER[name](db_path)
+    if output or not formatter.writes_directory:
+        return _time_format(formatter, output or os.devnull)
+
+    with tempfile.TemporaryDirectory() as directory:
+        return _time_format(formatter, directory)
+
+
+def _time_format(formatter, output):
+    start = time.perf_counter()
+    for context_id in formatter.iter_context_ids():
+        formatter.format(context_id, output)
+    return time.perf_counter() - start, peak_rss()
+
+
+def run_format(db_path, names=None, output=None):
+    """
+    Formats the database at the given path with the named formatters (all
+    of them by default), saving into the output directory or discarding
+    the results, and returns a dictionary with the results of the
+    benchmark. There is one ``<formatter>_`` result of each kind for
+    every formatter.
+    """
+    from ..formatters.reader import connect_reader
+    if not names:
+        from ..formatters import NAME_TO_FORMATTER
+        names = sorted(NAME_TO_FORMATTER)
+
+    conn = connect_reader(db_path)
+    try:
+        contexts, messages = conn.execute(
+            'SELECT COUNT(DISTINCT ContextID), COUNT(*) FROM Message'
+        ).fetchone()
+    finally:
+        conn.close()
+
+    results = {
+        'contexts': contexts,
+        'messages': messages,
+        'database_bytes': os.path.getsize(db_path)
+    }
+    context = multiprocessing.get_context('spawn')
+    for name in names:
+        directory = None
+        if output:
+            directory = os.path.join(output, name)
+            os.makedirs(directory, exist_ok=True)
+
+        with context.Pool(1) as pool:
+            elapsed, peak = pool.apply(_format_all,
+                                       (name, db_path, directory))
+        results[name + '_seconds'] = elapsed
+        results[name + '_messages_per_second'] = \
+            messages / elapsed if elapsed else None
+        results[name + '_peak_rss_bytes'] = peak
+    return results
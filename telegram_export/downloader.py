@@ -9,10 +9,13 @@ from collections import defaultdict
 
 import tqdm
 from telethon import utils
-from telethon.errors import ChatAdminRequiredError
+from telethon.errors import ChatAdminRequiredError, FloodWaitError
 from telethon.tl import types, functions
 
 from . import utils as export_utils
+from .mediapath import MediaPaths
+from .metrics import METRICS
+from .tracing import TRACER
 
 __log__ = logging.getLogger(__name__)
 
@@ -47,8 +50,9 @@ class Downloader:
         self.types = {x.strip().lower()
                       for x in (config.get('MediaWhitelist') or '').split(',')
                       if x.strip()}
-        self.media_fmt = os.path.join(config['OutputDirectory'],
-                                      config['MediaFilenameFmt'])
+        self.media_paths = MediaPaths(config['MediaFilenameFmt'],
+                                      self._get_name,
+                                      config['OutputDirectory'])
         assert all(x in VALID_TYPES for x in self.types)
         if self.types:
             self.types.add('unknown')  # Always allow "unknown" media types
@@ -75,16 +79,57 @@ class Downloader:
         self._user_queue = asyncio.Queue()
         self._chat_queue = asyncio.Queue()
         self._running = False
+        METRICS.set('queue_size', self._media_queue.qsize, queue='media')
+        METRICS.set('queue_size', self._user_queue.qsize, queue='user')
+        METRICS.set('queue_size', self._chat_queue.qsize, queue='chat')
+
+        # Entities seen through updates while watching are not tied to the
+        # dump of any context, so remember which context they came from in
+        # case they need to be saved for resuming later, {peer_id: context}.
+        self._live_contexts = {}
+
+    async def _invoke(self, request):
+        """
+        Invokes the given request through the client, keeping track of how
+        many requests of each type are made and how long they take.
+        """
+        name = type(request).__name__
+        METRICS.inc('requests_total', request=name)
+        try:
+            with TRACER.span('request', request=name), \
+                    METRICS.time('request_seconds', request=name):
+                return await self.client(request)
+        except FloodWaitError as e:
+            # Telethon sleeps on short flood waits by itself and only raises
+            # for the long ones, the former are counted by a logging filter.
+            METRICS.inc('flood_waits_total')
+            METRICS.inc('flood_wait_seconds_total', e.seconds)
+            raise
+
+    async def _sleep(self, delay, stage):
+        """Sleeps for delay seconds, keeping track of the time spent."""
+        delay = max(delay, 0)
+        METRICS.inc('sleep_seconds_total', delay, stage=stage)
+        with TRACER.span('sleep', stage=stage):
+            await asyncio.sleep(delay)
 
     def _check_media(self, media):
         """
         Checks whether the given MessageMedia should be downloaded or not.
         """
-        if not media or not self.max_size:
+        if not media:
             return False
-        if not self.types:
-            return True
-        return export_utils.get_media_type(media) in self.types
+        return self.should_download(export_utils.get_media_type(media))
+
+    def should_download(self, media_type):
+        """
+        Checks whether media of the given type (as in the Media table)
+        should be downloaded, as configured by MediaWhitelist and MaxSize
+        (of which only "0" is taken into account, to download nothing).
+        """
+        if not self.max_size:
+            return False
+        return not self.types or media_type in self.types
 
     def _dump_full_entity(self, entity):
         """
@@ -98,16 +143,17 @@ class Downloader:
                 photo_id = self.dumper.dump_media(entity.profile_photo)
             else:
                 photo_id = None
-            self.enqueue_photo(entity.profile_photo, photo_id, entity.user)
             self.dumper.dump_user(entity, photo_id=photo_id)
+            self._enqueue_picture('User', entity.profile_photo, photo_id,
+                                  entity.user)
 
         elif isinstance(entity, types.Chat):
             if not self.types or 'chatphoto' in self.types:
                 photo_id = self.dumper.dump_media(entity.photo)
             else:
                 photo_id = None
-            self.enqueue_photo(entity.photo, photo_id, entity)
             self.dumper.dump_chat(entity, photo_id=photo_id)
+            self._enqueue_picture('Chat', entity.photo, photo_id, entity)
 
         elif isinstance(entity, types.messages.ChatFull):
             if not self.types or 'chatphoto' in self.types:
@@ -117,12 +163,25 @@ class Downloader:
             chat = next(
                 x for x in entity.chats if x.id == entity.full_chat.id
             )
-            self.enqueue_photo(entity.full_chat.chat_photo, photo_id, chat)
             if chat.megagroup:
                 self.dumper.dump_supergroup(entity.full_chat, chat,
                                             photo_id)
+                table = 'Supergroup'
             else:
                 self.dumper.dump_channel(entity.full_chat, chat, photo_id)
+                table = 'Channel'
+            self._enqueue_picture(table, entity.full_chat.chat_photo,
+                                  photo_id, chat)
+
+    def _enqueue_picture(self, table, photo, photo_id, entity):
+        """
+        Enqueues the picture of the entity just dumped into the given table,
+        dated as the first row there with it, so that the path it's saved
+        to is the same every time (and the one the manifest says).
+        """
+        if photo_id:
+            self.enqueue_photo(photo, photo_id, entity, date=(
+                self.dumper.get_picture_date(table, photo_id)))
 
     def _dump_messages(self, messages, target):
         """
@@ -221,49 +280,22 @@ class Downloader:
             'SELECT LocalID, VolumeID, Secret, Type, MimeType, Name, Size '
             'FROM Media WHERE ID = ?', (media_id,)
         ).fetchone()
-        # Documents have attributes and they're saved under the "document"
-        # namespace so we need to split it before actually comparing.
-        media_type = media_row[3].split('.')
-        media_type, media_subtype = media_type[0], media_type[-1]
-        if media_type not in ('photo', 'document'):
-            return  # Only photos or documents are actually downloadable
-
-        formatter = defaultdict(
-            str,
-            context_id=context_id,
-            sender_id=sender_id,
-            type=media_subtype or 'unknown',
-            name=self._get_name(context_id) or 'unknown',
-            sender_name=self._get_name(sender_id) or 'unknown'
+        if media_row is None:
+            __log__.warning('Skipping media %d, which is not saved', media_id)
+            return
+        filename = self.media_paths.get_path(
+            media_id, media_row[3], media_row[5], media_row[4],
+            context_id, sender_id, date
         )
-
-        # Documents might have a filename, which may have an extension. Use
-        # the extension from the filename if any (more accurate than mime).
-        ext = None
-        filename = media_row[5]
-        if filename:
-            filename, ext = os.path.splitext(filename)
-        else:
-            # No filename at all, set a sensible default filename
-            filename = date.strftime(
-                '{}_%Y-%m-%d_%H-%M-%S'.format(formatter['type'])
-            )
-
-        # The saved media didn't have a filename and we set our own.
-        # Detect a sensible extension from the known mimetype.
-        if not ext:
-            ext = export_utils.get_extension(media_row[4])
-
-        # Apply the date to the user format string and then replace the map
-        formatter['filename'] = filename
-        filename = date.strftime(self.media_fmt).format_map(formatter)
-        filename += '.{}{}'.format(media_id, ext)
+        if filename is None:
+            return  # Only photos or documents are actually downloadable
         if os.path.isfile(filename):
             __log__.debug('Skipping already-existing file %s', filename)
             return
 
         __log__.debug('Downloading to %s', filename)
         os.makedirs(os.path.dirname(filename), exist_ok=True)
+        media_type = media_row[3].split('.')[0]
         if media_type == 'document':
             location = types.InputDocumentFileLocation(
                 id=media_row[0],
@@ -301,43 +333,90 @@ class Downloader:
             progress_callback=progress
         )
         self._incomplete_download = None
+        METRICS.inc('downloads_total', type=media_type)
+        METRICS.inc('downloaded_bytes_total', os.path.getsize(filename),
+                    type=media_type)
 
     async def _media_consumer(self, queue, bar):
+        TRACER.set_track('media consumer')
         while self._running:
             start = time.time()
             media_id, context_id, sender_id, date = await queue.get()
-            await self._download_media(media_id, context_id, sender_id,
-                                       datetime.datetime.utcfromtimestamp(date),
-                                       bar)
+            with TRACER.span('download_media', media_id=media_id):
+                await self._download_media(
+                    media_id, context_id, sender_id,
+                    datetime.datetime.utcfromtimestamp(date), bar
+                )
             queue.task_done()
-            await asyncio.sleep(max(MEDIA_DELAY - (time.time() - start), 0),
-                                loop=self.loop)
+            await self._sleep(MEDIA_DELAY - (time.time() - start), 'media')
 
     async def _user_consumer(self, queue, bar):
+        TRACER.set_track('user consumer')
         while self._running:
             start = time.time()
-            self._dump_full_entity(await self.client(
-                functions.users.GetFullUserRequest(await queue.get())
-            ))
-            queue.task_done()
-            bar.update(1)
-            await asyncio.sleep(max(USER_FULL_DELAY - (time.time() - start), 0),
-                                loop=self.loop)
+            user = await queue.get()
+            with TRACER.span('full_user'):
+                self._dump_full_entity(await self._invoke(
+                    functions.users.GetFullUserRequest(user)
+                ))
+                queue.task_done()
+                bar.update(1)
+            await self._sleep(USER_FULL_DELAY - (time.time() - start), 'user')
 
     async def _chat_consumer(self, queue, bar):
+        TRACER.set_track('chat consumer')
         while self._running:
             start = time.time()
             chat = await queue.get()
-            if isinstance(chat, (types.Chat, types.PeerChat)):
-                self._dump_full_entity(chat)
-            else:  # isinstance(chat, (types.Channel, types.PeerChannel)):
-                self._dump_full_entity(await self.client(
-                    functions.channels.GetFullChannelRequest(chat)
-                ))
-            queue.task_done()
-            bar.update(1)
-            await asyncio.sleep(max(CHAT_FULL_DELAY - (time.time() - start), 0),
-                                loop=self.loop)
+            with TRACER.span('full_chat'):
+                if isinstance(chat, (types.Chat, types.PeerChat)):
+                    self._dump_full_entity(chat)
+                else:  # isinstance(chat, (types.Channel, types.PeerChannel)):
+                    self._dump_full_entity(await self._invoke(
+                        functions.channels.GetFullChannelRequest(chat)
+                    ))
+                queue.task_done()
+                bar.update(1)
+            await self._sleep(CHAT_FULL_DELAY - (time.time() - start), 'chat')
+
+    def _start_consumers(self, ent_bar, med_bar):
+        """
+        Starts the coroutines consuming the entity and media queues, and
+        returns their tasks so that they can be cancelled once done.
+        """
+        return [
+            asyncio.ensure_future(self._user_consumer(self._user_queue,
+                                                      ent_bar), loop=self.loop),
+            asyncio.ensure_future(self._chat_consumer(self._chat_queue,
+                                                      ent_bar), loop=self.loop),
+            asyncio.ensure_future(self._media_consumer(self._media_queue,
+                                                       med_bar), loop=self.loop)
+        ]
+
+    def _save_queues(self, context_id):
+        """
+        Saves the entities and media left in the queues into the database
+        so that they can be resumed when the given context is dumped again.
+        Entities which came from updates are saved under their own context.
+        """
+        entities = defaultdict(list)
+        for queue in (self._user_queue, self._chat_queue):
+            while not queue.empty():
+                entity = queue.get_nowait()
+                cid = self._live_contexts.get(utils.get_peer_id(entity),
+                                              context_id)
+                if cid is not None:
+                    entities[cid].append(entity)
+        for cid, ents in entities.items():
+            self.dumper.save_resume_entities(cid, ents)
+
+        media = []
+        while not self._media_queue.empty():
+            media.append(self._media_queue.get_nowait())
+        self.dumper.save_resume_media(media)
+
+        if entities or media:
+            self.dumper.commit()
 
     def enqueue_entities(self, entities):
         """
@@ -398,10 +477,19 @@ class Downloader:
         """
         Starts the dump with the given target ID.
         """
-        self._running = True
-        self._incomplete_download = None
         target_in = await self.client.get_input_entity(target_id)
         target = await self.client.get_entity(target_in)
+        with TRACER.dialog(utils.get_peer_id(target),
+                           utils.get_display_name(target)):
+            await self._dump_dialog(target_in, target)
+
+    async def _dump_dialog(self, target_in, target):
+        """
+        Dumps the messages, admin log and participants of the given
+        target and its input version, as well as their entities and media.
+        """
+        self._running = True
+        self._incomplete_download = None
         target_id = utils.get_peer_id(target)
 
         found = self.dumper.get_message_count(target_id)
@@ -415,12 +503,7 @@ class Downloader:
                             total=0, postfix={'chat': chat_name})
         # Divisor is 1000 not 1024 since tqdm puts a K not a Ki
 
-        asyncio.ensure_future(self._user_consumer(self._user_queue, ent_bar),
-                              loop=self.loop)
-        asyncio.ensure_future(self._chat_consumer(self._chat_queue, ent_bar),
-                              loop=self.loop)
-        asyncio.ensure_future(self._media_consumer(self._media_queue, med_bar),
-                              loop=self.loop)
+        consumers = self._start_consumers(ent_bar, med_bar)
 
         self.enqueue_entities(self.dumper.iter_resume_entities(target_id))
         for mid, sender_id, date in self.dumper.iter_resume_media(target_id):
@@ -448,10 +531,13 @@ class Downloader:
             if can_get_participants:
                 try:
                     __log__.info('Getting participants...')
-                    participants = await self.client.get_participants(target_in)
-                    added, removed = self.dumper.dump_participants_delta(
-                        target_id, ids=[x.id for x in participants]
-                    )
+                    METRICS.inc('requests_total', request='get_participants')
+                    with TRACER.span('participants'):
+                        participants = await self.client.get_participants(
+                            target_in)
+                        added, removed = self.dumper.dump_participants_delta(
+                            target_id, ids=[x.id for x in participants]
+                        )
                     __log__.info('Saved %d new members, %d left the chat.',
                                  len(added), len(removed))
                 except ChatAdminRequiredError:
@@ -474,7 +560,7 @@ class Downloader:
                     target_in, q='', min_id=0, max_id=0, limit=1
                 )
                 try:
-                    await self.client(log_req)
+                    await self._invoke(log_req)
                     log_req.limit = 100
                 except ChatAdminRequiredError:
                     log_req = None
@@ -486,20 +572,23 @@ class Downloader:
             # is interlaced as well to dump both at the same time.
             while self._running:
                 start = time.time()
-                history = await self.client(req)
-                # Queue found entities so they can be dumped later
-                self.enqueue_entities(itertools.chain(
-                    history.users, history.chats
-                ))
-                ent_bar.total = len(self._checked_entity_ids)
+                with TRACER.span('fetch', offset_id=req.offset_id):
+                    history = await self._invoke(req)
+                    # Queue found entities so they can be dumped later
+                    self.enqueue_entities(itertools.chain(
+                        history.users, history.chats
+                    ))
 
                 # Dump the messages from this batch
-                self._dump_messages(history.messages, target)
+                with TRACER.span('dump_messages', count=len(history.messages)):
+                    self._dump_messages(history.messages, target)
 
                 # Determine whether to continue dumping or we're done
                 count = len(history.messages)
-                msg_bar.total = getattr(history, 'count', count)
-                msg_bar.update(count)
+                with TRACER.span('progress'):
+                    ent_bar.total = len(self._checked_entity_ids)
+                    msg_bar.total = getattr(history, 'count', count)
+                    msg_bar.update(count)
                 if history.messages:
                     # We may reinsert some we already have (so found > total)
                     found = min(found + len(history.messages), msg_bar.total)
@@ -534,22 +623,21 @@ class Downloader:
 
                 # Interlace with the admin log request if any
                 if log_req:
-                    result = await self.client(log_req)
-                    self.enqueue_entities(itertools.chain(
-                        result.users, result.chats
-                    ))
-                    if result.events:
-                        log_req.max_id = self._dump_admin_log(result.events,
-                                                              target)
-                    else:
-                        log_req = None
+                    with TRACER.span('admin_log'):
+                        result = await self._invoke(log_req)
+                        self.enqueue_entities(itertools.chain(
+                            result.users, result.chats
+                        ))
+                        if result.events:
+                            log_req.max_id = self._dump_admin_log(
+                                result.events, target)
+                        else:
+                            log_req = None
 
                 # We need to sleep for HISTORY_DELAY but we have already spent
                 # some of it invoking (so subtract said delta from the delay).
-                await asyncio.sleep(
-                    max(HISTORY_DELAY - (time.time() - start), 0),
-                    loop=self.loop
-                )
+                await self._sleep(HISTORY_DELAY - (time.time() - start),
+                                  'history')
 
             # Message loop complete, wait for the queues to empty
             msg_bar.n = msg_bar.total
@@ -559,57 +647,97 @@ class Downloader:
             # This loop is specific to the admin log (to finish up)
             while log_req and self._running:
                 start = time.time()
-                result = await self.client(log_req)
-                self.enqueue_entities(itertools.chain(
-                    result.users, result.chats
-                ))
-                if result.events:
-                    log_req.max_id = self._dump_admin_log(result.events,
-                                                          target)
-                    await asyncio.sleep(max(
-                        HISTORY_DELAY - (time.time() - start), 0),
-                        loop=self.loop
-                    )
-                else:
-                    log_req = None
+                with TRACER.span('admin_log'):
+                    result = await self._invoke(log_req)
+                    self.enqueue_entities(itertools.chain(
+                        result.users, result.chats
+                    ))
+                    if result.events:
+                        log_req.max_id = self._dump_admin_log(result.events,
+                                                              target)
+                    else:
+                        log_req = None
+                if log_req:
+                    await self._sleep(HISTORY_DELAY - (time.time() - start),
+                                      'adminlog')
 
             __log__.info(
                 'Done. Retrieving full information about %s missing entities.',
                 self._user_queue.qsize() + self._chat_queue.qsize()
             )
-            await self._user_queue.join()
-            await self._chat_queue.join()
-            await self._media_queue.join()
+            with TRACER.span('wait_queues'):
+                await self._user_queue.join()
+                await self._chat_queue.join()
+                await self._media_queue.join()
         finally:
             self._running = False
+            for consumer in consumers:
+                consumer.cancel()
             ent_bar.n = ent_bar.total
             ent_bar.close()
             med_bar.n = med_bar.total
             med_bar.close()
-            # If the download was interrupted and there are users left in the
-            # queue we want to save them into the database for the next run.
-            entities = []
-            while not self._user_queue.empty():
-                entities.append(self._user_queue.get_nowait())
-            while not self._chat_queue.empty():
-                entities.append(self._chat_queue.get_nowait())
-            if entities:
-                self.dumper.save_resume_entities(target_id, entities)
-
-            # Do the same with the media queue
-            media = []
-            while not self._media_queue.empty():
-                media.append(self._media_queue.get_nowait())
-            self.dumper.save_resume_media(media)
-
-            if entities or media:
-                self.dumper.commit()
+            # If the download was interrupted and there are users or media
+            # left in the queues we want to save them for the next run.
+            self._save_queues(target_id)
 
             # Delete partially-downloaded files
             if (self._incomplete_download is not None
                     and os.path.isfile(self._incomplete_download)):
                 os.remove(self._incomplete_download)
 
+    async def dump_update(self, event):
+        """
+        Event handler to dump the message from a ``NewMessage`` or
+        ``MessageEdited`` event, enqueuing its media and entities to be
+        dumped by the consumers started by `watch`. Edited messages
+        simply replace the version that was previously dumped.
+        """
+        context_id = event.chat_id
+        entities = [x for x in (event.chat, event.sender) if x is not None]
+        for entity in entities:
+            self._live_contexts.setdefault(utils.get_peer_id(entity),
+                                           context_id)
+
+        self.enqueue_entities(entities)
+        self._dump_messages((event.message,), context_id)
+        self.dumper.commit()
+
+    async def watch(self, reconnected=None):
+        """
+        Keeps the consumers running so that the entities and media enqueued
+        by `dump_update` get dumped, until the client is disconnected or the
+        given ``asyncio.Event`` is set (when the client reconnected on its
+        own). Raises ConnectionError if the client couldn't reconnect.
+        """
+        self._running = True
+        self._incomplete_download = None
+        ent_bar = tqdm.tqdm(unit=' entities', desc='entities',
+                            bar_format=BAR_FORMAT)
+        med_bar = tqdm.tqdm(unit='B', desc='media', unit_divisor=1000,
+                            unit_scale=True, bar_format=BAR_FORMAT, total=0)
+        consumers = self._start_consumers(ent_bar, med_bar)
+        waits = [asyncio.ensure_future(self.client.disconnected)]
+        if reconnected is not None:
+            waits.append(asyncio.ensure_future(reconnected.wait()))
+        try:
+            done, _ = await asyncio.wait(
+                waits, return_when=asyncio.FIRST_COMPLETED)
+            for wait in done:
+                wait.result()  # Raises if the connection was lost for good
+        finally:
+            for wait in waits:
+                wait.cancel()
+            self._running = False
+            for consumer in consumers:
+                consumer.cancel()
+            ent_bar.close()
+            med_bar.close()
+            self._save_queues(None)
+            if (self._incomplete_download is not None
+                    and os.path.isfile(self._incomplete_download)):
+                os.remove(self._incomplete_download)
+
     async def download_past_media(self, dumper, target_id):
         """
         Downloads the past media that has already been dumped into the
@@ -14,11 +14,24 @@ from telethon.tl import types
 from telethon.utils import get_peer_id, resolve_id, get_input_peer
 
 from . import utils
+from .metrics import METRICS
+from .tracing import TRACER
 
 logger = logging.getLogger(__name__)
 
 DB_VERSION = 1  # database version
 
+# The index of the ForwardID in the rows of the Message table
+FORWARD_COLUMN = 6
+
+# The full-text search index of the messages, kept up to date by the Dumper
+# if SearchIndex is enabled (see `Dumper.rebuild_search_index`). It keeps
+# the text and the name of the media of every message under its rowid.
+SEARCH_TABLE = 'MessageSearch'
+
+# How many messages are indexed at once when rebuilding the search index
+SEARCH_BATCH_SIZE = 100000
+
 
 class InputFileType(Enum):
     """An enum to specify the type of an InputFile"""
@@ -194,7 +207,7 @@ class Dumper:
                       "PostAuthor TEXT,"
                       "ViewCount INT,"
                       "MediaID INT,"
-                      "Formatting TEXT,"  # e.g. bold, italic, etc.
+                      "Formatting TEXT,"  # bold, links... (see formatting.py)
                       "ServiceAction TEXT,"  # friendly name of action if it is
                       # a MessageService
                       "FOREIGN KEY (ForwardID) REFERENCES Forward(ID),"
@@ -235,6 +248,97 @@ class Dumper:
                       "PRIMARY KEY (MediaID))")
             self.conn.commit()
 
+        # Media without a location is looked up by its content (see
+        # dump_media), and databases made before may not have this yet
+        c.execute("CREATE INDEX IF NOT EXISTS MediaContent "
+                  "ON Media(Type, Name)")
+        self.conn.commit()
+
+        self.search_index = config.getboolean('SearchIndex', False)
+        if self.search_index and not self._create_search_index():
+            self.search_index = False
+
+    def _create_search_index(self, warn=True):
+        """
+        Creates the search index if it doesn't exist yet, returning whether
+        it could be (SQLite may have been compiled without FTS5). Unless
+        warn is False, messages already dumped without it are warned about.
+        """
+        c = self.conn.cursor()
+        c.execute("SELECT name FROM sqlite_master "
+                  "WHERE type='table' AND name=?", (SEARCH_TABLE,))
+        if c.fetchone():
+            return True
+        try:
+            c.execute("CREATE VIRTUAL TABLE {} USING fts5(Text, MediaName, "
+                      "tokenize='unicode61 remove_diacritics 1')"
+                      .format(SEARCH_TABLE))
+        except sqlite3.OperationalError as e:
+            logger.warning('Could not create the search index: %s', e)
+            return False
+        self.conn.commit()
+        if warn and c.execute("SELECT 1 FROM Message LIMIT 1").fetchone():
+            logger.warning('The search index was just created, rebuild it '
+                           'to search the messages dumped before')
+        return True
+
+    def rebuild_search_index(self, batch_size=SEARCH_BATCH_SIZE,
+                             progress=None):
+        """
+        Indexes every message dumped so far again, a batch of them at a
+        time, calling progress(indexed, total) after every batch if given.
+        This is needed if SearchIndex was disabled while dumping.
+        """
+        if not self._create_search_index(warn=False):
+            raise ValueError('This SQLite does not support search indices')
+        c = self.conn.cursor()
+        c.execute("DELETE FROM {}".format(SEARCH_TABLE))
+        last = c.execute("SELECT MAX(rowid) FROM Message").fetchone()[0] or 0
+        for start in range(0, last, batch_size):
+            with TRACER.span('index'):
+                c.execute(
+                    "INSERT INTO {} (rowid, Text, MediaName) "
+                    "SELECT Message.rowid, Message.Message, Media.Name "
+                    "FROM Message LEFT JOIN Media "
+                    "ON Media.ID = Message.MediaID "
+                    "WHERE Message.rowid > ? AND Message.rowid <= ? "
+                    "AND Message.ServiceAction IS NULL "
+                    "AND (Message.Message != '' OR Media.Name IS NOT NULL)"
+                    .format(SEARCH_TABLE), (start, start + batch_size)
+                )
+                self.commit()
+            if progress:
+                progress(min(start + batch_size, last), last)
+
+        c.execute("INSERT INTO {0} ({0}) VALUES ('optimize')"
+                  .format(SEARCH_TABLE))
+        self.commit()
+
+    def _unindex_message(self, message_id, context_id):
+        """
+        Removes the message with the given IDs from the search index, which
+        must be done before it's replaced (and given another rowid).
+        """
+        self.conn.execute(
+            "DELETE FROM {} WHERE rowid = (SELECT rowid FROM Message "
+            "WHERE ID = ? AND ContextID = ?)".format(SEARCH_TABLE),
+            (message_id, context_id)
+        )
+
+    def _index_message(self, rowid, text, media_id):
+        """Adds the message with the given rowid to the search index."""
+        name = None
+        if media_id:
+            name = self.conn.execute(
+                "SELECT Name FROM Media WHERE ID = ?", (media_id,)
+            ).fetchone()
+            name = name and name[0]
+        if text or name:
+            self.conn.execute(
+                "INSERT INTO {} (rowid, Text, MediaName) VALUES (?, ?, ?)"
+                .format(SEARCH_TABLE), (rowid, text, name)
+            )
+
     def _upgrade_database(self, old):
         """
         This method knows how to migrate from old -> DB_VERSION.
@@ -309,6 +413,9 @@ class Dumper:
         if not message.message and message.media:
             message.message = getattr(message.media, 'caption', '')
 
+        with TRACER.span('encode', event=False):
+            formatting = utils.encode_msg_entities(message.entities)
+
         row = (message.id,
                context_id,
                message.date.timestamp(),
@@ -319,13 +426,55 @@ class Dumper:
                message.post_author,
                message.views,
                media_id,
-               utils.encode_msg_entities(message.entities),
+               formatting,
                None)  # No MessageAction
 
         for callback in self._dump_callbacks['message']:
             callback(row)
 
-        return self._insert('Message', row)
+        if self._is_dumped(row):
+            return None
+        if not self.search_index:
+            return self._insert('Message', row)
+
+        with TRACER.span('index', event=False):
+            self._unindex_message(message.id, context_id)
+        rowid = self._insert('Message', row)
+        if rowid is not None:
+            with TRACER.span('index', event=False):
+                self._index_message(rowid, message.message, media_id)
+        return rowid
+
+    def _is_dumped(self, row):
+        """
+        Returns whether the message of the given row of the Message table
+        was already dumped just like that, in which case it's left alone.
+        The newest messages are fetched again every time, and keeping the
+        rowid of those that didn't change lets the formatters tell apart
+        the messages that were dumped or edited since they last ran.
+        """
+        old = self.conn.execute(
+            'SELECT * FROM Message WHERE ID = ? AND ContextID = ?', row[:2]
+        ).fetchone()
+        if old is None:
+            return False
+        for i, (old_value, value) in enumerate(zip(old, row)):
+            if old_value == value:
+                continue
+            if i != FORWARD_COLUMN or old_value is None or value is None:
+                return False
+            # Every dump saves the forward header again with a new ID
+            forwards = {x[0]: x[1:] for x in self.conn.execute(
+                'SELECT * FROM Forward WHERE ID IN (?, ?)', (old_value, value)
+            )}
+            if forwards.get(old_value) != forwards.get(value):
+                return False
+
+        if old[FORWARD_COLUMN] != row[FORWARD_COLUMN]:
+            # Nothing else can refer to the one just saved
+            self.conn.execute('DELETE FROM Forward WHERE ID = ?',
+                              (row[FORWARD_COLUMN],))
+        return True
 
     def dump_message_service(self, message, context_id, media_id):
         """Similar to self.dump_message, but for MessageAction's."""
@@ -333,10 +482,11 @@ class Dumper:
         if not name:
             return
 
-        extra = message.action.to_dict()
-        del extra['_']  # We don't need to store the type, already have name
-        sanitize_dict(extra)
-        extra = json.dumps(extra)
+        with TRACER.span('encode', event=False):
+            extra = message.action.to_dict()
+            del extra['_']  # We don't need to store the type, already have name
+            sanitize_dict(extra)
+            extra = json.dumps(extra)
 
         row = (message.id,
                context_id,
@@ -354,6 +504,10 @@ class Dumper:
         for callback in self._dump_callbacks['message_service']:
             callback(row)
 
+        if self._is_dumped(row):
+            return None
+        if self.search_index:
+            self._unindex_message(message.id, context_id)
         return self._insert('Message', row)
 
     def dump_admin_log_event(self, event, context_id, media_id1, media_id2):
@@ -491,6 +645,9 @@ class Dumper:
                 row = c.fetchone()
             added = ids - last_ids
             removed = last_ids - ids
+            if not added and not removed:
+                # Nothing changed (e.g. dumped again right after a reconnect)
+                return added, removed
 
         row = (context_id,
                round(time.time()),
@@ -501,6 +658,7 @@ class Dumper:
             callback(row)
 
         c.execute("INSERT INTO ChatParticipants VALUES (?, ?, ?, ?)", row)
+        METRICS.inc('rows_total', table='ChatParticipants')
         return added, removed
 
     def dump_media(self, media, media_type=None):
@@ -510,162 +668,47 @@ class Dumper:
         if not media:
             return
 
-        row = {x: None for x in (
-            'name', 'mime_type', 'size', 'thumbnail_id',
-            'local_id', 'volume_id', 'secret'
-        )}
-        row['type'] = media_type
+        row = utils.media_to_row(media, self.dump_media, media_type)
+        if not row['type']:
+            return
+
         row['extra'] = media.to_dict()
         sanitize_dict(row['extra'])
         row['extra'] = json.dumps(row['extra'])
 
-        if isinstance(media, types.MessageMediaContact):
-            row['type'] = 'contact'
-            row['name'] = '{} {}'.format(media.first_name, media.last_name)
-            row['local_id'] = media.user_id
-            try:
-                row['secret'] = int(media.phone_number or '0')
-            except ValueError:
-                row['secret'] = 0
-
-        elif isinstance(media, types.MessageMediaDocument):
-            row['type'] = utils.get_media_type(media)
-            doc = media.document
-            if isinstance(doc, types.Document):
-                row['mime_type'] = doc.mime_type
-                row['size'] = doc.size
-                row['thumbnail_id'] = self.dump_media(doc.thumb)
-                row['local_id'] = doc.id
-                row['volume_id'] = doc.version
-                row['secret'] = doc.access_hash
-                for attr in doc.attributes:
-                    if isinstance(attr, types.DocumentAttributeFilename):
-                        row['name'] = attr.file_name
-
-        elif isinstance(media, types.MessageMediaEmpty):
-            row['type'] = 'empty'
-            return
-
-        elif isinstance(media, types.MessageMediaGame):
-            row['type'] = 'game'
-            game = media.game
-            if isinstance(game, types.Game):
-                row['name'] = game.short_name
-                row['thumbnail_id'] = self.dump_media(game.photo)
-                row['local_id'] = game.id
-                row['secret'] = game.access_hash
-
-        elif isinstance(media, types.MessageMediaGeo):
-            row['type'] = 'geo'
-            geo = media.geo
-            if isinstance(geo, types.GeoPoint):
-                row['name'] = '({}, {})'.format(repr(geo.lat), repr(geo.long))
-
-        elif isinstance(media, types.MessageMediaGeoLive):
-            row['type'] = 'geolive'
-            geo = media.geo
-            if isinstance(geo, types.GeoPoint):
-                row['name'] = '({}, {})'.format(repr(geo.lat), repr(geo.long))
-
-        elif isinstance(media, types.MessageMediaInvoice):
-            row['type'] = 'invoice'
-            row['name'] = media.title
-            row['thumbnail_id'] = self.dump_media(media.photo)
-
-        elif isinstance(media, types.MessageMediaPhoto):
-            row['type'] = 'photo'
-            row['mime_type'] = 'image/jpeg'
-            media = media.photo
-
-        elif isinstance(media, types.MessageMediaUnsupported):
-            row['type'] = 'unsupported'
-            return
-
-        elif isinstance(media, types.MessageMediaVenue):
-            row['type'] = 'venue'
-            row['name'] = '{} - {} ({}, {} {})'.format(
-                media.title, media.address,
-                media.provider, media.venue_id, media.venue_type
-            )
-            geo = media.geo
-            if isinstance(geo, types.GeoPoint):
-                row['name'] += ' at ({}, {})'.format(
-                    repr(geo.lat), repr(geo.long)
-                )
-
-        elif isinstance(media, types.MessageMediaWebPage):
-            row['type'] = 'webpage'
-            web = media.webpage
-            if isinstance(web, types.WebPage):
-                row['name'] = web.title
-                row['thumbnail_id'] = self.dump_media(web.photo, 'thumbnail')
-                row['local_id'] = web.id
-                row['secret'] = web.hash
-
-        if isinstance(media, types.Photo):
-            # Extra fallback cases for common parts
-            row['type'] = 'photo'
-            row['mime_type'] = 'image/jpeg'
-            row['name'] = str(media.date)
-            sizes = [x for x in media.sizes
-                     if isinstance(x, (types.PhotoSize, types.PhotoCachedSize))]
-            if sizes:
-                small = min(sizes, key=lambda s: s.w * s.h)
-                large = max(sizes, key=lambda s: s.w * s.h)
-                media = large
-                if small != large:
-                    row['thumbnail_id'] = self.dump_media(small, 'thumbnail')
-
-        if isinstance(media, (types.PhotoSize,
-                              types.PhotoCachedSize,
-                              types.PhotoSizeEmpty)):
-            row['type'] = 'photo'
-            row['mime_type'] = 'image/jpeg'
-            if isinstance(media, types.PhotoSizeEmpty):
-                row['size'] = 0
-            else:
-                if isinstance(media, types.PhotoSize):
-                    row['size'] = media.size
-                elif isinstance(media, types.PhotoCachedSize):
-                    row['size'] = len(media.bytes)
-                if isinstance(media.location, types.FileLocation):
-                    media = media.location
-
-        if isinstance(media, (types.UserProfilePhoto, types.ChatPhoto)):
-            row['type'] = 'photo'
-            row['mime_type'] = 'image/jpeg'
-            row['thumbnail_id'] = self.dump_media(
-                media.photo_small, 'thumbnail'
-            )
-            media = media.photo_big
+        # We'll say two files are the same if they point to the same
+        # downloadable content (through local_id/volume_id/secret).
 
-        if isinstance(media, types.FileLocation):
-            row['local_id'] = media.local_id
-            row['volume_id'] = media.volume_id
-            row['secret'] = media.secret
-
-        if row['type']:
-            # We'll say two files are the same if they point to the same
-            # downloadable content (through local_id/volume_id/secret).
-
-            for callback in self._dump_callbacks['media']:
-                callback(row)
+        for callback in self._dump_callbacks['media']:
+            callback(row)
 
-            c = self.conn.cursor()
+        c = self.conn.cursor()
+        if None not in (row['local_id'], row['volume_id'], row['secret']):
             c.execute('SELECT ID FROM Media WHERE LocalID = ? '
                       'AND VolumeID = ? AND Secret = ?',
                       (row['local_id'], row['volume_id'], row['secret']))
-            existing_row = c.fetchone()
-            if existing_row:
-                return existing_row[0]
-
-            return self._insert('Media', (
-                None,
-                row['name'], row['mime_type'], row['size'],
-                row['thumbnail_id'], row['type'],
-                row['local_id'], row['volume_id'], row['secret'],
-                row['extra']
-            ))
+        else:
+            # Media that can't be downloaded (geo points, contacts, web
+            # pages...) is the same if everything about it is, so that
+            # dumping it again doesn't give the same message a new one
+            c.execute('SELECT ID FROM Media WHERE Type = ? AND Name IS ? '
+                      'AND MimeType IS ? AND Size IS ? AND ThumbnailID IS ? '
+                      'AND LocalID IS ? AND VolumeID IS ? AND Secret IS ? '
+                      'AND Extra = ? ORDER BY ID LIMIT 1', (
+                          row['type'], row['name'], row['mime_type'],
+                          row['size'], row['thumbnail_id'], row['local_id'],
+                          row['volume_id'], row['secret'], row['extra']))
+        existing_row = c.fetchone()
+        if existing_row:
+            return existing_row[0]
+
+        return self._insert('Media', (
+            None,
+            row['name'], row['mime_type'], row['size'],
+            row['thumbnail_id'], row['type'],
+            row['local_id'], row['volume_id'], row['secret'],
+            row['extra']
+        ))
 
     def dump_forward(self, forward):
         """
@@ -703,6 +746,16 @@ class Dumper:
         ).fetchone()
         return tuple_[0] if tuple_ else 0
 
+    def get_picture_date(self, table, photo_id):
+        """
+        Returns the DateUpdated of the first row of the given table (User,
+        Chat, Channel or Supergroup) with the given picture, or None. The
+        picture is saved with this date (which the manifest expects).
+        """
+        return self.conn.execute(
+            "SELECT MIN(DateUpdated) FROM {} WHERE PictureID = ?"
+            .format(table), (photo_id,)).fetchone()[0]
+
     def get_resume(self, context_id):
         """
         For the given context ID, return a tuple consisting of the offset
@@ -830,8 +883,10 @@ class Dumper:
         """
         try:
             fmt = ','.join('?' * len(values))
-            c = self.conn.execute("INSERT OR REPLACE INTO {} VALUES ({})"
-                                  .format(into, fmt), values)
+            with TRACER.span('insert', event=False):
+                c = self.conn.execute("INSERT OR REPLACE INTO {} VALUES ({})"
+                                      .format(into, fmt), values)
+            METRICS.inc('rows_total', table=into)
             return c.lastrowid
         except sqlite3.IntegrityError as error:
             self.conn.rollback()
@@ -842,4 +897,5 @@ class Dumper:
         """
         Commits the changes made to the database to persist on disk.
         """
-        self.conn.commit()
+        with TRACER.span('commit'), METRICS.time('commit_seconds'):
+            self.conn.commit()
@@ -1,12 +1,19 @@
 """A class to iterate through dialogs and dump them, or save past media"""
 
+import asyncio
 import logging
 import re
 
 from async_generator import yield_, async_generator
-from telethon import utils
+from telethon import events, utils
 
 from .downloader import Downloader
+from .planner import Planner
+
+# Seconds to wait before connecting again once the connection was lost for
+# good while watching, doubled every time it fails up to the maximum
+RECONNECT_DELAY = 5
+MAX_RECONNECT_DELAY = 300
 
 
 @async_generator
@@ -61,26 +68,123 @@ class Exporter:
         await self.client.disconnect()
         self.dumper.conn.close()
 
-    async def start(self):
-        """Perform a dump of the dialogs we've been told to act on"""
-        self.logger.info("Saving to %s", self.dumper.config['OutputDirectory'])
-        self.dumper.check_self_user((await self.client.get_me(input_peer=True)).user_id)
+    @async_generator
+    async def _iter_targets(self):
+        """Yields the entities of the dialogs we've been told to act on"""
         if 'Whitelist' in self.dumper.config:
             # Only whitelist, don't even get the dialogs
             async for entity in get_entities_iter('whitelist',
                                                   self.dumper.config['Whitelist'],
                                                   self.client):
-                await self.downloader.start(entity)
+                await yield_(entity)
         elif 'Blacklist' in self.dumper.config:
             # May be blacklist, so save the IDs on who to avoid
             async for entity in get_entities_iter('blacklist',
                                                   self.dumper.config['Blacklist'],
                                                   self.client):
-                await self.downloader.start(entity)
+                await yield_(entity)
         else:
             # Neither blacklist nor whitelist - get all
             for dialog in await self.client.get_dialogs(limit=None):
-                await self.downloader.start(dialog.entity)
+                await yield_(dialog.entity)
+
+    async def start(self):
+        """Perform a dump of the dialogs we've been told to act on"""
+        self.logger.info("Saving to %s", self.dumper.config['OutputDirectory'])
+        self.dumper.check_self_user((await self.client.get_me(input_peer=True)).user_id)
+        async for entity in self._iter_targets():
+            await self.downloader.start(entity)
+
+    async def plan(self):
+        """
+        Estimate the work needed to dump the dialogs we've been told to act
+        on without dumping them, returning a list of ``DialogPlan``.
+        """
+        planner = Planner(self.client, self.dumper, self.downloader)
+        plans = []
+        async for entity in self._iter_targets():
+            plans.append(await planner.plan(entity))
+        return plans
+
+    async def _get_watched_chats(self):
+        """
+        Returns the ``(chats, blacklist_chats)`` parameters for the event
+        builders, so that only the dialogs we've been told to act on are
+        watched for updates.
+        """
+        chats = []
+        if 'Whitelist' in self.dumper.config:
+            async for entity in entities_from_str(
+                    self.client.get_input_entity,
+                    self.dumper.config['Whitelist']):
+                chats.append(entity)
+            return chats, False
+        elif 'Blacklist' in self.dumper.config:
+            async for eid in entities_from_str(
+                    self.client.get_peer_id, self.dumper.config['Blacklist']):
+                chats.append(eid)
+            return chats, True
+        return None, False
+
+    def _on_reconnect(self, callback):
+        """
+        Makes callback() be called every time the client reconnects on its
+        own, which ``client.disconnected`` doesn't tell about (it's only
+        done once the client gives up). Telethon only has such a callback
+        for itself, so the one its sender has is chained.
+        """
+        sender = getattr(self.client, '_sender', None)
+        if sender is None or not hasattr(sender, '_auto_reconnect_callback'):
+            self.logger.warning("Can't tell when the client reconnects, "
+                                "so missed messages are only dumped after "
+                                "it's disconnected")
+            return
+
+        original = sender._auto_reconnect_callback
+
+        async def reconnected():
+            if original:
+                await original()
+            callback()
+
+        sender._auto_reconnect_callback = reconnected
+
+    async def watch(self):
+        """
+        Perform a dump of the dialogs we've been told to act on, and then
+        keep dumping new and edited messages as their updates arrive.
+
+        Every time the client reconnects, all the dialogs are dumped again
+        first to catch up with whatever was missed while offline. If the
+        connection is lost for good, connecting is retried after a delay
+        that doubles every time it fails, up to `MAX_RECONNECT_DELAY`.
+        """
+        chats, blacklist = await self._get_watched_chats()
+        for builder in (events.NewMessage, events.MessageEdited):
+            self.client.add_event_handler(
+                self.downloader.dump_update,
+                builder(chats=chats, blacklist_chats=blacklist)
+            )
+
+        reconnected = asyncio.Event()
+        self._on_reconnect(reconnected.set)
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                if not self.client.is_connected():
+                    await self.client.connect()
+                # Anything missed while dumping will be dumped again
+                reconnected.clear()
+                await self.start()
+                delay = RECONNECT_DELAY
+                self.logger.info("Caught up, watching for new messages")
+                await self.downloader.watch(reconnected)
+                self.logger.info("Reconnected, dumping again to catch up")
+            except ConnectionError as e:
+                self.logger.warning("Connection lost (%r), connecting again "
+                                    "in %s seconds", e, delay)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
 
     async def download_past_media(self):
         """
@@ -89,20 +193,5 @@ class Exporter:
         """
         self.logger.info("Saving to %s", self.dumper.config['OutputDirectory'])
         self.dumper.check_self_user((await self.client.get_me(input_peer=True)).user_id)
-
-        if 'Whitelist' in self.dumper.config:
-            # Only whitelist, don't even get the dialogs
-            async for entity in get_entities_iter('whitelist',
-                                                  self.dumper.config['Whitelist'],
-                                                  self.client):
-                await self.downloader.download_past_media(self.dumper, entity)
-        elif 'Blacklist' in self.dumper.config:
-            # May be blacklist, so save the IDs on who to avoid
-            async for entity in get_entities_iter('blacklist',
-                                                  self.dumper.config['Blacklist'],
-                                                  self.client):
-                await self.downloader.download_past_media(self.dumper, entity)
-        else:
-            # Neither blacklist nor whitelist - get all
-            for dialog in await self.client.get_dialogs(limit=None):
-                await self.downloader.download_past_media(self.dumper, dialog.entity)
+        async for entity in self._iter_targets():
+            await self.downloader.download_past_media(self.dumper, entity)
@@ -5,6 +5,10 @@ from .baseformatter import BaseFormatter
 from .textformatter import TextFormatter
 from .htmlformatter import HtmlFormatter
 from .nlpformatter import NlpFormatter
+from .jsonlformatter import JsonlFormatter
+from .columnformatter import ColumnFormatter
+from .statsformatter import StatsFormatter
+from .manifestformatter import ManifestFormatter
 
 
 # Create a map between the name of available formatter and their classes
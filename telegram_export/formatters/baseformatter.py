@@ -5,20 +5,48 @@ import math
 import sqlite3
 import sys
 from pathlib import Path
-from collections import namedtuple
+from collections import OrderedDict, defaultdict, namedtuple
 from abc import abstractmethod
-from io import TextIOWrapper
 
 import os
-from telethon import utils
-from telethon.tl import types
+
+from .checkpoints import Checkpoint, CheckpointStore, filters_digest, \
+    row_digest, table_state
+from .entitycache import EntityCache
+from .output import compression_extension, open_output
+from .reader import connect_reader
+# The entities of the messages are decoded there, also needed by the Dumper
+from ..formatting import MessageEntity, decode_formatting, \
+    decode_formatting_many  # noqa
+from ..mediapath import MEDIA_FMT, MediaPaths
+from ..tracing import TRACER
+
+# The kinds of peer an ID may belong to, as returned by ``resolve_id``.
+# These stand for telethon's Peer types, which are not used here so that
+# formatting an export doesn't have to pay the cost of importing telethon.
+PEER_USER, PEER_CHAT, PEER_CHANNEL = 'user', 'chat', 'channel'
+
+# How many messages are fetched (and their senders and replies) at once
+PAGE_SIZE = 1000
+
+# Older SQLite versions don't allow more than 999 parameters per query
+MAX_PARAMS = 500
+
+MESSAGE_COLUMNS = (
+    'ID, ContextID, Date, FromID, Message, ReplyMessageID, ForwardID, '
+    'PostAuthor, ViewCount, MediaID, Formatting, ServiceAction'
+)
+
 
 Message = namedtuple('Message', (
     'id', 'context_id', 'date', 'from_id', 'text', 'reply_message_id',
-    'forward_id', 'post_author', 'view_count', 'media_id', 'formatting', 'out',
+    'forward_id', 'post_author', 'view_count', 'media_id', 'formatting',
+    'entities',  # The formatting decoded into a list of MessageEntity
+    'out',
     'service_action', 'reply_message',  # An attribute that may be None if
     # there was no reply, a Message namedtuple if there was a reply, or () if
-    # there was a reply but we don't have it in the database.
+    # there was a reply but we don't have it in the database. It is also None
+    # for replies nested deeper than the formatter's reply_depth.
     'context', # A User, Channel, Supergroup, or Chat
     'from_user', # A User or None if a channel message
 ))
@@ -47,15 +75,117 @@ Media = namedtuple('Media', (
     'volume_id', 'secret', 'extra'
 ))
 
+Forward = namedtuple('Forward', (
+    'id', 'original_date', 'from_id', 'channel_post', 'post_author'
+))
+
+MEDIA_COLUMNS = ('ID, Name, MimeType, Size, ThumbnailID, Type, LocalID, '
+                 'VolumeID, Secret, Extra')
+
+FORWARD_COLUMNS = 'ID, OriginalDate, FromID, ChannelPost, PostAuthor'
+
+# The full-text search index of the Dumper (see its SearchIndex option)
+SEARCH_TABLE = 'MessageSearch'
+
+# A result of `BaseFormatter.search`, where a lower rank is a better match
+# and the snippet is the part of the text matched, with it in [brackets].
+SearchHit = namedtuple('SearchHit', ('message', 'rank', 'snippet'))
+
+
+# The columns of the tables with the versions of entities saved over time,
+# in the order of the fields of their namedtuple.
+ENTITY_COLUMNS = {
+    'User': 'ID, DateUpdated, FirstName, LastName, Username, Phone, Bio, '
+            'Bot, CommonChatsCount, PictureID',
+    'Channel': 'ID, DateUpdated, About, Title, Username, PictureID, '
+               'PinMessageID',
+    'Supergroup': 'ID, DateUpdated, About, Title, Username, PictureID, '
+                  'PinMessageID',
+    'Chat': 'ID, DateUpdated, Title, MigratedToID, PictureID'
+}
+
+ENTITY_TUPLES = {
+    'User': User,
+    'Channel': Channel,
+    'Supergroup': Supergroup,
+    'Chat': Chat
+}
+
+# How many versions of entities each formatter keeps cached by default
+ENTITY_CACHE_SIZE = 100000
+
+# How many messages each formatter keeps cached to resolve replies
+MESSAGE_CACHE_SIZE = 10000
+
+# How many nested replies are resolved by default (a reply to a reply...)
+REPLY_DEPTH = 1
+
+
+def resolve_id(marked_id):
+    """
+    Given a Bot API style marked ID, return a tuple with the real ID and
+    its kind (one of the ``PEER_*`` values). See ``telethon.utils``.
+    """
+    if marked_id >= 0:
+        return marked_id, PEER_USER
+    # Some chat IDs are 10000xyz, which look like a channel once marked, so
+    # there must be no more zeros after the "-100" for it to be a channel.
+    marked = str(marked_id)
+    if marked.startswith('-100') and marked[4:5] not in ('', '0'):
+        return int(marked[4:]), PEER_CHANNEL
+    return -marked_id, PEER_CHAT
+
 
 class BaseFormatter:
     """
     A class to extract data from a given telegram-export database in the form
     of named tuples.
     """
-    def __init__(self, db):
+    # Whether the output of formatting a context can be continued with the
+    # output of newer messages, so that `format` can resume from checkpoints
+    appendable = False
+
+    # Whether formatting a context writes a directory of files inside the
+    # directory given rather than a single file (so it can only be given
+    # directories, and `format` is all there is to it, without `_format`)
+    writes_directory = False
+
+    # Whether `format_all` formats all the contexts in a single pass over
+    # the database instead of one after another (so it's not worth using
+    # several processes, one per context, for them)
+    single_pass = False
+
+    def __init__(self, db, cache_size=ENTITY_CACHE_SIZE,
+                 reply_depth=REPLY_DEPTH, checkpoints=None,
+                 media_fmt=MEDIA_FMT, media_root=None, immutable=False):
+        """
+        Db should be the path to an export database or a connection to it.
+        Paths are opened with `connect_reader`, as immutable if it's set,
+        while connections are used as they are (so they may be written to).
+        Up to cache_size versions of users, chats and channels are kept in
+        memory, which should be cleared with `invalidate_cache` if the
+        database is being modified while formatting.
+
+        The reply_message of messages is resolved up to reply_depth times
+        (so 1 means only the message replied to, without its own reply),
+        or for the entire reply chain if it is None.
+
+        If checkpoints is given (the path to a `CheckpointStore` or one),
+        formatting into files only appends the messages dumped since the
+        last time, if the formatter is `appendable`.
+
+        The media is found where the downloader would save it, that is,
+        media_fmt (as the MediaFilenameFmt in the config) inside media_root
+        (by default, the directory the database is in).
+        """
+        self.reply_depth = reply_depth
+        if isinstance(checkpoints, (str, Path)):
+            checkpoints = CheckpointStore(str(checkpoints))
+        self.checkpoints = checkpoints
+        self._entity_cache = EntityCache(cache_size)
+        self._message_cache = OrderedDict()  # {(key, depth): Message}
         if isinstance(db, str):
-            self.dbconn = sqlite3.connect('file:{}?mode=ro'.format(db), uri=True)
+            self.dbconn = connect_reader(db, immutable=immutable)
         elif isinstance(db, sqlite3.Connection):
             self.dbconn = db
         else:
@@ -64,6 +194,13 @@ class BaseFormatter:
         self.our_userid = self.dbconn.execute(
             "SELECT UserID FROM SelfInformation").fetchone()[0]
 
+        if media_root is None:
+            media_root = os.path.dirname(os.path.abspath(db)) \
+                if isinstance(db, str) else '.'
+        self.media_root = media_root
+        self.media_paths = MediaPaths(media_fmt, self.get_display_name,
+                                      media_root)
+
     @staticmethod
     @abstractmethod
     def name():
@@ -76,16 +213,16 @@ class BaseFormatter:
     @staticmethod
     def ensure_id_marked(eid, etype):
         """
-        Given an entity ID and type (PeerUser, PeerChat, PeerChannel), return
-        the marked ID regardless of whether the ID is already marked.
+        Given an entity ID and type (PEER_USER, PEER_CHAT, PEER_CHANNEL),
+        return the marked ID regardless of whether the ID is already marked.
         """
-        if etype == types.PeerUser:
+        if etype == PEER_USER:
             return eid
-        if etype == types.PeerChat:
+        if etype == PEER_CHAT:
             if eid < 0:
                 return eid
             return -eid
-        if etype == types.PeerChannel:
+        if etype == PEER_CHANNEL:
             if str(eid).startswith('-100'):
                 return eid
             # Append -100 at start. See telethon/utils.py get_peer_id.
@@ -123,7 +260,7 @@ class BaseFormatter:
     @staticmethod
     def get_timestamp(date):
         """Get a unix timestamp from an int, datetime, or date"""
-        if date is None or isinstance(date, int):
+        if date is None or isinstance(date, (int, float)):
             return date
         if isinstance(date, datetime.datetime):
             return date.timestamp()
@@ -150,83 +287,215 @@ class BaseFormatter:
             return ' WHERE ' + ' AND '.join(query), tuple(param)
         return ' ', ()
 
-    @classmethod
-    def _fetch_at_date(cls, cur, query, eid, at_date):
+    def _load_versions(self, table, eids):
         """
-        Helper method around the common operation to fetch a type by its ID
-        and a "DateUpdated" parameter.
+        Returns the ``(dates, versions)`` of every entity with the given IDs
+        saved in the given table, as a dictionary. Those not in the cache
+        are loaded with a single query (for every few hundred of them).
         """
-        where, query_params = cls._build_query(
-            ('ID = ?', eid),
-            ('DateUpdated <= ?', at_date)
-        )
-        # Find the newest dump before the specified date
-        cur.execute('{} {} ORDER BY DateUpdated DESC'
-                    .format(query, where), query_params)
-        row = cur.fetchone()
-        if row:
-            return row
-        # If it wasn't found in a dump from before the specified date, find the
-        # first time it was dumped after that date.
-        where, query_params = cls._build_query(
-            ('ID = ?', eid),
-            ('DateUpdated > ?', at_date)
-        )
-        cur.execute('{} {} ORDER BY DateUpdated ASC'
-                    .format(query, where), query_params)
-        return cur.fetchone()
+        cache = self._entity_cache
+        found = {}
+        missing = []
+        for eid in eids:
+            entry = cache.get((table, eid))
+            if entry is None:
+                missing.append(eid)
+            else:
+                found[eid] = entry
+
+        cls = ENTITY_TUPLES[table]
+        cur = self.dbconn.cursor()
+        for i in range(0, len(missing), MAX_PARAMS):
+            chunk = missing[i:i + MAX_PARAMS]
+            loaded = {eid: ([], []) for eid in chunk}
+            cur.execute(
+                "SELECT {} FROM {} WHERE ID IN ({}) ORDER BY DateUpdated ASC"
+                .format(ENTITY_COLUMNS[table], table,
+                        ','.join('?' * len(chunk))), chunk
+            )
+            for row in cur:
+                dates, versions = loaded[row[0]]
+                dates.append(row[1])
+                versions.append(cls(row[0], datetime.datetime.fromtimestamp(
+                    row[1]), *row[2:]))
+            for eid, (dates, versions) in loaded.items():
+                cache.put((table, eid), dates, versions)
+            found.update(loaded)
+        return found
+
+    def _get_at_date(self, table, eid, at_date):
+        """
+        Returns the version of the entity with the given ID saved in the
+        table at the given date (the newest saved before it, or else the
+        first after it), or the newest if at_date is None.
+        """
+        dates, versions = self._load_versions(table, (eid,))[eid]
+        return EntityCache.at_date(dates, versions, at_date)
+
+    def invalidate_cache(self, eid=None):
+        """
+        Forgets the cached versions of the entity with the given marked ID,
+        or of every entity if None, so they are loaded again when needed.
+        """
+        self._message_cache.clear()  # They contain the old versions
+        self.media_paths.forget()
+        if eid is None:
+            self._entity_cache.invalidate()
+        else:
+            for table in ENTITY_COLUMNS:
+                self._entity_cache.invalidate((table, eid))
 
-    def format(self, target, file=None, *args, **kwargs):
+    def format(self, target, file=None, *args, compression=None, **kwargs):
         """
         The public method to format target contexts and output them to 'file'.
-        Target should be an individual Context ID. File can be a filename or
-        file-like object. If it is falsey, it will be interpreted as stdout.
+        Target should be an individual Context ID. File can be a filename,
+        directory, socket or any object with a ``write`` method (accepting
+        text or bytes). If it is falsey, it will be interpreted as stdout.
+
+        The output is compressed with the given compression (see `output`),
+        which for filenames is guessed from their extension. Files passed
+        in are flushed but left open.
+
+        When formatting into a filename with checkpoints, only the messages
+        newer than those formatted last time are appended to it, unless the
+        file or older messages changed since then (see `checkpoints`).
         """
         if not file:
             file = sys.stdout
-        elif isinstance(file, (str, Path)):
-            if os.path.isdir(file):
-                file = os.path.join(file, str(target))
-            file = open(file, 'w')
-        elif not isinstance(file, TextIOWrapper):  # Is there a better way?
-            raise TypeError(
-                "Supplied file {} could not be interpreted as a file"
-                .format(file)
-            )
+        elif isinstance(file, (str, Path)) and os.path.isdir(file):
+            file = os.path.join(
+                file, str(target) + compression_extension(compression))
 
-        with file:
-            if isinstance(target, int):
-                return self._format(target, file, *args, **kwargs)
-            if isinstance(target, (User, Chat, Channel, Supergroup)):
-                return self._format(target.id, file, *args, **kwargs)
-
-        raise TypeError("target should be a context ID or context namedtuple")
+        if isinstance(target, (User, Chat, Channel, Supergroup)):
+            target = target.id
+        if not isinstance(target, int):
+            raise TypeError(
+                "target should be a context ID or context namedtuple")
+
+        if not (self.checkpoints and self.appendable
+                and isinstance(file, (str, Path))):
+            with open_output(file, compression) as output, \
+                    TRACER.dialog(target), \
+                    TRACER.span('format', formatter=self.name()):
+                return self._format(target, output, *args, **kwargs)
+
+        path = os.path.abspath(str(file))
+        max_rowid, digest = table_state(self.dbconn)
+        checkpoint = self.checkpoints.get(self.name(), target)
+        if checkpoint and (checkpoint.max_rowid, checkpoint.digest) \
+                != (max_rowid, digest):
+            # The database changed since, so what's cached may be outdated
+            self.invalidate_cache()
+        filters = filters_digest(args, kwargs)
+        if not self._can_resume(target, path, checkpoint, filters):
+            checkpoint = None
+        with open_output(path, compression,
+                         append=checkpoint is not None) as output, \
+                TRACER.dialog(target), \
+                TRACER.span('format', formatter=self.name(),
+                            resumed=checkpoint is not None):
+            result = self._format(target, output, *args,
+                                  checkpoint=checkpoint, **kwargs)
+
+        # Anything dumped while formatting will be newer than max_rowid
+        # and not newer than this date, so it will be formatted again.
+        last = self.dbconn.execute(
+            'SELECT ID, MAX(Date) FROM Message WHERE rowid > ? '
+            'AND ContextID = ?',
+            (checkpoint.max_rowid if checkpoint else 0, target)
+        ).fetchone()
+        if last[1] is None and checkpoint:
+            last = checkpoint.message_id, checkpoint.date
+        self.checkpoints.put(Checkpoint(
+            self.name(), target, path, last[0], last[1], max_rowid, digest,
+            os.path.getsize(path), filters
+        ))
+        return result
+
+    def _can_resume(self, context_id, path, checkpoint, filters=None):
+        """
+        Returns whether the messages of the given context newer than the
+        `Checkpoint` saved when it was last formatted into the file at path
+        can be appended to it. They can't if there is none, if the file is
+        missing or changed, if it was formatted with other filters (their
+        `filters_digest`), or if any message as old as those formatted
+        into it was dumped or edited since.
+
+        If they can, the messages to append are those dumped since, and the
+        newer messages may be fetched with ``min_rowid=checkpoint.max_rowid``
+        which only has to look at those.
+        """
+        if not checkpoint or checkpoint.date is None \
+                or checkpoint.filters != filters \
+                or checkpoint.path != path or not os.path.isfile(path) \
+                or os.path.getsize(path) != checkpoint.offset:
+            return False
+
+        # The last message might have been replaced keeping its rowid
+        row = self.dbconn.execute(
+            'SELECT * FROM Message WHERE rowid = ?', (checkpoint.max_rowid,)
+        ).fetchone()
+        if row and row_digest(row) != checkpoint.digest \
+                and row[1] == context_id and row[2] <= checkpoint.date:
+            return False
+
+        oldest = self.dbconn.execute(
+            'SELECT MIN(Date) FROM Message WHERE rowid > ? AND ContextID = ?',
+            (checkpoint.max_rowid, context_id)
+        ).fetchone()[0]
+        return oldest is None or oldest > checkpoint.date
 
     @abstractmethod
     def _format(self, context_id, file, *args, **kwargs):
         """
         An abstract method that should be implemented by formatters
         Context ID will always be a Bot API style ID. File will always be
-        something like a file object or sys.stdout, suitable for usage with
-        print(file=file).
+        an `output.OutputWriter`, which buffers the text written into it,
+        so formatters should write (or ``writelines``) whole strings into
+        it rather than printing them one by one.
+
+        Formatters which are `appendable` also get a checkpoint, and if it
+        is not None, should only write the messages newer than it (as if
+        they were continuing the output of the messages before), which are
+        those after its date and ``max_rowid`` (see `_can_resume`).
         """
         # TODO provide a way to format many targets into one directory with one
         # method, and a format syntax to specify the name scheme of the output files.
         pass
 
+    def format_all(self, directory, context_ids=None, compression=None):
+        """
+        Formats the given contexts (or all of them) into the given
+        directory one after another, and then their index (if any).
+        """
+        for cid in self.iter_context_ids() if context_ids is None \
+                else context_ids:
+            self.format(cid, directory, compression=compression)
+        self.format_index(directory, context_ids, compression=compression)
+
+    def format_index(self, directory, context_ids=None, compression=None):
+        """
+        Called once the given contexts (or all of them) have been formatted
+        into the given directory, for formatters which write an index of
+        all of them. Does nothing by default.
+        """
+
     def get_messages_from_context(self, context_id, start_date=None, end_date=None,
                                   from_user_id=None, order='DESC',
-                                  include_service=True):
+                                  include_service=True, min_rowid=None):
         """
         Yield Messages from a context. Start and end date should be UTC timestamps
         or datetime objects. Note that Channels will never yield any messages if
         from_user_id is set, as there is no FromID for Channel messages. Order
         should be ASC or DESC. Note that unlike the other methods, context_id
         *must* be in the Bot API format where Channel/Supergroup IDs start with
-        -100 and old-style Chat IDs start with -.
+        -100 and old-style Chat IDs start with -. If min_rowid is set, only
+        the messages dumped (or changed) after the row with that rowid are
+        yielded, which only has to look at those rows.
         """
         start_date, end_date = self.get_timestamp(start_date), self.get_timestamp(end_date)
         where, params = self._build_query(
+            ('rowid > ?', min_rowid),
             ('ContextID = ?', context_id),
             ('Date > ?', start_date),
             ('Date < ?', end_date),
@@ -236,75 +505,201 @@ class BaseFormatter:
         cur = self.dbconn.cursor()
         exclude_service = '' if include_service else ' AND ServiceAction is null'
         cur.execute(
-            "SELECT ID, ContextID, Date, FromID, Message, ReplyMessageID, "
-            "ForwardID, PostAuthor, ViewCount, MediaID, Formatting, ServiceAction"
-            " FROM Message {}{} ORDER BY Date {}".format(where, exclude_service,
-                                                         order.upper()),
+            "SELECT {} FROM Message {}{} ORDER BY Date {}".format(
+                MESSAGE_COLUMNS, where, exclude_service, order.upper()),
             params
         )
-        row = cur.fetchone()
-        while row:
-            yield self._message_from_row(row)
-            row = cur.fetchone()
-            if not row:
-                return
+        rows = cur.fetchmany(PAGE_SIZE)
+        while rows:
+            with TRACER.span('hydrate', event=False):
+                messages = self._messages_from_rows(rows)
+            yield from messages
+            rows = cur.fetchmany(PAGE_SIZE)
 
     def _message_from_row(self, row):
         """
         Take a row (ID, ContextID, Date, FromID, Text, ReplyMessageID,
         ForwardID, PostAuthor, ViewCount, MediaID, Formatting, ServiceAction)
-        and add the values for out, reply_message, context, and from_user. Also
-        replace date UTC timestamp with date UTC datetime. Return a Message.
-        Something slightly worrying: if there is a chain of many replies, this
-        is quite inefficient. If the chain is > 1000, possible recursion error.
+        and add the values for entities, out, reply_message, context, and
+        from_user. Also replace date UTC timestamp with date UTC datetime.
+        Return a Message.
+        """
+        return self._messages_from_rows([row])[0]
+
+    def _messages_from_rows(self, rows):
+        """
+        Like `_message_from_row` but for many rows at once. The replies (and
+        the replies of those, down to reply_depth), senders and contexts of
+        all the rows are fetched with a few queries for all of them, rather
+        than a few for every single message, and their formatting is decoded
+        in one go (see `decode_formatting_many`).
+
+        The resolved messages are cached, so that replies to the messages
+        seen recently (e.g. in the previous page) aren't fetched again.
         """
         # TODO forwards, media
-        out = row[3] == self.our_userid
-        if row[5]:  # ReplyMessageID
-            reply = self.get_message_by_id(row[1], row[5])
-        else:
-            reply = None
-        context = self.get_entity(row[1])
-        if row[3]:  # FromID
-            from_user = self.get_user(row[3])
-        else:
-            from_user = None
-        date = datetime.datetime.fromtimestamp(row[2])
-
-        return Message(row[0], # ID
-                       row[1], # ContextID
-                       date,
-                       row[3],  # FromID
-                       row[4],  # Text
-                       row[5],  # ReplyMessageID
-                       row[6],  # ForwardID
-                       row[7],  # PostAuthor
-                       row[8],  # ViewCount
-                       row[9],  # MediaID
-                       row[10], # Formatting
-                       out,
-                       row[11], # ServiceAction
-                       reply,
-                       context,
-                       from_user)
+        depth = self.reply_depth
+        cache = self._message_cache
+        fetched = {(row[1], row[0]): row for row in rows}
+
+        # Fetch the replies one level of nesting at a time, which we know
+        # is enough once a level is empty or the maximum depth is reached.
+        level = rows
+        expanded = set()
+        while level and depth != 0:
+            depth = None if depth is None else depth - 1
+            wanted = set()
+            for row in level:
+                key = (row[1], row[0])
+                if row[5] and key not in expanded:
+                    expanded.add(key)
+                    wanted.add((row[1], row[5]))
+            wanted = {key for key in wanted if (key, depth) not in cache}
+            missing = wanted - fetched.keys()
+            if missing:
+                found = self._fetch_messages(missing)
+                for key in missing:
+                    fetched[key] = found.get(key)  # None if it wasn't dumped
+            level = [fetched[key] for key in wanted if fetched[key]]
+
+        found = [row for row in fetched.values() if row]
+        users = self._fetch_users({row[3] for row in found if row[3]})
+        contexts = {cid: self.get_entity(cid)
+                    for cid in {row[1] for row in found}}
+        entities = dict(zip(
+            ((row[1], row[0]) for row in found),
+            decode_formatting_many([row[10] for row in found])
+        ))
+
+        messages = [self._build_message((row[1], row[0]), fetched, users,
+                                        contexts, entities) for row in rows]
+        while len(cache) > MESSAGE_CACHE_SIZE:
+            cache.popitem(last=False)
+        return messages
+
+    def _build_message(self, key, fetched, users, contexts, entities):
+        """
+        Builds the Message with the given key out of the fetched rows, users,
+        contexts and entities, resolving its replies down to reply_depth. This is
+        done iteratively, so that the chains can be as long as desired.
+        """
+        cache = self._message_cache
+        depth = self.reply_depth
+        chain = []
+        seen = set()
+        while True:
+            reply = cache.get((key, depth))
+            if reply is not None:
+                cache.move_to_end((key, depth))
+                break
+            row = fetched.get(key)
+            if row is None or key in seen:
+                reply = ()  # Not dumped (or the database is broken)
+                break
+            seen.add(key)
+            chain.append((row, depth))
+            if not row[5] or depth == 0:
+                reply = None
+                break
+            key = (row[1], row[5])
+            depth = None if depth is None else depth - 1
+
+        # Build the chain from the oldest message replied to, all of
+        # which will have been resolved as deep as it was needed.
+        for row, depth in reversed(chain):
+            reply = Message(row[0], # ID
+                            row[1], # ContextID
+                            datetime.datetime.fromtimestamp(row[2]),
+                            row[3],  # FromID
+                            row[4],  # Text
+                            row[5],  # ReplyMessageID
+                            row[6],  # ForwardID
+                            row[7],  # PostAuthor
+                            row[8],  # ViewCount
+                            row[9],  # MediaID
+                            row[10], # Formatting
+                            entities[row[1], row[0]],
+                            row[3] == self.our_userid,  # Out
+                            row[11], # ServiceAction
+                            reply,
+                            contexts[row[1]],
+                            users.get(row[3]))
+            cache[(row[1], row[0]), depth] = reply
+        return reply
+
+    def _fetch_messages(self, keys):
+        """
+        Fetches the rows of the messages with the given (context ID, message
+        ID) keys, returning a dictionary with the rows found under their key.
+        """
+        ids = defaultdict(list)
+        for context_id, msg_id in keys:
+            ids[context_id].append(msg_id)
+
+        rows = {}
+        cur = self.dbconn.cursor()
+        for context_id, msg_ids in ids.items():
+            for i in range(0, len(msg_ids), MAX_PARAMS):
+                chunk = msg_ids[i:i + MAX_PARAMS]
+                cur.execute(
+                    "SELECT {} FROM Message WHERE ContextID = ? AND ID IN ({})"
+                    .format(MESSAGE_COLUMNS, ','.join('?' * len(chunk))),
+                    [context_id] + chunk
+                )
+                for row in cur:
+                    rows[row[1], row[0]] = row
+        return rows
+
+    def _fetch_users(self, ids):
+        """
+        Fetches the users with the given IDs as we last saw them, returning a
+        dictionary with the users found under their ID. Like `get_user`, but
+        with a single query for all the users not in the cache.
+        """
+        return {uid: versions[-1] for uid, (_, versions)
+                in self._load_versions('User', ids).items() if versions}
+
+    def search(self, query, context_id=None, start_date=None, end_date=None,
+               limit=20):
+        """
+        Searches the text of the messages (and the names of their media)
+        for the given FTS5 query, returning up to limit `SearchHit`, best
+        first. They may be restricted to a context and dates like in
+        `get_messages_from_context`. Raises ValueError if the database
+        has no search index.
+        """
+        if not self.dbconn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type='table' AND name=?",
+                (SEARCH_TABLE,)).fetchone():
+            raise ValueError('The database has no search index, enable '
+                             'SearchIndex and run with --rebuild-search')
 
+        where, params = self._build_query(
+            ('{} MATCH ?'.format(SEARCH_TABLE), query),
+            ('ContextID = ?', context_id),
+            ('Date > ?', self.get_timestamp(start_date)),
+            ('Date < ?', self.get_timestamp(end_date))
+        )
+        cur = self.dbconn.execute(
+            "SELECT {0}, bm25({1}), "
+            "snippet({1}, -1, '[', ']', '...', 16) "
+            "FROM {1} JOIN Message ON Message.rowid = {1}.rowid {2} "
+            "ORDER BY bm25({1}) LIMIT ?".format(
+                MESSAGE_COLUMNS, SEARCH_TABLE, where),
+            params + (limit,)
+        )
+        rows = cur.fetchall()
+        messages = self._messages_from_rows([row[:-2] for row in rows])
+        return [SearchHit(message, row[-2], row[-1])
+                for message, row in zip(messages, rows)]
 
     def get_message_by_id(self, context_id, msg_id):
         """
         Returns the unique message with the given context and message ID.
         Returns ``None`` if the message has not been dumped.
         """
-        where, params = self._build_query(
-            ('ContextID = ?', context_id),
-            ('ID = ?', msg_id)
-        )
-        cur = self.dbconn.cursor()
-        cur.execute(
-            "SELECT ID, ContextID, Date, FromID, Message, ReplyMessageID, "
-            "ForwardID, PostAuthor, ViewCount, MediaID, Formatting, "
-            "ServiceAction FROM Message {}".format(where), params
-        )
-        row = cur.fetchone()
+        row = self._fetch_messages([(context_id, msg_id)]).get(
+            (context_id, msg_id))
         if row:
             return self._message_from_row(row)
 
@@ -326,12 +721,12 @@ class BaseFormatter:
         ID, at the given date (like all the specific methods). Context ID must
         be marked in the Bot API style, as with get_messages_from_context.
         """
-        peer_type = utils.resolve_id(context_id)[1]
-        if peer_type == types.PeerUser:
+        peer_type = resolve_id(context_id)[1]
+        if peer_type == PEER_USER:
             return self.get_user(context_id, at_date=at_date)
-        elif peer_type == types.PeerChat:
+        elif peer_type == PEER_CHAT:
             return self.get_chat(context_id, at_date=at_date)
-        elif peer_type == types.PeerChannel:
+        elif peer_type == PEER_CHANNEL:
             supergroup = self.get_supergroup(context_id, at_date=at_date)
             if not supergroup:
                 return self.get_channel(context_id, at_date=at_date)
@@ -346,18 +741,8 @@ class BaseFormatter:
         If it is not set, get the user as we last saw them. at_date should be a UTC
         timestamp or datetime object.
         """
-        at_date = self.get_timestamp(at_date)
-        uid = self.ensure_id_marked(uid, types.PeerUser)
-        cur = self.dbconn.cursor()
-        query = (
-            "SELECT ID, DateUpdated, FirstName, LastName, Username, "
-            "Phone, Bio, Bot, CommonChatsCount, PictureID FROM User"
-        )
-        row = self._fetch_at_date(cur, query, uid, at_date)
-        if not row:
-            return None
-        user = User(*row)
-        return user._replace(date_updated=datetime.datetime.fromtimestamp(user.date_updated))
+        return self._get_at_date('User', self.ensure_id_marked(uid, PEER_USER),
+                                 self.get_timestamp(at_date))
 
     def get_channel(self, cid, at_date=None):
         """
@@ -365,18 +750,9 @@ class BaseFormatter:
         the channel as it was at the given date (to the best of our knowledge).
         at_date should be a UTC timestamp or datetime object.
         """
-        at_date = self.get_timestamp(at_date)
-        cid = self.ensure_id_marked(cid, types.PeerChannel)
-        cur = self.dbconn.cursor()
-        query = (
-            "SELECT ID, DateUpdated, About, Title, Username, "
-            "PictureID, PinMessageID FROM Channel"
-        )
-        row = self._fetch_at_date(cur, query, cid, at_date)
-        if not row:
-            return None
-        channel = Channel(*row)
-        return channel._replace(date_updated=datetime.datetime.fromtimestamp(channel.date_updated))
+        return self._get_at_date('Channel',
+                                 self.ensure_id_marked(cid, PEER_CHANNEL),
+                                 self.get_timestamp(at_date))
 
     def get_supergroup(self, sid, at_date=None):
         """
@@ -384,19 +760,9 @@ class BaseFormatter:
         get the supergroup as it was at the given date (to the best of our
         knowledge). at_date should be a UTC timestamp or datetime object.
         """
-        at_date = self.get_timestamp(at_date)
-        sid = self.ensure_id_marked(sid, types.PeerChannel)
-        cur = self.dbconn.cursor()
-        query = (
-            "SELECT ID, DateUpdated, About, Title, Username, "
-            "PictureID, PinMessageID FROM Supergroup"
-        )
-        row = self._fetch_at_date(cur, query, sid, at_date)
-        if not row:
-            return None
-        supergroup = Supergroup(*row)
-        return supergroup._replace(date_updated=datetime.datetime.fromtimestamp(
-            supergroup.date_updated))
+        return self._get_at_date('Supergroup',
+                                 self.ensure_id_marked(sid, PEER_CHANNEL),
+                                 self.get_timestamp(at_date))
 
     def get_chat(self, cid, at_date=None):
         """
@@ -404,28 +770,52 @@ class BaseFormatter:
         the chat as it was at the given date (to the best of our knowledge).
         at_date should be a UTC timestamp or datetime object.
         """
-        at_date = self.get_timestamp(at_date)
-        cid = self.ensure_id_marked(cid, types.PeerChat)
-
-        cur = self.dbconn.cursor()
-        query = (
-            "SELECT ID, DateUpdated, Title, MigratedToID, PictureID FROM Chat"
-        )
-        row = self._fetch_at_date(cur, query, cid, at_date)
-        if not row:
-            return None
-        chat = Chat(*row)
-        return chat._replace(date_updated=datetime.datetime.fromtimestamp(chat.date_updated))
+        return self._get_at_date('Chat', self.ensure_id_marked(cid, PEER_CHAT),
+                                 self.get_timestamp(at_date))
 
     def get_media(self, mid):
         """Return the Media with given ID or return None."""
         cur = self.dbconn.cursor()
-        cur.execute("SELECT ID, Name, MimeType, Size, ThumbnailID, Type, LocalID, "
-                    "VolumeID, Secret, Extra FROM Media WHERE ID = ?", (mid,))
+        cur.execute("SELECT {} FROM Media WHERE ID = ?".format(MEDIA_COLUMNS),
+                    (mid,))
         row = cur.fetchone()
         if not row:
             return None
         return Media(*row)
 
+    def get_media_path(self, message, media):
+        """
+        Returns the path where the downloader saves the given Media of the
+        Message, or None if it's not a kind of media that is downloaded.
+        Whether it was can be checked with ``media_paths.exists(path)``.
+        """
+        return self.media_paths.get_path(
+            media.id, media.type, media.name, media.mime_type,
+            message.context_id, message.from_id, message.date.timestamp()
+        )
+
+    def _fetch_by_id(self, table, columns, cls, ids):
+        """
+        Fetches the rows with the given IDs from the table, returning a
+        dictionary with them as the given namedtuple class under their ID.
+        """
+        ids = [i for i in set(ids) if i is not None]
+        found = {}
+        for i in range(0, len(ids), MAX_PARAMS):
+            chunk = ids[i:i + MAX_PARAMS]
+            for row in self.dbconn.execute(
+                    "SELECT {} FROM {} WHERE ID IN ({})".format(
+                        columns, table, ','.join('?' * len(chunk))), chunk):
+                found[row[0]] = cls(*row)
+        return found
+
+    def get_media_many(self, ids):
+        """Like `get_media` but for many IDs, as a dictionary by ID."""
+        return self._fetch_by_id('Media', MEDIA_COLUMNS, Media, ids)
+
+    def get_forwards(self, ids):
+        """Returns a dictionary with the Forward of every ID found."""
+        return self._fetch_by_id('Forward', FORWARD_COLUMNS, Forward, ids)
+
 # if __name__ == '__main__':
     # main()
@@ -0,0 +1,110 @@
+"""
+Render checkpoints, which remember up to where every context was formatted
+into which file, so that formatting it again only has to append the messages
+dumped since then instead of formatting all of them from the beginning.
+"""
+import hashlib
+import sqlite3
+from collections import namedtuple
+
+# The file the checkpoints are saved in, inside the output directory
+CHECKPOINTS_FILE = 'render-checkpoints.db'
+
+Checkpoint = namedtuple('Checkpoint', (
+    'formatter', 'context_id', 'path',
+    'message_id', 'date',  # The newest message formatted, if any
+    'max_rowid', 'digest',  # The state of the Message table (`table_state`)
+    'offset',  # The size of the file once formatted
+    'filters'  # The digest of the filters it was formatted with, if any
+))
+
+
+def row_digest(row):
+    """Returns a digest of the values in the given row."""
+    return hashlib.sha1(repr(tuple(row)).encode('utf-8')).hexdigest()
+
+
+def filters_digest(args, kwargs):
+    """
+    Returns a digest of the arguments the messages were formatted with
+    besides the context and file (such as start_date or from_user_id), or
+    None if none of them was given, so that output formatted with some
+    filters isn't continued with the messages of other filters.
+    """
+    kwargs = sorted((k, v) for k, v in kwargs.items() if v is not None)
+    if not args and not kwargs:
+        return None
+    return row_digest((args, kwargs))
+
+
+def table_state(conn):
+    """
+    Returns the largest rowid in the Message table and the digest of its
+    row. The Dumper inserts messages again when they change, which gives
+    them a larger rowid than any before (or the same, if it was the last
+    one, which is why its digest is needed), so together they tell apart
+    the messages that were added or changed since.
+    """
+    row = conn.execute('SELECT rowid, * FROM Message '
+                       'ORDER BY rowid DESC LIMIT 1').fetchone()
+    if row is None:
+        return 0, None
+    return row[0], row_digest(row[1:])
+
+
+class CheckpointStore:
+    """
+    Saves the checkpoints of every formatter and context in a database of
+    its own, since the export database is only ever read by formatters.
+    Several processes may use the same one at once.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, timeout=60)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS RenderCheckpoint('
+            'Formatter TEXT NOT NULL,'
+            'ContextID INT NOT NULL,'
+            'Path TEXT NOT NULL,'
+            'MessageID INT,'
+            'Date INT,'
+            'MaxRowID INT NOT NULL,'
+            'Digest TEXT,'
+            'Offset INT NOT NULL,'
+            'Filters TEXT,'
+            'PRIMARY KEY (Formatter, ContextID))'
+        )
+        columns = [row[1] for row in self.conn.execute(
+            'PRAGMA table_info(RenderCheckpoint)')]
+        if 'Filters' not in columns:
+            # Made before filters were saved, when they were always none
+            self.conn.execute(
+                'ALTER TABLE RenderCheckpoint ADD COLUMN Filters TEXT')
+        self.conn.commit()
+
+    def get(self, formatter, context_id):
+        """Returns the `Checkpoint` of the given formatter and context."""
+        row = self.conn.execute(
+            'SELECT Formatter, ContextID, Path, MessageID, Date, MaxRowID, '
+            'Digest, Offset, Filters FROM RenderCheckpoint '
+            'WHERE Formatter = ? AND ContextID = ?', (formatter, context_id)
+        ).fetchone()
+        return Checkpoint(*row) if row else None
+
+    def put(self, checkpoint):
+        """Saves the given `Checkpoint`, replacing the previous one."""
+        self.conn.execute('INSERT OR REPLACE INTO RenderCheckpoint '
+                          'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', checkpoint)
+        self.conn.commit()
+
+    def clear(self, formatter=None):
+        """Forgets the checkpoints of the given formatter, or all of them."""
+        if formatter is None:
+            self.conn.execute('DELETE FROM RenderCheckpoint')
+        else:
+            self.conn.execute('DELETE FROM RenderCheckpoint '
+                              'WHERE Formatter = ?', (formatter,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
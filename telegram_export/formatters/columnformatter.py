@@ -0,0 +1,206 @@
+"""
+Formatter to export the Message table as columns, every one of them an array
+of fixed-size numbers saved in a ``.npy`` file (which NumPy can memory-map)
+so that analyses over millions of messages don't have to go through Python.
+"""
+import ast
+import os
+import struct
+import sys
+from array import array
+from pathlib import Path
+
+from . import BaseFormatter
+from .baseformatter import MAX_PARAMS, User, Chat, Channel, Supergroup
+from ..tracing import TRACER
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# The numeric columns exported as ``<name>.npy`` with 64-bit integers,
+# where NULL values are saved as 0 (which no ID can be).
+NUMERIC_COLUMNS = (
+    ('id', 'ID'),
+    ('context_id', 'ContextID'),
+    ('date', 'CAST(Date AS INT)'),
+    ('from_id', 'FromID'),
+    ('reply_message_id', 'ReplyMessageID'),
+    ('forward_id', 'ForwardID'),
+    ('media_id', 'MediaID'),
+    ('view_count', 'ViewCount')
+)
+
+# The text of every message is saved, encoded in UTF-8, one after another
+# in ``text.npy``, and it spans from ``text_offsets[i]`` to the next one.
+TEXT_FILE = 'text.npy'
+TEXT_OFFSETS_FILE = 'text_offsets.npy'
+
+# How many rows are fetched and written at once
+CHUNK_SIZE = 65536
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+
+# The header is always this long so that it can be written (with the final
+# shape) once all the data has been, which is after it in the file.
+NPY_HEADER_SIZE = 128
+
+# {array typecode: NumPy dtype}
+DTYPES = {'q': '<i8', 'B': '|u1'}
+
+
+class NpyWriter:
+    """
+    Writes a one-dimensional ``.npy`` file with the items of the given
+    `array` typecode as they're given, without having to know how many
+    there will be beforehand or to keep them in memory.
+    """
+    def __init__(self, path, typecode='q'):
+        self.typecode = typecode
+        self.count = 0
+        self._file = open(path, 'wb')
+        self._file.write(b'\0' * NPY_HEADER_SIZE)
+        self._swap = sys.byteorder != 'little' and typecode != 'B'
+
+    def write(self, items):
+        """Writes the given items, an `array` or a bytes-like object."""
+        if not isinstance(items, array):
+            items = array(self.typecode, items)
+        if self._swap:
+            items.byteswap()
+        items.tofile(self._file)
+        self.count += len(items)
+
+    def close(self):
+        """Writes the header with the final shape and closes the file."""
+        if self._file.closed:
+            return
+        header = "{{'descr': '{}', 'fortran_order': False, 'shape': ({},), }}" \
+            .format(DTYPES[self.typecode], self.count)
+        size = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+        header = header.ljust(size - 1).encode('latin1') + b'\n'
+        self._file.seek(0)
+        self._file.write(NPY_MAGIC + struct.pack('<H', size) + header)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def read_npy(path):
+    """
+    Reads the given ``.npy`` file as written by `NpyWriter`. If NumPy is
+    installed, this returns a read-only memory-mapped array (the same as
+    ``numpy.load(path, mmap_mode='r')``), and an `array` otherwise.
+    """
+    if numpy is not None:
+        return numpy.load(path, mmap_mode='r')
+
+    with open(path, 'rb') as f:
+        if f.read(len(NPY_MAGIC)) != NPY_MAGIC:
+            raise ValueError('{} is not a .npy file version 1.0'.format(path))
+        size, = struct.unpack('<H', f.read(2))
+        header = ast.literal_eval(f.read(size).decode('latin1'))
+        typecode = next(t for t, d in DTYPES.items()
+                        if d == header['descr'])
+        items = array(typecode)
+        items.fromfile(f, header['shape'][0])
+    if sys.byteorder != 'little' and typecode != 'B':
+        items.byteswap()
+    return items
+
+
+class ColumnFormatter(BaseFormatter):
+    """
+    A Formatter class to export the messages of a context as columns into
+    a ``<context ID>`` directory inside the given one (see `export`).
+
+    The columns aren't written as a stream of text like the rest, so this
+    only implements `format` and not `_format`.
+    """
+    writes_directory = True
+
+    @staticmethod
+    def name():
+        return 'columns'
+
+    def format(self, target, file=None, *args, **kwargs):
+        """Exports the target context into a directory inside 'file'."""
+        if isinstance(target, (User, Chat, Channel, Supergroup)):
+            target = target.id
+        if not isinstance(target, int):
+            raise TypeError(
+                "target should be a context ID or context namedtuple")
+        if not (isinstance(file, (str, Path)) and os.path.isdir(file)):
+            raise TypeError('The columns can only be exported into a '
+                            'directory, not {}'.format(file))
+
+        with TRACER.dialog(target), \
+                TRACER.span('format', formatter=self.name()):
+            return self.export(os.path.join(file, str(target)), [target])
+
+    def export(self, directory, context_ids=None):
+        """
+        Exports the messages of the given contexts (or all of them) into
+        the given directory, sorted by context and date. Every column in
+        `NUMERIC_COLUMNS` is saved as ``<name>.npy`` and their text into
+        `TEXT_FILE` and `TEXT_OFFSETS_FILE`. Returns how many there were.
+
+        The rows are read straight from the database and written a chunk
+        at a time, without making a Message out of every one of them.
+        """
+        os.makedirs(directory, exist_ok=True)
+        wanted = None
+        if context_ids is not None:
+            context_ids = list(context_ids)
+            if len(context_ids) > MAX_PARAMS:
+                # Reading everything is cheaper than that many parameters
+                wanted, context_ids = set(context_ids), None
+
+        writers = [NpyWriter(os.path.join(directory, name + '.npy'))
+                   for name, _ in NUMERIC_COLUMNS]
+        text = NpyWriter(os.path.join(directory, TEXT_FILE), 'B')
+        offsets = NpyWriter(os.path.join(directory, TEXT_OFFSETS_FILE))
+        offsets.write((0,))
+        try:
+            query = 'SELECT {}, Message FROM Message'.format(
+                ', '.join(column for _, column in NUMERIC_COLUMNS))
+            if context_ids is not None:
+                query += ' WHERE ContextID IN ({})'.format(
+                    ','.join('?' * len(context_ids)))
+            cur = self.dbconn.execute(
+                query + ' ORDER BY ContextID, Date, ID', context_ids or ())
+
+            rows = cur.fetchmany(CHUNK_SIZE)
+            while rows:
+                with TRACER.span('columns', event=False):
+                    if wanted is not None:
+                        rows = [row for row in rows if row[1] in wanted]
+                    self._write_rows(rows, writers, text, offsets)
+                rows = cur.fetchmany(CHUNK_SIZE)
+        finally:
+            for writer in writers + [text, offsets]:
+                writer.close()
+        return writers[0].count
+
+    @staticmethod
+    def _write_rows(rows, writers, text, offsets):
+        for i, writer in enumerate(writers):
+            writer.write(array('q', (row[i] or 0 for row in rows)))
+
+        blob = bytearray()
+        ends = array('q')
+        end = text.count
+        last = len(writers)
+        for row in rows:
+            if row[last]:
+                encoded = row[last].encode('utf-8', 'surrogatepass')
+                blob += encoded
+                end += len(encoded)
+            ends.append(end)
+        text.write(blob)
+        offsets.write(ends)
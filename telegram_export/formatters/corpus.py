@@ -0,0 +1,359 @@
+"""
+Exports the text of the messages as a corpus for natural language processing:
+one message per line, split into shards of a bounded size, with the messages
+that are nearly the same as one seen before left out, and optionally only
+those of some length or language.
+
+The Message table is read in ranges of rowids, which are cheap to scan, and
+several ranges can be exported at once by worker processes. Nothing grows
+with the amount of messages besides the index of those seen, a Bloom filter
+of a fixed size which the processes share through a memory-mapped file.
+
+Near duplicates are found with MinHash and locality-sensitive hashing: the
+signature of every message is split into bands, and a message is left out if
+any of its bands is in the filter already, which is likely if it shares most
+of its shingles (runs of words) with a message seen before.
+"""
+import glob
+import hashlib
+import math
+import mmap
+import multiprocessing
+import os
+import re
+import struct
+from collections import Counter
+
+from .baseformatter import MAX_PARAMS
+from .output import compression_extension, open_output
+from .reader import connect_reader
+from ..tracing import TRACER
+
+try:
+    import langdetect
+except ImportError:
+    langdetect = None
+
+# How many characters of text every shard has, at most
+SHARD_SIZE = 64 * 1024 * 1024
+
+# How many rows of the Message table every job reads
+RANGE_ROWS = 1000000
+
+# How many of the messages never seen before the index of those seen may
+# take for duplicates, once it has as many messages as it was made for
+SEEN_ERROR_RATE = 0.001
+
+# How many words in a row make a shingle, and how many bands of how many
+# hashes the MinHash signature of a message has. Two messages are likely
+# to share a band if more than about (1 / BANDS) ** (1 / BAND_HASHES) of
+# their shingles (around 70%) are the same, and messages with no more words
+# than a shingle only if they are the same.
+SHINGLE_WORDS = 3
+BANDS = 10
+BAND_HASHES = 6
+
+SEEN_FILE = 'corpus-seen.bloom'
+SEEN_MAGIC = b'TGXBLOOM'
+SEEN_HEADER = struct.Struct('<8sQ')
+_WORD = struct.Struct('<Q')
+
+# How many bits of its word every message sets, and how many more bits the
+# filter needs than a classic Bloom filter for the same error rate (since
+# the words aren't all as full, some of them make more mistakes).
+SEEN_BITS = 8
+SEEN_OVERHEAD = 2
+
+# What is compared when telling if two messages are the same are their
+# words, ignoring case, links, numbers and punctuation (so that forwards
+# and spam with a changed link or counter are caught too).
+_LINK = re.compile(r'https?://\S+|www\.\S+')
+_WORDS = re.compile(r'[^\W\d_]+')
+
+# The (a, b) of the hash functions h -> (a * h + b) mod _PRIME the MinHash
+# signature uses, the same in every process.
+_PRIME = (1 << 61) - 1
+_PERMUTATIONS = [
+    (a % (_PRIME - 1) + 1, b % _PRIME) for a, b in (
+        struct.unpack('<QQ', hashlib.blake2b(
+            b'minhash %d' % i, digest_size=16).digest())
+        for i in range(BANDS * BAND_HASHES))
+]
+_BAND = struct.Struct('<B{}Q'.format(BAND_HASHES))
+
+
+def normalize(text):
+    """Returns the text the way it's compared to the rest to deduplicate."""
+    text = text.casefold()
+    if 'http' in text or 'www.' in text:
+        text = _LINK.sub(' ', text)
+    return ' '.join(_WORDS.findall(text))
+
+
+def shingles(key):
+    """
+    Returns the set of shingles (every `SHINGLE_WORDS` words in a row) of
+    the normalized text, or the text itself if it has no more words.
+    """
+    words = key.split()
+    if len(words) <= SHINGLE_WORDS:
+        return {key}
+    return {' '.join(words[i:i + SHINGLE_WORDS])
+            for i in range(len(words) - SHINGLE_WORDS + 1)}
+
+
+def band_keys(key):
+    """
+    Returns the bands of the MinHash signature of the normalized text, as
+    the keys to look up in the `SeenFilter`.
+    """
+    hashes = [int.from_bytes(hashlib.blake2b(
+        shingle.encode('utf-8', 'surrogatepass'), digest_size=8).digest(),
+        'little') for shingle in shingles(key)]
+    signature = [min((a * h + b) % _PRIME for h in hashes)
+                 for a, b in _PERMUTATIONS]
+    return [_BAND.pack(band, *signature[i:i + BAND_HASHES])
+            for band, i in enumerate(range(0, len(signature), BAND_HASHES))]
+
+
+def detect_language(text):
+    """
+    Returns the ISO 639-1 code of the language the text is most likely in,
+    or None if it can't tell. Needs the ``langdetect`` package.
+    """
+    try:
+        return langdetect.detect(text)
+    except langdetect.lang_detect_exception.LangDetectException:
+        return None
+
+
+class SeenFilter:
+    """
+    A Bloom filter of the messages seen, in a file mapped into memory so
+    that several processes can use it at once. Two of them setting bits
+    of the same word at once may lose some of them, which can only let a
+    duplicate through, so they don't lock it.
+
+    All the bits of a message are in the same 64-bit word, so that adding
+    one is a single read and write (rather than one for every bit), which
+    makes mistakes a bit more likely than in a classic Bloom filter.
+    """
+    def __init__(self, path, capacity=1000000, error_rate=SEEN_ERROR_RATE):
+        """
+        Opens the filter at path, or creates it with as many bits as
+        needed for capacity items and the given error rate.
+        """
+        if not os.path.exists(path):
+            bits = SEEN_OVERHEAD * -capacity * math.log(error_rate) \
+                / math.log(2) ** 2
+            words = max(math.ceil(bits / 64), 1)
+            with open(path, 'wb') as f:
+                f.write(SEEN_HEADER.pack(SEEN_MAGIC, words))
+                f.truncate(SEEN_HEADER.size + words * _WORD.size)
+
+        self._file = open(path, 'r+b')
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        magic, self.words = SEEN_HEADER.unpack_from(self._map, 0)
+        if magic != SEEN_MAGIC:
+            self.close()
+            raise ValueError('{} is not an index of seen messages'
+                             .format(path))
+
+    def add(self, key):
+        """
+        Adds the given text (or bytes) to the filter, returning whether it's
+        new (that is, False if it was added before, or rarely, by mistake).
+        """
+        if isinstance(key, str):
+            key = key.encode('utf-8', 'surrogatepass')
+        word, bits = struct.unpack('<QQ', hashlib.blake2b(
+            key, digest_size=16).digest())
+        mask = 0
+        for _ in range(SEEN_BITS):
+            mask |= 1 << (bits & 63)
+            bits >>= 6
+        offset = SEEN_HEADER.size + word % self.words * _WORD.size
+        old, = _WORD.unpack_from(self._map, offset)
+        if old & mask == mask:
+            return False
+        _WORD.pack_into(self._map, offset, old | mask)
+        return True
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def shard_name(index, shard, compression=None):
+    """Returns the file name of the given shard of the given range."""
+    return 'part-{:05}-{:03}.txt{}'.format(
+        index, shard, compression_extension(compression))
+
+
+def database_path(conn):
+    """Returns the path of the file the given connection has opened."""
+    return conn.execute('PRAGMA database_list').fetchone()[2]
+
+
+def export_range(conn, directory, index, start, end, seen, context_ids=None,
+                 shard_size=SHARD_SIZE, compression=None, min_length=1,
+                 max_length=None, languages=None):
+    """
+    Exports the messages with a rowid in [start, end) into the shards of
+    the given range index inside directory, skipping those the `SeenFilter`
+    has already seen (nearly) the same as. Returns a Counter of how many messages were written
+    and how many were skipped (by the reason why).
+    """
+    query = ('SELECT ContextID, Message FROM Message '
+             'WHERE rowid >= ? AND rowid < ? '
+             "AND ServiceAction IS NULL AND Message != ''")
+    params = [start, end]
+    wanted = None
+    if context_ids is not None:
+        if len(context_ids) > MAX_PARAMS:
+            # Reading everything is cheaper than that many parameters
+            wanted = set(context_ids)
+        else:
+            query += ' AND ContextID IN ({})'.format(
+                ','.join('?' * len(context_ids)))
+            params.extend(context_ids)
+
+    counts = Counter()
+    shard = size = 0
+    output = None
+    try:
+        with TRACER.span('corpus', event=False):
+            for cid, text in conn.execute(query, params):
+                if wanted is not None and cid not in wanted:
+                    continue
+                text = ' '.join(text.split())
+                if len(text) < min_length:
+                    counts['short'] += 1
+                    continue
+                if max_length and len(text) > max_length:
+                    counts['long'] += 1
+                    continue
+                key = normalize(text)
+                if not key:
+                    counts['empty'] += 1
+                    continue
+                # Every band is added, even if an earlier one was seen, so
+                # the near duplicates of this message are caught as well.
+                if not all([seen.add(band) for band in band_keys(key)]):
+                    counts['duplicate'] += 1
+                    continue
+                # Detecting the language is slow, so duplicates are skipped
+                # first (their copies would be left out all the same).
+                if languages and detect_language(text) not in languages:
+                    counts['language'] += 1
+                    continue
+
+                if output is not None and size + len(text) >= shard_size:
+                    output.close()
+                    output = None
+                    shard += 1
+                if output is None:
+                    output = open_output(os.path.join(
+                        directory, shard_name(index, shard, compression)),
+                        compression)
+                    size = 0
+                output.write(text + '\n')
+                size += len(text) + 1
+                counts['written'] += 1
+    finally:
+        if output is not None:
+            output.close()
+    return counts
+
+
+# The connection and SeenFilter of this worker process, from `_init_worker`
+_worker = None
+
+
+def _init_worker(db_path, immutable, seen_path, kwargs):
+    global _worker
+    _worker = (connect_reader(db_path, immutable=immutable),
+               SeenFilter(seen_path), kwargs)
+
+
+def _export_range(job):
+    conn, seen, kwargs = _worker
+    index, start, end, directory = job
+    return end - start, export_range(conn, directory, index, start, end,
+                                     seen, **kwargs)
+
+
+def export_corpus(db, directory, context_ids=None, jobs=1, progress=None,
+                  seen_capacity=None, range_rows=RANGE_ROWS, immutable=False,
+                  **kwargs):
+    """
+    Exports the corpus of the given contexts (or all of them) from the
+    database (a path or a connection to it) into directory, replacing what
+    was exported there before. Returns a Counter like `export_range`.
+
+    The rowids are split into ranges of range_rows, exported by as many
+    worker processes as jobs (0 for one per CPU), calling progress(rows)
+    as every range is done (opening the database as immutable, if set,
+    like `connect_reader` does). The index of the messages seen is made for
+    seen_capacity messages, by default as many as there may be in the
+    database (which takes around 48 bytes for every message, one band of
+    their signature being around 5). The rest of keyword arguments are
+    those of `export_range`, and the languages need ``langdetect`` installed.
+
+    Which messages are left out as nearly the same as one before depends on
+    the order the ranges are exported in, and the index may take a few new
+    messages for duplicates (`SEEN_ERROR_RATE`).
+    """
+    if kwargs.get('languages') and langdetect is None:
+        raise ValueError('langdetect must be installed to filter languages')
+    if kwargs.get('languages'):
+        # It's random otherwise, and runs should give the same corpus
+        langdetect.DetectorFactory.seed = 0
+    if context_ids is not None:
+        kwargs['context_ids'] = list(context_ids)
+
+    own_conn = isinstance(db, str)
+    conn = connect_reader(db, immutable=immutable) if own_conn else db
+
+    os.makedirs(directory, exist_ok=True)
+    for path in glob.glob(os.path.join(directory, 'part-*.txt*')):
+        os.remove(path)
+    seen_path = os.path.join(directory, SEEN_FILE)
+    if os.path.exists(seen_path):
+        os.remove(seen_path)
+
+    counts = Counter()
+    try:
+        last = conn.execute('SELECT MAX(rowid) FROM Message').fetchone()[0]
+        SeenFilter(seen_path, BANDS * (seen_capacity or max(last or 0, 1)),
+                   SEEN_ERROR_RATE / BANDS).close()
+        last = (last or 0) + 1
+        ranges = [(i, start, min(start + range_rows, last), directory)
+                  for i, start in enumerate(range(0, last, range_rows))]
+        jobs = min(jobs or multiprocessing.cpu_count(), len(ranges))
+        if jobs <= 1:
+            seen = SeenFilter(seen_path)
+            try:
+                for index, start, end, _ in ranges:
+                    counts += export_range(conn, directory, index, start, end,
+                                           seen, **kwargs)
+                    if progress:
+                        progress(end - start)
+            finally:
+                seen.close()
+        else:
+            with multiprocessing.Pool(
+                    jobs, initializer=_init_worker,
+                    initargs=(database_path(conn), immutable, seen_path,
+                              kwargs)) as pool:
+                for rows, done in pool.imap_unordered(
+                        _export_range, ranges, chunksize=1):
+                    counts += done
+                    if progress:
+                        progress(rows)
+    finally:
+        if own_conn:
+            conn.close()
+        if os.path.exists(seen_path):
+            os.remove(seen_path)
+    return counts
@@ -0,0 +1,79 @@
+"""
+A cache of the versions of the entities saved over time, so that looking up
+how an entity was at any date doesn't have to query the database every time.
+"""
+from bisect import bisect_right
+from collections import OrderedDict
+
+
+class EntityCache:
+    """
+    Keeps every saved version of the entities looked up, sorted by the date
+    they were saved, so that finding the one at any date is a binary search.
+
+    The entities least recently used are forgotten once more than
+    ``max_rows`` versions are kept (entities which have never been saved
+    count as one). A ``max_rows`` of 0 disables the cache.
+    """
+    def __init__(self, max_rows=100000):
+        self.max_rows = max_rows
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # {key: (dates, versions)}
+        self._rows = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Returns the ``(dates, versions)`` saved under the given key,
+        or ``None`` if they're not cached.
+        """
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(key)
+        return entry
+
+    def put(self, key, dates, versions):
+        """
+        Saves the versions of an entity under the given key. Both lists
+        must be sorted by date, which is what ``dates`` should contain.
+        """
+        if not self.max_rows:
+            return
+        self.invalidate(key)
+        self._entries[key] = (dates, versions)
+        self._rows += len(versions) or 1
+        while self._rows > self.max_rows and len(self._entries) > 1:
+            _, (_, old) = self._entries.popitem(last=False)
+            self._rows -= len(old) or 1
+
+    def invalidate(self, key=None):
+        """Forgets the entity with the given key, or all of them if None."""
+        if key is None:
+            self._entries.clear()
+            self._rows = 0
+        else:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._rows -= len(entry[1]) or 1
+
+    @staticmethod
+    def at_date(dates, versions, at_date=None):
+        """
+        Returns the newest version saved before (or at) the given date, the
+        first saved after it if there is none, or the newest if the date is
+        None. Returns None if there are no versions at all.
+        """
+        if not versions:
+            return None
+        if at_date is None:
+            return versions[-1]
+        return versions[max(bisect_right(dates, at_date) - 1, 0)]
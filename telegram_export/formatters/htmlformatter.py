@@ -1,35 +1,389 @@
 """
-Formatter to display paginated(?) HTML of a context.
-Very much unfinished and needs a web designer to work on it.
+Formatter to display paginated HTML of a context.
+
+Formatting into a directory writes every context into its own directory,
+split into pages of a fixed amount of messages with links between them and
+an index of the pages, and `format_index` writes the index of all contexts.
+Formatting into a file writes the whole context as a single page instead.
 """
+import datetime
+import html
+import os
+import urllib.parse
+from itertools import islice
+from pathlib import Path
+
 from . import BaseFormatter
+from .baseformatter import PAGE_SIZE, User, Chat, Channel, Supergroup
+from .output import compression_extension, open_output
+from ..formatting import from_utf16, to_utf16
+from ..tracing import TRACER
+
+# How many messages every page has
+PAGE_MESSAGES = 1000
+
+UNKNOWN_USER_TEXT = '(???)'
+
+# The tags the text of the entities of these kinds is put inside, besides
+# links. The rest of kinds (such as hashtags) are left as plain text.
+ENTITY_TAGS = {'bold': 'b', 'italic': 'i', 'code': 'code', 'pre': 'pre'}
+
+# The only schemes the links in the text of the messages can have
+LINK_SCHEMES = ('http', 'https', 'tg')
+
+STYLE = '''
+body { font-family: sans-serif; max-width: 50em; margin: auto; }
+nav { margin: 1em 0; }
+.message { margin: 0.5em 0; }
+.service { color: #777; font-style: italic; }
+.meta, .forward, .reply { color: #777; font-size: small; }
+.reply { border-left: 2px solid #ccc; padding-left: 0.5em; }
+table { border-collapse: collapse; }
+td, th { padding: 0.2em 0.5em; text-align: left; }
+'''
+
+HEADER = '''<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>{title}</title>
+<style>{style}</style>
+</head>
+<body>
+<h1>{heading}</h1>
+'''
+
+FOOTER = '</body>\n</html>\n'
+
+
+def page_name(page, compression=None):
+    """Returns the file name of the given page (starting at 1)."""
+    return 'page-{}.html{}'.format(page, compression_extension(compression))
 
 
 class HtmlFormatter(BaseFormatter):
     """A Formatter class to generate HTML"""
+    def __init__(self, db, *args, page_size=PAGE_MESSAGES, **kwargs):
+        """
+        Pages will have up to page_size messages. The media is linked to
+        where the downloader would save it (see `BaseFormatter`).
+        """
+        super().__init__(db, *args, **kwargs)
+        self.page_size = page_size
+
     @staticmethod
     def name():
         return 'html'
 
-    def output_header(self, file, context):
-        """Output the header of the page. Context should be a namedtuple"""
-        # TODO HTML
-        print(self.get_display_name(context), file=file)
-
-    def generate_message_html(self, message):
+    def format(self, target, file=None, *args, compression=None, **kwargs):
         """
-        Return HTML for a message, showing reply message, forward headers,
-        view count, post author, and media (if applicable).
+        Like `BaseFormatter.format`, but formatting into a directory writes
+        the pages of the context and their index into a ``<target>``
+        directory inside it, rather than a single file.
         """
-        # TODO HTML
-        from_name = self.get_display_name(message.from_id) or "(???)"
-        return "{}: {}".format(from_name, message.text)
+        if not (isinstance(file, (str, Path)) and os.path.isdir(file)):
+            return super().format(target, file, *args,
+                                  compression=compression, **kwargs)
+
+        if isinstance(target, (User, Chat, Channel, Supergroup)):
+            target = target.id
+        if not isinstance(target, int):
+            raise TypeError(
+                "target should be a context ID or context namedtuple")
+
+        with TRACER.dialog(target), \
+                TRACER.span('format', formatter=self.name()):
+            return self.format_pages(target, os.path.join(file, str(target)),
+                                     compression)
 
     def _format(self, context_id, file, *args, **kwargs):
-        """Format the given context as HTML and output to 'file'"""
+        """Format the given context as a single HTML page into 'file'"""
+        entity = self.get_entity(context_id)
+        name = self.get_display_name(entity) or 'unnamed'
+        file.writelines(self.generate_page(
+            name, self.get_messages_from_context(context_id, order='ASC')
+        ))
+
+    def format_pages(self, context_id, directory, compression=None):
+        """
+        Formats the given context into pages inside the given directory,
+        followed by their index. The messages are read only once, and no
+        more than one of them is held at a time (besides those cached).
+        """
+        os.makedirs(directory, exist_ok=True)
         entity = self.get_entity(context_id)
+        name = self.get_display_name(entity) or 'unnamed'
+        count = self.dbconn.execute(
+            'SELECT COUNT(*) FROM Message WHERE ContextID = ?', (context_id,)
+        ).fetchone()[0]
+        pages = max((count + self.page_size - 1) // self.page_size, 1)
+
+        messages = self.get_messages_from_context(context_id, order='ASC')
+        summaries = []  # (first date, last date, count) of every page
+        for page in range(1, pages + 1):
+            summary = []
+            path = os.path.join(directory, page_name(page, compression))
+            with open_output(path, compression) as output:
+                output.writelines(self.generate_page(
+                    name, islice(messages, self.page_size), directory,
+                    page=page, pages=pages, compression=compression,
+                    summary=summary
+                ))
+            summaries.append(summary)
+
+        path = os.path.join(directory,
+                            'index.html' + compression_extension(compression))
+        with open_output(path, compression) as output:
+            output.writelines(self.generate_context_index(
+                name, summaries, compression))
+
+    def generate_page(self, title, messages, directory=None, page=1, pages=1,
+                      compression=None, summary=None):
+        """
+        Yields the HTML of a page with the given messages, which will be
+        saved in the given directory (so that media is linked relative to
+        it, or with absolute paths if None). The date of the first and last
+        messages written and how many there were are appended to summary.
+        The media of every `PAGE_SIZE` messages is fetched all at once.
+        """
+        heading = html.escape(title)
+        if pages > 1:
+            heading += ' &mdash; page {} of {}'.format(page, pages)
+        yield HEADER.format(title=heading, heading=heading, style=STYLE)
+        nav = self.generate_nav(page, pages, compression)
+        yield nav
+
+        first = last = None
+        count = 0
+        ids = set()
+        messages = iter(messages)
+        for batch in iter(lambda: list(islice(messages, PAGE_SIZE)), []):
+            media = self.get_media_many(m.media_id for m in batch)
+            for message in batch:
+                with TRACER.span('generate', event=False):
+                    text = self.generate_message_html(
+                        message, directory, ids, media.get(message.media_id))
+                ids.add(message.id)
+                first = first or message.date
+                last = message.date
+                count += 1
+                yield text
+
+        yield nav
+        yield FOOTER
+        if summary is not None:
+            summary.extend((first, last, count))
+
+    @staticmethod
+    def generate_nav(page, pages, compression=None):
+        """Returns the links to the index and the previous and next pages."""
+        if pages <= 1:
+            return ''
+        links = ['<a href="index.html{}">Index</a>'.format(
+            compression_extension(compression))]
+        if page > 1:
+            links.append('<a href="{}">&larr; Previous</a>'.format(
+                page_name(page - 1, compression)))
+        if page < pages:
+            links.append('<a href="{}">Next &rarr;</a>'.format(
+                page_name(page + 1, compression)))
+        return '<nav>{}</nav>\n'.format(' | '.join(links))
+
+    def generate_message_html(self, message, directory=None, page_ids=(),
+                              media=None):
+        """
+        Return HTML for a message, showing reply message, forward headers,
+        view count, post author, and media (if applicable). Replies to the
+        messages in page_ids link to them, since they're on the same page.
+        The Media of the message is fetched unless it's given.
+        """
+        when = message.date.strftime('%Y-%m-%d %H:%M:%S')
+        if message.service_action:
+            return ('<div class="message service" id="m{}">{} &middot; {}'
+                    '</div>\n'.format(message.id, when,
+                                      html.escape(message.service_action)))
+
+        parts = ['<div class="message" id="m{}">'.format(message.id)]
+        sender = self.get_display_name(message.from_user) \
+            or message.post_author or UNKNOWN_USER_TEXT
+        parts.append('<div class="meta"><b>{}</b> &middot; {}'.format(
+            html.escape(sender), when))
+        if message.view_count:
+            parts.append(' &middot; {} views'.format(message.view_count))
+        parts.append('</div>')
+
+        if message.forward_id:
+            parts.append('<div class="forward">Forwarded message</div>')
+
+        if message.reply_message is not None:
+            if message.reply_message == ():  # Message not dumped
+                reply = '(message not found)'
+            else:
+                reply = '{}: {}'.format(
+                    html.escape(self.get_display_name(
+                        message.reply_message.from_user) or UNKNOWN_USER_TEXT),
+                    html.escape(message.reply_message.text or ''))
+            if message.reply_message_id in page_ids:
+                reply = '<a href="#m{}">{}</a>'.format(
+                    message.reply_message_id, reply)
+            parts.append('<div class="reply">{}</div>'.format(reply))
+
+        if message.text:
+            parts.append('<div class="text">{}</div>'.format(
+                self.generate_text_html(message.text, message.entities)))
+
+        if message.media_id:
+            parts.append(self.generate_media_html(message, directory, media))
+
+        parts.append('</div>\n')
+        return ''.join(parts)
+
+    @staticmethod
+    def generate_text_html(text, entities=()):
+        """
+        Returns the HTML of the text of a message, with that of its entities
+        in bold, as links, etc. If they overlap rather than nest, those
+        starting later are closed later than they should.
+        """
+        if not entities:
+            return _escape_text(text)
+        data = to_utf16(text)
+        size = len(data) // 2
+        tags = []
+        for entity in entities:
+            start = min(entity.offset, size)
+            end = min(entity.offset + entity.length, size)
+            tag = _entity_tag(entity, from_utf16(data, start, end))
+            if tag and start < end:
+                tags.append((start, end) + tag)
+        tags.sort(key=lambda tag: (tag[0], -tag[1]))
+
+        parts = []
+        inside = []  # The (end, closing tag) of the entities inside of
+        position = 0
+        for start, end, opening, closing in tags + [(size, size, '', '')]:
+            while inside and inside[-1][0] <= start:
+                stop, tag = inside.pop()
+                if stop > position:
+                    parts.append(_escape_text(
+                        from_utf16(data, position, stop)))
+                    position = stop
+                parts.append(tag)
+            parts.append(_escape_text(from_utf16(data, position, start)))
+            parts.append(opening)
+            inside.append((end, closing))
+            position = start
+        return ''.join(parts)
+
+    def generate_media_html(self, message, directory=None, media=None):
+        """
+        Return HTML linking to the media of the message, if downloaded. The
+        Media is fetched unless it's given.
+        """
+        if media is None:
+            media = self.get_media(message.media_id)
+        if not media:
+            return ''
+        label = html.escape(media.name or (media.type or 'media').split('.')[-1])
+        path = self.get_media_path(message, media)
+        if not path:
+            return '<div class="media">[{}]</div>'.format(label)
+        if directory:
+            path = os.path.relpath(path, directory)
+        href = path.replace(os.sep, '/')
+        return '<div class="media"><a href="{}">[{}]</a></div>'.format(
+            html.escape(href), label)
+
+    def generate_context_index(self, title, summaries, compression=None):
+        """
+        Yields the HTML of the index of a context, listing its pages with
+        the given ``(first date, last date, count)`` of each of them.
+        """
+        heading = html.escape(title)
+        yield HEADER.format(title=heading, heading=heading, style=STYLE)
+        yield '<table>\n<tr><th>Page</th><th>From</th><th>To</th>' \
+              '<th>Messages</th></tr>\n'
+        for page, (first, last, count) in enumerate(summaries, start=1):
+            yield '<tr><td><a href="{}">{}</a></td><td>{}</td><td>{}</td>' \
+                  '<td>{}</td></tr>\n'.format(
+                      page_name(page, compression), page,
+                      first.strftime('%Y-%m-%d') if first else '',
+                      last.strftime('%Y-%m-%d') if last else '', count)
+        yield '</table>\n'
+        yield FOOTER
+
+    def format_index(self, directory, context_ids=None, compression=None):
+        """
+        Writes the index of all the contexts formatted into the given
+        directory (or only those given), linking to their own index.
+        """
+        index = 'index.html' + compression_extension(compression)
+        if context_ids is None:
+            context_ids = self.iter_context_ids()
+        context_ids = [cid for cid in context_ids
+                       if os.path.isfile(os.path.join(directory, str(cid),
+                                                      index))]
+        stats = {row[0]: row[1:] for row in self.dbconn.execute(
+            'SELECT ContextID, COUNT(*), MIN(Date), MAX(Date) FROM Message '
+            'GROUP BY ContextID')}
+
+        rows = []
+        for cid in context_ids:
+            count, first, last = stats.get(cid, (0, None, None))
+            rows.append((self.get_display_name(cid) or 'unnamed', cid,
+                         count, first, last))
+        rows.sort(key=lambda row: row[0].lower())
+
+        with open_output(os.path.join(directory, index), compression) as out:
+            out.write(HEADER.format(title='Index', heading='Index',
+                                    style=STYLE))
+            out.write('<table>\n<tr><th>Context</th><th>From</th><th>To</th>'
+                      '<th>Messages</th></tr>\n')
+            out.writelines(
+                '<tr><td><a href="{}/{}">{}</a></td><td>{}</td><td>{}</td>'
+                '<td>{}</td></tr>\n'.format(
+                    cid, index, html.escape(name), _day(first), _day(last),
+                    count)
+                for name, cid, count, first, last in rows
+            )
+            out.write('</table>\n')
+            out.write(FOOTER)
+
+
+def _escape_text(text):
+    return html.escape(text).replace('\n', '<br>\n')
+
+
+def _entity_tag(entity, text):
+    """
+    Returns the opening and closing tags for the given entity with the
+    given text, or None if it has none (or its link isn't safe).
+    """
+    tag = ENTITY_TAGS.get(entity.kind)
+    if tag:
+        return '<{}>'.format(tag), '</{}>'.format(tag)
+
+    if entity.kind == 'texturl' or entity.kind == 'url':
+        href = entity.url if entity.kind == 'texturl' else text
+        if not href:
+            return None
+        scheme = urllib.parse.urlsplit(href).scheme.lower()
+        if not scheme:
+            href = 'http://' + href
+        elif scheme not in LINK_SCHEMES:
+            return None
+    elif entity.kind == 'email':
+        href = 'mailto:' + text
+    elif entity.kind == 'mention':
+        href = 'https://t.me/' + text.lstrip('@')
+    elif entity.kind == 'mentionname':
+        href = 'tg://user?id={}'.format(entity.user_id)
+    else:
+        return None
+    return '<a href="{}">'.format(html.escape(href)), '</a>'
+
 
-        self.output_header(file, entity)
-        for message in self.get_messages_from_context(context_id,
-                                                      order='ASC'):
-            print(self.generate_message_html(message), file=file)
+def _day(timestamp):
+    if timestamp is None:
+        return ''
+    return datetime.datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d')
@@ -0,0 +1,198 @@
+"""
+Formatter to output JSON Lines, one fully hydrated message per line, meant
+to be fed into other programs rather than read by humans.
+"""
+import datetime
+import glob
+import json
+import os
+from itertools import chain, islice
+from pathlib import Path
+
+from . import BaseFormatter
+from .baseformatter import ENTITY_CACHE_SIZE, PAGE_SIZE, User, Chat, \
+    Channel, Supergroup
+from .output import compression_extension, open_output
+from ..tracing import TRACER
+
+
+def _iso_date(date):
+    """Returns the given date (a timestamp or datetime) in ISO 8601, UTC."""
+    if isinstance(date, datetime.datetime):
+        date = date.timestamp()
+    return datetime.datetime.fromtimestamp(
+        date, datetime.timezone.utc).isoformat()
+
+
+def shard_name(shard, compression=None):
+    """Returns the file name of the given shard (starting at 0)."""
+    return 'part-{:05}.jsonl{}'.format(shard,
+                                        compression_extension(compression))
+
+
+class JsonlFormatter(BaseFormatter):
+    """
+    A Formatter class to output every message as a JSON object on a line
+    of its own, with its sender, forward, media and entities inlined.
+    """
+    appendable = True
+
+    def __init__(self, db, cache_size=ENTITY_CACHE_SIZE, reply_depth=0,
+                 checkpoints=None, shard_size=None, **kwargs):
+        """
+        If shard_size is given, formatting into a directory writes every
+        context into a ``<context ID>`` directory, split into files with
+        up to shard_size messages each. Only the ID of the message replied
+        to is output, so replies aren't resolved unless reply_depth is set.
+        """
+        super().__init__(db, cache_size=cache_size, reply_depth=reply_depth,
+                         checkpoints=checkpoints, **kwargs)
+        self.shard_size = shard_size
+        self._encode = json.JSONEncoder(
+            ensure_ascii=False, separators=(',', ':')).encode
+
+    @staticmethod
+    def name():
+        return 'jsonl'
+
+    def format(self, target, file=None, *args, compression=None, **kwargs):
+        """
+        Like `BaseFormatter.format`, but formatting into a directory with
+        a shard_size writes the shards into a ``<target>`` directory inside
+        it (always formatting all of the messages again).
+
+        The messages may be filtered with the start_date, end_date and
+        from_user_id of `get_messages_from_context`.
+        """
+        if not (self.shard_size and isinstance(file, (str, Path))
+                and os.path.isdir(file)):
+            return super().format(target, file, *args,
+                                  compression=compression, **kwargs)
+
+        if isinstance(target, (User, Chat, Channel, Supergroup)):
+            target = target.id
+        if not isinstance(target, int):
+            raise TypeError(
+                "target should be a context ID or context namedtuple")
+
+        with TRACER.dialog(target), \
+                TRACER.span('format', formatter=self.name()):
+            return self.format_shards(target, os.path.join(file, str(target)),
+                                      compression, **kwargs)
+
+    def format_shards(self, context_id, directory, compression=None,
+                      **filters):
+        """
+        Formats the given context into shards of shard_size messages inside
+        the given directory, removing the shards left over from before.
+        Returns how many shards were written.
+        """
+        os.makedirs(directory, exist_ok=True)
+        lines = self.generate(context_id, **filters)
+        shard = 0
+        for first in lines:
+            path = os.path.join(directory, shard_name(shard, compression))
+            with open_output(path, compression) as output:
+                output.writelines(chain(
+                    (first,), islice(lines, self.shard_size - 1)))
+            shard += 1
+
+        for path in glob.glob(os.path.join(directory, 'part-*.jsonl*')):
+            try:
+                index = int(os.path.basename(path)[5:10])
+            except ValueError:
+                continue
+            if index >= shard:
+                os.remove(path)
+        return shard
+
+    def _format(self, context_id, file, *args, checkpoint=None, **kwargs):
+        """Format the given context as JSON Lines and output to 'file'"""
+        file.writelines(self.generate(context_id, checkpoint, **kwargs))
+
+    def generate(self, context_id, checkpoint=None, start_date=None,
+                 end_date=None, from_user_id=None):
+        """
+        Yield the line of every message in the given context matching the
+        filters, or only of those newer than the checkpoint if it's given.
+        The forwards and media are fetched a page of messages at a time.
+        """
+        if checkpoint:
+            if start_date is None or \
+                    self.get_timestamp(start_date) < checkpoint.date:
+                start_date = checkpoint.date
+            min_rowid = checkpoint.max_rowid
+        else:
+            min_rowid = None
+
+        messages = self.get_messages_from_context(
+            context_id, start_date=start_date, end_date=end_date,
+            from_user_id=from_user_id, order='ASC', min_rowid=min_rowid)
+        for page in iter(lambda: list(islice(messages, PAGE_SIZE)), []):
+            forwards = self.get_forwards(m.forward_id for m in page)
+            media = self.get_media_many(m.media_id for m in page)
+            for message in page:
+                with TRACER.span('generate', event=False):
+                    line = self._encode(self.message_dict(
+                        message, forwards.get(message.forward_id),
+                        media.get(message.media_id))) + '\n'
+                yield line
+
+    @staticmethod
+    def message_dict(message, forward=None, media=None):
+        """
+        Returns the dictionary that is encoded as the JSON of a message,
+        given the Forward and Media it has, if any.
+        """
+        sender = message.from_user
+        if sender:
+            sender = {
+                'id': sender.id,
+                'first_name': sender.first_name,
+                'last_name': sender.last_name,
+                'username': sender.username,
+                'bot': bool(sender.bot)
+            }
+        if forward:
+            forward = {
+                'date': _iso_date(forward.original_date),
+                'from_id': forward.from_id,
+                'channel_post': forward.channel_post,
+                'post_author': forward.post_author
+            }
+        if media:
+            media = {
+                'id': media.id,
+                'type': media.type,
+                'name': media.name,
+                'mime_type': media.mime_type,
+                'size': media.size
+            }
+
+        entities = []
+        for entity in message.entities:
+            entity = entity._asdict()
+            if entity['url'] is None:
+                del entity['url']
+            if entity['user_id'] is None:
+                del entity['user_id']
+            if entity['language'] is None:
+                del entity['language']
+            entities.append(entity)
+
+        return {
+            'id': message.id,
+            'context_id': message.context_id,
+            'date': _iso_date(message.date),
+            'from_id': message.from_id,
+            'sender': sender,
+            'out': bool(message.out),
+            'text': message.text,
+            'entities': entities,
+            'reply_to_id': message.reply_message_id,
+            'forward': forward,
+            'media': media,
+            'post_author': message.post_author,
+            'views': message.view_count,
+            'service_action': message.service_action
+        }
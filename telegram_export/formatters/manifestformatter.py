@@ -0,0 +1,145 @@
+"""
+Formatter to output the manifest of the media of a context as CSV: where
+the downloader saves every media, how big it is and whether it's there, so
+that other programs can find the files without walking the directories.
+"""
+import csv
+import itertools
+import operator
+import os
+
+from . import BaseFormatter
+from .output import compression_extension, open_output
+from ..tracing import TRACER
+
+COLUMNS = ('context_id', 'message_id', 'media_id', 'type', 'path', 'size',
+           'present')
+
+# The file `format_index` writes the manifest of all the contexts into
+MANIFEST_FILE = 'manifest.csv'
+
+
+# Every reference to a media besides the messages: the pictures of the
+# users, chats and channels, and the media of the events of the admin log.
+# The downloader dates pictures as the first row with them, like here.
+REFERENCES = ' UNION ALL '.join([
+    'SELECT PictureID AS MediaID, ID AS ContextID, ID AS SenderID, '
+    'DateUpdated AS Date FROM User WHERE PictureID IS NOT NULL'
+] + [
+    'SELECT PictureID, ID, ID, DateUpdated FROM {} '
+    'WHERE PictureID IS NOT NULL'.format(table)
+    for table in ('Chat', 'Channel', 'Supergroup')
+] + [
+    'SELECT {0}, ContextID, UserID, Date FROM AdminLog '
+    'WHERE {0} IS NOT NULL'.format(column)
+    for column in ('MediaID1', 'MediaID2')
+])
+
+
+class ManifestFormatter(BaseFormatter):
+    """
+    A Formatter class to output a row for every media, with the `COLUMNS`
+    of the media and the message it was sent in (if any). The path is empty
+    for the kinds of media which are never downloaded, and present tells
+    whether the file exists.
+    """
+    single_pass = True
+
+    @staticmethod
+    def name():
+        return 'manifest'
+
+    def _format(self, context_id, file, *args, **kwargs):
+        """Format the manifest of the given context as CSV into 'file'"""
+        self._write(file, self.generate(context_id))
+
+    def format_all(self, directory, context_ids=None, compression=None):
+        """
+        Writes the manifest of every one of the given contexts (or all of
+        those with messages) into its own file inside the directory, and
+        that of all of them into `MANIFEST_FILE`, in a single pass.
+        """
+        extension = compression_extension(compression)
+        wanted = set(self.iter_context_ids() if context_ids is None
+                     else context_ids)
+        with open_output(os.path.join(directory, MANIFEST_FILE + extension),
+                         compression) as index, \
+                TRACER.span('format', formatter=self.name()):
+            index_writer = self._write(index, ())
+            for cid, rows in itertools.groupby(self.generate(),
+                                               operator.itemgetter(0)):
+                if cid not in wanted:
+                    if context_ids is None:
+                        index_writer.writerows(rows)
+                    continue
+
+                wanted.remove(cid)
+                path = os.path.join(directory, str(cid) + extension)
+                with open_output(path, compression) as output:
+                    writer = self._write(output, ())
+                    for row in rows:
+                        writer.writerow(row)
+                        index_writer.writerow(row)
+
+            # Those without any media still have a manifest, if empty
+            for cid in wanted:
+                path = os.path.join(directory, str(cid) + extension)
+                with open_output(path, compression) as output:
+                    self._write(output, ())
+
+    def format_index(self, directory, context_ids=None, compression=None):
+        """
+        Writes the manifest of all the given contexts (or all of them)
+        into `MANIFEST_FILE` inside the directory, in a single pass.
+        """
+        rows = self.generate()
+        if context_ids is not None:
+            context_ids = set(context_ids)
+            rows = (row for row in rows if row[0] in context_ids)
+
+        path = os.path.join(directory, MANIFEST_FILE
+                            + compression_extension(compression))
+        with open_output(path, compression) as output:
+            self._write(output, rows)
+
+    @staticmethod
+    def _write(file, rows):
+        writer = csv.writer(file, lineterminator='\n')
+        writer.writerow(COLUMNS)
+        writer.writerows(rows)
+        return writer
+
+    def generate(self, context_id=None):
+        """
+        Yields the row of every media in the given context (or in all of
+        them), sorted by context and date. Media which isn't in a message
+        but e.g. the picture of a user or chat has no message ID, and is in
+        the context of whom it belongs to (the media which nothing refers
+        to anymore, in none).
+
+        They are read with a single query, and the path of each of them is
+        resolved by ``media_paths`` without a Message having to be made.
+        """
+        where, params = self._build_query(('Context = ?', context_id))
+        cur = self.dbconn.execute(
+            'SELECT COALESCE(Message.ContextID, Other.ContextID) AS Context, '
+            'Message.ID, COALESCE(Message.FromID, Other.SenderID), '
+            'CAST(COALESCE(Message.Date, Other.Date) AS INT) AS Sent, '
+            'Media.ID, Type, Name, MimeType, Size FROM Media '
+            'LEFT JOIN Message ON Message.MediaID = Media.ID '
+            'LEFT JOIN (SELECT MediaID, ContextID, SenderID, MIN(Date) AS Date '
+            'FROM ({}) GROUP BY MediaID) AS Other '
+            'ON Other.MediaID = Media.ID AND Message.ID IS NULL{} '
+            'ORDER BY Context, Sent'.format(REFERENCES, where), params
+        )
+        paths = self.media_paths
+        for (cid, message_id, from_id, date,
+             media_id, media_type, name, mime_type, size) in cur:
+            with TRACER.span('generate', event=False):
+                path = None
+                if cid is not None:
+                    path = paths.get_path(media_id, media_type, name,
+                                          mime_type, cid, from_id, date)
+                present = bool(path) and paths.exists(path)
+            yield (cid, message_id, media_id, media_type, path or '', size,
+                   int(present))
@@ -1,20 +1,41 @@
 """A Formatter class to output pure text"""
 from . import BaseFormatter
+from .corpus import export_corpus
 
 
 class NlpFormatter(BaseFormatter):
     """A Formatter class to output only the text of messages,
     intended for natural language processing"""
+    appendable = True
+
     @staticmethod
     def name():
         return 'nlp'
 
-    def _format(self, context_id, file, *args, **kwargs):
+    def _format(self, context_id, file, *args, checkpoint=None, **kwargs):
         """Format the given context as text and output to 'file'"""
-        entity = self.get_entity(context_id)
+        file.writelines(self.generate(context_id, checkpoint))
 
-        for message in self.get_messages_from_context(context_id,
-                                                      order='ASC'):
+    def generate(self, context_id, checkpoint=None):
+        """
+        Yield the text of every message in the given context, or only of
+        those newer than the checkpoint if it's given
+        """
+        if checkpoint:
+            messages = self.get_messages_from_context(
+                context_id, start_date=checkpoint.date, order='ASC',
+                min_rowid=checkpoint.max_rowid)
+        else:
+            messages = self.get_messages_from_context(context_id, order='ASC')
+        for message in messages:
             if not message.text or message.service_action is not None:
                 continue
-            print(message.text)
+            yield message.text + '\n'
+
+    def export_corpus(self, directory, context_ids=None, **kwargs):
+        """
+        Exports the text of the given contexts (or of all of them) into
+        shards inside directory, without duplicates and optionally only of
+        some lengths or languages, as described in `corpus.export_corpus`.
+        """
+        return export_corpus(self.dbconn, directory, context_ids, **kwargs)
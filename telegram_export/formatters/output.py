@@ -0,0 +1,172 @@
+"""
+Output for formatters, which buffers what they write into big chunks before
+handing them to the file, pipe, socket or compressor they should go to.
+"""
+import importlib
+import io
+import os
+from pathlib import Path
+
+# How many characters are buffered before writing them out
+BUFFER_SIZE = 1024 * 1024
+
+# {compression: (module, file extension)}
+COMPRESSIONS = {
+    'gzip': ('gzip', '.gz'),
+    'bz2': ('bz2', '.bz2'),
+    'xz': ('lzma', '.xz')
+}
+
+
+class OutputWriter:
+    """
+    Buffers the text written to it, and writes it out into the sink (any
+    object with a ``write`` method, be it text or binary) in big chunks.
+    The sink is only closed when the writer is if ``close_sink`` is set.
+    """
+    def __init__(self, sink, buffer_size=BUFFER_SIZE, encoding='utf-8',
+                 close_sink=False):
+        self.sink = sink
+        self.buffer_size = buffer_size
+        self.encoding = encoding
+        self.close_sink = close_sink
+        self.closed = False
+        self.binary = isinstance(sink, (io.RawIOBase, io.BufferedIOBase)) \
+            or 'b' in str(getattr(sink, 'mode', ''))
+        self._parts = []
+        self._size = 0
+
+    def write(self, text):
+        """Writes the given text, returning how many characters it had."""
+        self._parts.append(text)
+        self._size += len(text)
+        if self._size >= self.buffer_size:
+            self._drain()
+        return len(text)
+
+    def writelines(self, lines):
+        """Writes every string the given iterable yields, as they come."""
+        parts = self._parts
+        size = self._size
+        limit = self.buffer_size
+        for line in lines:
+            parts.append(line)
+            size += len(line)
+            if size >= limit:
+                self._size = size
+                self._drain()
+                size = 0
+        self._size = size
+
+    def _drain(self):
+        if self._parts:
+            data = ''.join(self._parts)
+            self._parts.clear()
+            self._size = 0
+            self.sink.write(data.encode(self.encoding) if self.binary
+                            else data)
+
+    def flush(self):
+        """Writes out everything buffered so far, and flushes the sink."""
+        self._drain()
+        flush = getattr(self.sink, 'flush', None)
+        if flush:
+            flush()
+
+    def close(self):
+        """Flushes the writer, closing the sink if it should."""
+        if self.closed:
+            return
+        self.closed = True
+        self.flush()
+        if self.close_sink:
+            self.sink.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def compression_extension(compression):
+    """Returns the file extension used for the given compression."""
+    return COMPRESSIONS[compression][1] if compression else ''
+
+
+def _compressor(compression, target, mode='wb'):
+    try:
+        module = COMPRESSIONS[compression][0]
+    except KeyError:
+        raise ValueError('Unknown compression {}, use one of {}'.format(
+            compression, ', '.join(COMPRESSIONS))) from None
+    return importlib.import_module(module).open(target, mode)
+
+
+def open_output(target, compression=None, buffer_size=BUFFER_SIZE,
+                encoding='utf-8', append=False):
+    """
+    Returns an `OutputWriter` for the given target, which may be a path,
+    any object with a ``write`` method accepting text or bytes, or a
+    socket. The output is compressed with the given compression (one of
+    `COMPRESSIONS`), which for paths is guessed from their extension.
+
+    Paths are appended to instead of overwritten if append is set (which
+    works with compression too, since all of them allow concatenating).
+
+    Closing the writer only closes what it opened, so sockets and files
+    given here should still be closed by whoever opened them.
+    """
+    if isinstance(target, (str, Path)):
+        if compression is None:
+            extension = os.path.splitext(str(target))[1]
+            compression = next((name for name, (_, ext) in COMPRESSIONS.items()
+                                if ext == extension), None)
+        mode = 'ab' if append else 'wb'
+        sink = _compressor(compression, target, mode) if compression \
+            else open(target, mode)
+        return OutputWriter(sink, buffer_size, encoding, close_sink=True)
+
+    if hasattr(target, 'sendall') and hasattr(target, 'makefile'):
+        # A socket, writing into a file that doesn't close it when closed
+        target = target.makefile('wb')
+        if compression:
+            return OutputWriter(_Closing(_compressor(compression, target),
+                                         target),
+                                buffer_size, encoding, close_sink=True)
+        return OutputWriter(target, buffer_size, encoding, close_sink=True)
+
+    if not hasattr(target, 'write'):
+        raise TypeError('Supplied file {} could not be interpreted as a file'
+                        .format(target))
+
+    if compression:
+        if isinstance(target, io.TextIOBase):
+            if not hasattr(target, 'buffer'):
+                raise TypeError('Cannot write compressed output into {}'
+                                .format(target))
+            target.flush()
+            target = target.buffer
+        # Closing the compressor writes its end, but leaves the target open
+        return OutputWriter(_compressor(compression, target), buffer_size,
+                            encoding, close_sink=True)
+    return OutputWriter(target, buffer_size, encoding)
+
+
+class _Closing:
+    """Wraps a binary sink so that closing it also closes another one."""
+    def __init__(self, sink, other):
+        self.sink = sink
+        self.other = other
+        self.mode = 'wb'
+
+    def write(self, data):
+        return self.sink.write(data)
+
+    def flush(self):
+        self.sink.flush()
+        self.other.flush()
+
+    def close(self):
+        self.sink.close()
+        self.other.close()
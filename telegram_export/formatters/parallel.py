@@ -0,0 +1,62 @@
+"""
+Formats many contexts at once with a pool of worker processes, each with
+its own formatter and read-only connection to the database.
+"""
+import multiprocessing
+
+from . import NAME_TO_FORMATTER
+from .reader import connect_reader
+
+# The formatter of this worker process, made by `_init_worker`
+_formatter = None
+
+
+def context_sizes(db_path, context_ids=None):
+    """
+    Returns a list of ``(context ID, message count)`` for the given context
+    IDs (or every one in the database), with the largest contexts first.
+    """
+    conn = connect_reader(db_path)
+    try:
+        counts = dict(conn.execute(
+            'SELECT ContextID, COUNT(*) FROM Message GROUP BY ContextID'))
+    finally:
+        conn.close()
+    if context_ids is not None:
+        counts = {cid: counts.get(cid, 0) for cid in context_ids}
+    return sorted(counts.items(), key=lambda t: t[1], reverse=True)
+
+
+def _init_worker(name, db_path, kwargs):
+    global _formatter
+    _formatter = NAME_TO_FORMATTER[name](db_path, **kwargs)
+
+
+def _format_context(job):
+    context_id, count, output, compression = job
+    _formatter.format(context_id, output, compression=compression)
+    return context_id, count
+
+
+def format_contexts(name, db_path, output, contexts, jobs=None,
+                    compression=None, **kwargs):
+    """
+    Formats the given contexts, a list of ``(context ID, message count)``
+    like `context_sizes` returns, with the named formatter into the output.
+    As many worker processes as jobs are used (by default, one per CPU),
+    and any other keyword arguments are used to create their formatter.
+
+    The contexts are formatted in the order given, so the largest ones
+    should be first so that a worker isn't left alone with a huge one at
+    the end while the rest have nothing to do. Yields ``(context ID,
+    message count)`` as every context is done. The output is compressed
+    with the given compression, if any.
+    """
+    jobs = min(jobs or multiprocessing.cpu_count(), len(contexts)) or 1
+    with multiprocessing.Pool(jobs, initializer=_init_worker,
+                              initargs=(name, db_path, kwargs)) as pool:
+        yield from pool.imap_unordered(
+            _format_context,
+            ((cid, count, output, compression) for cid, count in contexts),
+            chunksize=1
+        )
@@ -0,0 +1,39 @@
+"""
+Connections to read an export database with, tuned for formatting: they can't
+write (so they never take a write lock), keep plenty of pages cached with the
+file mapped into memory, and reuse the statements they have prepared.
+"""
+import os
+import pathlib
+import sqlite3
+
+# How many bytes of the database file are mapped into memory
+MMAP_SIZE = 256 * 1024 * 1024
+
+# How many KiB of pages every connection caches
+CACHE_KIB = 64 * 1024
+
+# How many prepared statements every connection keeps (the queries with an
+# amount of parameters that varies make many different statements)
+CACHED_STATEMENTS = 512
+
+
+def connect_reader(path, immutable=False, mmap_size=MMAP_SIZE,
+                   cache_kib=CACHE_KIB):
+    """
+    Opens the database at the given path to read it, and nothing else.
+
+    If immutable is set, SQLite trusts that the file won't change while it's
+    open, so it doesn't lock it nor check if anything changed before every
+    query. That is only safe for finished archives that nothing is dumping
+    into (otherwise the queries may fail or give wrong results).
+    """
+    uri = pathlib.Path(os.path.abspath(path)).as_uri() + '?mode=ro'
+    if immutable:
+        uri += '&immutable=1'
+    conn = sqlite3.connect(uri, uri=True, cached_statements=CACHED_STATEMENTS)
+    conn.execute('PRAGMA query_only = 1')
+    conn.execute('PRAGMA mmap_size = {:d}'.format(mmap_size))
+    conn.execute('PRAGMA cache_size = {:d}'.format(-cache_kib))
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
@@ -0,0 +1,303 @@
+"""
+Formatter to output statistics of a context (or of the whole archive): who
+sends the most messages, at what hours and days, how much media, and so on.
+
+The statistics are computed with a few aggregate queries over the Message
+table for all the contexts at once, binning the dates in SQL, so that no
+Message namedtuple has to be made (and the table is only read a few times
+even when every context is formatted).
+"""
+import datetime
+import json
+import os
+from collections import Counter, defaultdict
+
+from . import BaseFormatter
+from .output import compression_extension, open_output
+
+# The reports that can be output, as JSON or as text meant to be read
+REPORTS = ('text', 'json')
+
+# How many senders are listed in a report
+TOP_SENDERS = 20
+
+WEEKDAYS = ('Mon', 'Tue', 'Wed', 'Thu', 'Fri', 'Sat', 'Sun')
+
+# The characters used to draw the heatmap in text, from none to the most
+HEAT = ' .:-=+*#%@'
+
+# How wide the bars in the text reports are, at most
+BAR_WIDTH = 40
+
+
+def _iso_date(timestamp):
+    if timestamp is None:
+        return None
+    return datetime.datetime.fromtimestamp(
+        timestamp, datetime.timezone.utc).isoformat()
+
+
+def _size(size):
+    """Returns the given amount of bytes in a human readable way."""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = 'TiB'
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' \
+        else '{} B'.format(size)
+
+
+def _bar(count, most):
+    return '#' * round(BAR_WIDTH * count / most) if most else ''
+
+
+def _heat(count, most):
+    """Returns the character of `HEAT` for count, rounding up."""
+    if not most:
+        return HEAT[0]
+    return HEAT[((len(HEAT) - 1) * count + most - 1) // most]
+
+
+class _Aggregates:
+    """The raw counts of a context, which can be added together."""
+    def __init__(self):
+        self.messages = self.service = self.replies = self.forwards = 0
+        self.first = self.last = None
+        self.bins = Counter()  # {(weekday, hour): messages}
+        self.months = Counter()  # {'YYYY-MM': messages}
+        self.senders = Counter()  # {from ID: messages}
+        self.media = Counter()  # {type: messages}
+        self.media_bytes = Counter()  # {type: bytes}
+
+    def __iadd__(self, other):
+        self.messages += other.messages
+        self.service += other.service
+        self.replies += other.replies
+        self.forwards += other.forwards
+        if other.first is not None:
+            self.first = other.first if self.first is None \
+                else min(self.first, other.first)
+            self.last = other.last if self.last is None \
+                else max(self.last, other.last)
+        self.bins += other.bins
+        self.months += other.months
+        self.senders += other.senders
+        self.media += other.media
+        self.media_bytes += other.media_bytes
+        return self
+
+
+class StatsFormatter(BaseFormatter):
+    """
+    A Formatter class to output the statistics of a context as a report,
+    and those of all of them together as the index (see `format_index`).
+    """
+    def __init__(self, db, *args, report='text', top=TOP_SENDERS,
+                 utc_offset=0, **kwargs):
+        """
+        The report may be 'text' or 'json', and lists the top senders. The
+        hours and weekdays are those in UTC plus utc_offset seconds.
+        """
+        super().__init__(db, *args, **kwargs)
+        if report not in REPORTS:
+            raise ValueError('Unknown report {}'.format(report))
+        self.report = report
+        self.top = top
+        self.utc_offset = utc_offset
+        self._aggregates = None
+
+    @staticmethod
+    def name():
+        return 'stats'
+
+    def invalidate_cache(self, eid=None):
+        super().invalidate_cache(eid)
+        self._aggregates = None
+
+    def _format(self, context_id, file, *args, **kwargs):
+        """Format the statistics of the given context and output to 'file'"""
+        aggregates = self.aggregate().get(context_id, _Aggregates())
+        self._write_report(file, self.get_stats(
+            aggregates, self.get_display_name(context_id) or 'unnamed',
+            context_id
+        ))
+
+    def format_index(self, directory, context_ids=None, compression=None):
+        """
+        Writes the statistics of all the given contexts (or all of them)
+        together into ``stats.txt`` or ``stats.json`` inside directory.
+        """
+        aggregates = self.aggregate()
+        if context_ids is None:
+            context_ids = aggregates
+        total = _Aggregates()
+        for cid in context_ids:
+            if cid in aggregates:
+                total += aggregates[cid]
+
+        path = os.path.join(directory, 'stats.{}{}'.format(
+            'json' if self.report == 'json' else 'txt',
+            compression_extension(compression)))
+        with open_output(path, compression) as output:
+            self._write_report(output, self.get_stats(total, 'all contexts'))
+
+    def _write_report(self, file, stats):
+        if self.report == 'json':
+            json.dump(stats, file, ensure_ascii=False, indent=2)
+            file.write('\n')
+        else:
+            file.writelines(self.generate_text(stats))
+
+    def aggregate(self):
+        """
+        Returns the raw counts of every context, as ``{context ID:
+        aggregates}``. They are computed once for all the contexts, since
+        every query has to read the whole table anyway, and then cached.
+        """
+        if self._aggregates is not None:
+            return self._aggregates
+
+        contexts = defaultdict(_Aggregates)
+        date = 'CAST(Date AS INT) + {:d}'.format(self.utc_offset)
+        for cid, count, first, last, service, replies, forwards in \
+                self.dbconn.execute(
+                    'SELECT ContextID, COUNT(*), MIN(Date), MAX(Date), '
+                    'COUNT(ServiceAction), COUNT(ReplyMessageID), '
+                    'COUNT(ForwardID) FROM Message GROUP BY ContextID'):
+            agg = contexts[cid]
+            agg.messages, agg.first, agg.last = count, first, last
+            agg.service, agg.replies, agg.forwards = service, replies, forwards
+
+        # 1970-01-01 was a Thursday, so that's 3 days after a Monday
+        for cid, weekday, hour, count in self.dbconn.execute(
+                'SELECT ContextID, ({0}) / 86400 % 7, ({0}) / 3600 % 24, '
+                'COUNT(*) FROM Message GROUP BY 1, 2, 3'.format(date)):
+            contexts[cid].bins[(weekday + 3) % 7, hour] = count
+
+        for cid, month, count in self.dbconn.execute(
+                "SELECT ContextID, strftime('%Y-%m', {}, 'unixepoch'), "
+                "COUNT(*) FROM Message GROUP BY 1, 2".format(date)):
+            contexts[cid].months[month] = count
+
+        for cid, from_id, count in self.dbconn.execute(
+                'SELECT ContextID, FromID, COUNT(*) FROM Message '
+                'GROUP BY 1, 2'):
+            contexts[cid].senders[from_id] = count
+
+        for cid, media_type, count, size in self.dbconn.execute(
+                'SELECT Message.ContextID, Media.Type, COUNT(*), '
+                'TOTAL(Media.Size) FROM Message JOIN Media '
+                'ON Media.ID = Message.MediaID GROUP BY 1, 2'):
+            agg = contexts[cid]
+            agg.media[media_type or 'unknown'] += count
+            agg.media_bytes[media_type or 'unknown'] += int(size)
+
+        self._aggregates = dict(contexts)
+        return self._aggregates
+
+    def get_stats(self, aggregates, name, context_id=None):
+        """
+        Returns the statistics from the given aggregates as a dictionary,
+        which is what the JSON report has.
+        """
+        agg = aggregates
+        heatmap = [[agg.bins[day, hour] for hour in range(24)]
+                   for day in range(7)]
+        growth = []
+        total = 0
+        for month in sorted(agg.months):
+            total += agg.months[month]
+            growth.append({'month': month, 'messages': agg.months[month],
+                           'total': total})
+
+        return {
+            'context_id': context_id,
+            'name': name,
+            'messages': agg.messages,
+            'service_messages': agg.service,
+            'first_date': _iso_date(agg.first),
+            'last_date': _iso_date(agg.last),
+            'senders': len(agg.senders),
+            'top_senders': [
+                {'id': from_id, 'name': self.get_display_name(from_id),
+                 'messages': count}
+                for from_id, count in agg.senders.most_common(self.top)
+            ],
+            'replies': agg.replies,
+            'reply_ratio': agg.replies / agg.messages if agg.messages else 0,
+            'forwards': agg.forwards,
+            'forward_ratio':
+                agg.forwards / agg.messages if agg.messages else 0,
+            'media': sum(agg.media.values()),
+            'media_bytes': sum(agg.media_bytes.values()),
+            'media_types': [
+                {'type': media_type, 'messages': count,
+                 'bytes': agg.media_bytes[media_type]}
+                for media_type, count in agg.media.most_common()
+            ],
+            'utc_offset': self.utc_offset,
+            'hours': [sum(day[hour] for day in heatmap)
+                      for hour in range(24)],
+            'weekdays': [sum(day) for day in heatmap],
+            'heatmap': heatmap,  # [weekday][hour], Monday first
+            'growth': growth
+        }
+
+    @staticmethod
+    def generate_text(stats):
+        """Yields the lines of the text report of the given statistics."""
+        title = 'Statistics of {}'.format(stats['name'])
+        if stats['context_id'] is not None:
+            title += ' ({})'.format(stats['context_id'])
+        yield title + '\n'
+        yield '=' * len(title) + '\n\n'
+        yield 'Messages: {} ({} service)\n'.format(
+            stats['messages'], stats['service_messages'])
+        if stats['first_date']:
+            yield 'From {} to {}\n'.format(stats['first_date'][:10],
+                                           stats['last_date'][:10])
+        yield 'Replies: {} ({:.1%})\n'.format(stats['replies'],
+                                              stats['reply_ratio'])
+        yield 'Forwards: {} ({:.1%})\n'.format(stats['forwards'],
+                                               stats['forward_ratio'])
+        yield 'Media: {} ({})\n'.format(stats['media'],
+                                        _size(stats['media_bytes']))
+
+        yield '\nTop senders (of {}):\n'.format(stats['senders'])
+        for sender in stats['top_senders']:
+            yield '{:>9}  {}\n'.format(
+                sender['messages'],
+                sender['name'] or sender['id'] or '(channel)')
+
+        if stats['media_types']:
+            yield '\nMedia types:\n'
+            for media in stats['media_types']:
+                yield '{:>9}  {} ({})\n'.format(
+                    media['messages'], media['type'], _size(media['bytes']))
+
+        zone = 'UTC'
+        if stats['utc_offset']:
+            zone += '{:+g}h'.format(stats['utc_offset'] / 3600)
+        most = max(stats['hours'])
+        yield '\nMessages by hour ({}):\n'.format(zone)
+        for hour, count in enumerate(stats['hours']):
+            yield '   {:02}  {:>9} {}\n'.format(hour, count, _bar(count, most))
+
+        most = max(stats['weekdays'])
+        yield '\nMessages by weekday:\n'
+        for day, count in zip(WEEKDAYS, stats['weekdays']):
+            yield '  {}  {:>9} {}\n'.format(day, count, _bar(count, most))
+
+        most = max(max(day) for day in stats['heatmap'])
+        yield '\nHeatmap (hours 00-23):\n'
+        for day, counts in zip(WEEKDAYS, stats['heatmap']):
+            yield '  {}  {}\n'.format(
+                day, ''.join(_heat(count, most) for count in counts))
+
+        if stats['growth']:
+            yield '\nMessages by month:\n'
+            for month in stats['growth']:
+                yield '  {}  {:>9} {:>10}\n'.format(
+                    month['month'], month['messages'], month['total'])
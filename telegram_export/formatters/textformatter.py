@@ -1,18 +1,21 @@
 """A Formatter class to output pure text"""
 from . import BaseFormatter
+from ..formatting import from_utf16, to_utf16
+from ..tracing import TRACER
 
 UNKNOWN_USER_TEXT = '(???)'
 
 class TextFormatter(BaseFormatter):
     """A Formatter class to output pure text"""
+    appendable = True
+
     @staticmethod
     def name():
         return 'text'
 
     def generate_message(self, message):
         """Generate the text for a given Message namedtuple"""
-        who = self.get_display_name(
-            self.get_user(message.from_id)) or UNKNOWN_USER_TEXT
+        who = self.get_display_name(message.from_user) or UNKNOWN_USER_TEXT
 
         if message.service_action:
             return "Service action {}".format(message.service_action)
@@ -30,14 +33,52 @@ class TextFormatter(BaseFormatter):
             reply = ''
 
         when = message.date.strftime('[%d.%m.%y %H.%M.%S]')
-        return '{}, {}:{} {}'.format(who, when, reply or '', message.text)
+        return '{}, {}:{} {}'.format(
+            who, when, reply or '',
+            self.generate_text(message.text, message.entities))
+
+    @staticmethod
+    def generate_text(text, entities=()):
+        """
+        Returns the text of a message with the URL of its links (those
+        with some other text rather than the URL itself) after them.
+        """
+        links = [e for e in entities if e.kind == 'texturl' and e.url]
+        if not text or not links:
+            return text
+        data = to_utf16(text)
+        size = len(data) // 2
+        parts = []
+        position = 0
+        for end, url in sorted((min(e.offset + e.length, size), e.url)
+                               for e in links):
+            parts.append(from_utf16(data, position, end))
+            parts.append(' ({})'.format(url))
+            position = end
+        parts.append(from_utf16(data, position, size))
+        return ''.join(parts)
 
-    def _format(self, context_id, file, *args, **kwargs):
+    def _format(self, context_id, file, *args, checkpoint=None, **kwargs):
         """Format the given context as text and output to 'file'"""
-        entity = self.get_entity(context_id)
-        name = self.get_display_name(entity) or 'unnamed'
+        file.writelines(self.generate(context_id, checkpoint))
 
-        print('== Conversation with "{}" =='.format(name), file=file)
-        for message in self.get_messages_from_context(context_id,
-                                                      order='ASC'):
-            print(self.generate_message(message))
+    def generate(self, context_id, checkpoint=None):
+        """
+        Yield the lines of text for the given context, only for the messages
+        newer than the checkpoint (and without the header) if it's given
+        """
+        if checkpoint is None:
+            entity = self.get_entity(context_id)
+            name = self.get_display_name(entity) or 'unnamed'
+            yield '== Conversation with "{}" ==\n'.format(name)
+
+        if checkpoint:
+            messages = self.get_messages_from_context(
+                context_id, start_date=checkpoint.date, order='ASC',
+                min_rowid=checkpoint.max_rowid)
+        else:
+            messages = self.get_messages_from_context(context_id, order='ASC')
+        for message in messages:
+            with TRACER.span('generate', event=False):
+                line = self.generate_message(message) + '\n'
+            yield line
@@ -0,0 +1,195 @@
+"""
+How the Formatting of a message (its bold, links, mentions...) is saved in
+the database, without needing telethon so that the formatters can read it.
+
+It used to be saved as text, ``kind,offset,length[,extra];...``, leaving out
+the kinds of entities with no name there. Now every kind is saved, packed
+as a BLOB: a header with the version and how many entities there are, the
+(kind, offset, length) of every entity one after the other, and then the
+URL, language or user ID of those which have one. Both can be read.
+
+The offsets and lengths are in UTF-16 code units, like Telegram sends them,
+so the text has to be sliced as UTF-16 (see `to_utf16` and `from_utf16`).
+"""
+import struct
+from collections import namedtuple
+
+# The version of the packed Formatting written, in the low bits of its
+# first byte. The high bit is set when the offsets and lengths don't fit
+# in 16 bits (which Telegram never sends, but the format allows).
+FORMATTING_VERSION = 1
+WIDE = 0x80
+
+_HEADER = struct.Struct('<BH')  # version, amount of entities
+_NARROW = struct.Struct('<BHH')  # kind, offset, length
+_WIDE = struct.Struct('<BII')
+_STRING_SIZE = struct.Struct('<H')
+_USER_ID = struct.Struct('<q')
+
+# The kinds of entity by the number they're packed as, so they can only be
+# appended to. These are also the names used by the text format.
+ENTITY_KINDS = (
+    'unknown', 'mention', 'hashtag', 'botcommand', 'url', 'email', 'bold',
+    'italic', 'code', 'pre', 'texturl', 'mentionname', 'phone', 'cashtag'
+)
+KIND_TO_CODE = {kind: code for code, kind in enumerate(ENTITY_KINDS)}
+
+# An entity of the text of a message where kind is one of `ENTITY_KINDS`
+# and url, user_id and language are only set for "texturl", "mentionname"
+# and "pre" respectively (which has no language in the text format).
+MessageEntity = namedtuple('MessageEntity', (
+    'kind', 'offset', 'length', 'url', 'user_id', 'language'
+))
+
+# Making them like this skips the checks of calling MessageEntity, which
+# take longer than decoding them
+_tuple_new = tuple.__new__
+
+
+def encode_formatting(entities):
+    """
+    Packs the given `MessageEntity` (or tuples like it) into the bytes
+    saved as the Formatting of a message, or returns None if there are no
+    entities. Raises KeyError if the kind of an entity is unknown.
+    """
+    if not entities:
+        return None
+    wide = any(e[1] > 0xffff or e[2] > 0xffff for e in entities)
+    record = _WIDE if wide else _NARROW
+    header = FORMATTING_VERSION | (WIDE if wide else 0)
+
+    records = [_HEADER.pack(header, len(entities))]
+    extras = []
+    for kind, offset, length, url, user_id, language in entities:
+        records.append(record.pack(KIND_TO_CODE[kind], offset, length))
+        if kind == 'texturl' or kind == 'pre':
+            string = (url if kind == 'texturl' else language) or ''
+            string = string.encode('utf-8', 'surrogatepass')
+            extras.append(_STRING_SIZE.pack(len(string)))
+            extras.append(string)
+        elif kind == 'mentionname':
+            extras.append(_USER_ID.pack(user_id))
+    return b''.join(records + extras)
+
+
+def decode_formatting(value):
+    """
+    Decodes the Formatting of a message (either packed or the old text)
+    into a list of `MessageEntity`.
+    """
+    if not value:
+        return []
+    if isinstance(value, str):
+        return _decode_text(value)
+
+    header, count = _HEADER.unpack_from(value)
+    if header & 0x7f != FORMATTING_VERSION:
+        raise ValueError('Unknown formatting version {}'
+                         .format(header & 0x7f))
+    record = _WIDE if header & WIDE else _NARROW
+    start = _HEADER.size
+    end = start + count * record.size
+
+    # All the entities are unpacked in one go, and only those few with
+    # something more to read have to look into the bytes past them.
+    if end == len(value):
+        return [_tuple_new(MessageEntity, (
+                    ENTITY_KINDS[code], offset, length, None, None, None))
+                for code, offset, length in record.iter_unpack(value[start:])]
+
+    entities = []
+    for code, offset, length in record.iter_unpack(value[start:end]):
+        kind = ENTITY_KINDS[code]
+        if kind == 'texturl' or kind == 'pre':
+            size, = _STRING_SIZE.unpack_from(value, end)
+            end += _STRING_SIZE.size
+            string = value[end:end + size].decode('utf-8', 'surrogatepass') \
+                or None
+            end += size
+            if kind == 'texturl':
+                entities.append(_tuple_new(MessageEntity, (
+                    kind, offset, length, string, None, None)))
+            else:
+                entities.append(_tuple_new(MessageEntity, (
+                    kind, offset, length, None, None, string)))
+        elif kind == 'mentionname':
+            user_id, = _USER_ID.unpack_from(value, end)
+            end += _USER_ID.size
+            entities.append(_tuple_new(MessageEntity, (
+                kind, offset, length, None, user_id, None)))
+        else:
+            entities.append(_tuple_new(MessageEntity, (
+                kind, offset, length, None, None, None)))
+    return entities
+
+
+def decode_formatting_many(values):
+    """
+    Decodes the Formatting of many messages at once, like calling
+    `decode_formatting` for every value, but faster: the records of all
+    the packed values with nothing past them (most of them) are unpacked
+    with a single ``iter_unpack`` over their bytes joined together.
+    """
+    result = [None] * len(values)
+    batches = {_NARROW: ([], [], []), _WIDE: ([], [], [])}
+    for i, value in enumerate(values):
+        if not value:
+            result[i] = []
+            continue
+        if isinstance(value, str):
+            result[i] = _decode_text(value)
+            continue
+        header = value[0]  # The header's fields without unpacking it
+        record = _WIDE if header & WIDE else _NARROW
+        count = value[1] | value[2] << 8
+        if header & 0x7f != FORMATTING_VERSION \
+                or _HEADER.size + count * record.size != len(value):
+            result[i] = decode_formatting(value)
+            continue
+        indices, counts, parts = batches[record]
+        indices.append(i)
+        counts.append(count)
+        parts.append(value[_HEADER.size:])
+
+    for record, (indices, counts, parts) in batches.items():
+        if not parts:
+            continue
+        entities = [_tuple_new(MessageEntity, (
+                        ENTITY_KINDS[code], offset, length, None, None, None))
+                    for code, offset, length
+                    in record.iter_unpack(b''.join(parts))]
+        start = 0
+        for i, count in zip(indices, counts):
+            result[i] = entities[start:start + count]
+            start += count
+    return result
+
+
+def to_utf16(text):
+    """Returns the text as UTF-16 bytes, to slice by the entities."""
+    return text.encode('utf-16-le', 'surrogatepass')
+
+
+def from_utf16(data, start, end):
+    """
+    Returns the text between the given offsets (in code units, as those
+    of the entities) of the UTF-16 bytes `to_utf16` returned.
+    """
+    return data[start * 2:end * 2].decode('utf-16-le', 'surrogatepass')
+
+
+def _decode_text(string):
+    """Decodes the Formatting saved as text by older versions."""
+    entities = []
+    for part in string.split(';'):
+        split = part.split(',')
+        kind, offset, length = split[0], int(split[1]), int(split[2])
+        url = user_id = None
+        if kind == 'texturl':
+            # Read as older versions did, with "," and ";" left escaped
+            url = split[-1]
+        elif kind == 'mentionname':
+            user_id = int(split[-1])
+        entities.append(MessageEntity(kind, offset, length, url, user_id,
+                                      None))
+    return entities
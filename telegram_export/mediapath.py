@@ -0,0 +1,169 @@
+"""
+Where the downloader saves every media, worked out from the database alone,
+so that it can also be found offline (e.g. by the formatters) without having
+to import telethon or walk through the output directory.
+"""
+import datetime
+import mimetypes
+import os
+from collections import OrderedDict, defaultdict
+
+# The MediaFilenameFmt the downloader uses unless configured otherwise
+MEDIA_FMT = 'usermedia/{name}-{context_id}/{type}-{filename}'
+
+# The kinds of media (before the dot in Media.Type) that can be downloaded
+DOWNLOADABLE_TYPES = ('photo', 'document')
+
+# How many paths a `MediaPaths` remembers
+PATH_CACHE_SIZE = 100000
+
+# The mimetypes module has many extension for the same mimetype and it will
+# return the one that happens to be first (e.g. ".bat" for "text/plain").
+# This map contains a few common mimetypes and their most common extension.
+#
+# The following code can be use to find out which mimetypes have several ext:
+'''
+import mimetypes
+from collections import defaultdict
+d = defaultdict(list)
+for k, v in mimetypes.types_map.items():
+    d[v].append(k)
+
+d = {k: v for k, v in d.items() if len(v) > 1}
+'''
+COMMON_MIME_TO_EXTENSION = {
+    'text/plain': '.txt',  # To avoid ".bat"
+    'image/jpeg': '.jpg',  # To avoid ".jpe"
+    'image/bmp': '.bmp',  # To avoid ".dib"
+    'video/mp4': '.mp4',  # To avoid ".m4v"
+}
+
+
+def get_extension(mime):
+    """
+    Returns the most common extension for the given mimetype, or '.bin' if
+    none can be found to indicate that it contains arbitrary binary data.
+    """
+    if not mime:
+        mime = ''
+
+    return (
+        COMMON_MIME_TO_EXTENSION.get(mime)
+        or mimetypes.guess_extension(mime)
+        or '.bin'
+    )
+
+
+class MediaPaths:
+    """
+    Resolves the path where the downloader saves a media, given the rows of
+    the message and media, by expanding the MediaFilenameFmt of the config.
+
+    The names of the contexts and senders in the paths, the paths and the
+    files in every directory looked into are cached, so `forget` should be
+    called if those may have changed.
+    """
+    def __init__(self, media_fmt=MEDIA_FMT, get_name=None, root=''):
+        """
+        The paths are media_fmt inside root. get_name(peer_id) should
+        return the name of the given marked ID, or '' if it's unknown.
+        """
+        self.media_fmt = os.path.join(root, media_fmt)
+        self._get_name = get_name or (lambda peer_id: '')
+        self._names = {}
+        self._paths = OrderedDict()  # {(media ID, ...): path}
+        self._listings = {}  # {directory: {file names}}
+
+    def get_name(self, peer_id):
+        """Returns the name of the given marked ID, remembering it."""
+        if peer_id is None:
+            return ''
+        name = self._names.get(peer_id)
+        if not name:
+            # Only known names are remembered, since unknown ones may be
+            # dumped anytime (and then the downloader will use them).
+            name = self._get_name(peer_id) or ''
+            if name:
+                self._names[peer_id] = name
+        return name
+
+    def get_path(self, media_id, media_type, name, mime_type, context_id,
+                 sender_id, date):
+        """
+        Returns the path where the given media (with the Type, Name and
+        MimeType of its row) of the message in the given context, from the
+        given sender and sent at date (a timestamp or a datetime in UTC), is
+        saved. Returns None if it's not a kind of media that is downloaded.
+        """
+        key = (media_id, context_id, sender_id, date)
+        path = self._paths.get(key)
+        if path is not None:
+            self._paths.move_to_end(key)
+            return path
+
+        # Documents have attributes and they're saved under the "document"
+        # namespace so we need to split it before actually comparing.
+        media_type = (media_type or '').split('.')
+        media_type, media_subtype = media_type[0], media_type[-1]
+        if media_type not in DOWNLOADABLE_TYPES:
+            return None
+
+        if not isinstance(date, datetime.datetime):
+            date = datetime.datetime.fromtimestamp(date, datetime.timezone.utc)
+
+        formatter = defaultdict(
+            str,
+            context_id=context_id,
+            sender_id=sender_id,
+            type=media_subtype or 'unknown',
+            name=self.get_name(context_id) or 'unknown',
+            sender_name=self.get_name(sender_id) or 'unknown'
+        )
+
+        # Documents might have a filename, which may have an extension. Use
+        # the extension from the filename if any (more accurate than mime).
+        ext = None
+        if name:
+            filename, ext = os.path.splitext(name)
+        else:
+            # No filename at all, set a sensible default filename
+            filename = date.strftime(
+                '{}_%Y-%m-%d_%H-%M-%S'.format(formatter['type'])
+            )
+
+        # The saved media didn't have a filename and we set our own.
+        # Detect a sensible extension from the known mimetype.
+        if not ext:
+            ext = get_extension(mime_type)
+
+        # Apply the date to the user format string and then replace the map
+        formatter['filename'] = filename
+        path = date.strftime(self.media_fmt).format_map(formatter)
+        path += '.{}{}'.format(media_id, ext)
+
+        self._paths[key] = path
+        if len(self._paths) > PATH_CACHE_SIZE:
+            self._paths.popitem(last=False)
+        return path
+
+    def exists(self, path):
+        """
+        Returns whether there is a file at the given path. The directory it
+        is in is listed the first time, and only looked up afterwards, which
+        is much faster than checking every file when there are many.
+        """
+        directory, filename = os.path.split(path)
+        listing = self._listings.get(directory)
+        if listing is None:
+            try:
+                listing = set(os.listdir(directory or '.'))
+            except OSError:
+                listing = set()
+            self._listings[directory] = listing
+        return filename in listing
+
+    def forget(self):
+        """Forgets the names, paths and files that were remembered."""
+        self._names.clear()
+        self._paths.clear()
+        self._listings.clear()
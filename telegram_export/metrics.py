@@ -0,0 +1,274 @@
+"""
+Counters, gauges and histograms to keep track of what the exporter is doing,
+which can be exported in the Prometheus text format or as a JSON summary.
+"""
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from contextlib import contextmanager
+
+__log__ = logging.getLogger(__name__)
+
+PREFIX = 'telegram_export_'
+
+# Upper bounds of the histogram buckets, in seconds (same as Prometheus').
+DEFAULT_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+# How often should the metrics file be rewritten while running, in seconds.
+WRITE_INTERVAL = 15
+
+
+class Histogram:
+    """Observed values counted in buckets, plus their count and sum."""
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        """Observes the given value."""
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns a list of (upper bound, cumulative count) pairs."""
+        result = []
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class Metrics:
+    """
+    A collection of metrics identified by their name and labels, which are
+    given as keyword arguments, e.g. ``inc('requests_total', request='X')``.
+    """
+    def __init__(self):
+        self.start_time = time.time()
+        self.counters = defaultdict(float)
+        self.gauges = {}
+        self.histograms = {}
+
+    @staticmethod
+    def _key(name, labels):
+        if len(labels) > 1:
+            return name, tuple(sorted(labels.items()))
+        return name, tuple(labels.items())
+
+    def reset(self):
+        """Forgets all the metrics, to start measuring from scratch."""
+        self.__init__()
+
+    def inc(self, name, value=1, **labels):
+        """Increments the given counter by value."""
+        self.counters[self._key(name, labels)] += value
+
+    def set(self, name, value, **labels):
+        """
+        Sets the given gauge to value. The value may also be a callable,
+        in which case it will be called to get the current value.
+        """
+        self.gauges[self._key(name, labels)] = value
+
+    def observe(self, name, value, **labels):
+        """Observes value in the given histogram."""
+        key = self._key(name, labels)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = Histogram()
+        histogram.observe(value)
+
+    @contextmanager
+    def time(self, name, **labels):
+        """Observes how long the body of the ``with`` block takes."""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(name, time.time() - start, **labels)
+
+    def _gauge_values(self):
+        for key, value in self.gauges.items():
+            yield key, value() if callable(value) else value
+
+    def to_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        def fmt_labels(labels, extra=()):
+            labels = tuple(labels) + tuple(extra)
+            if not labels:
+                return ''
+            return '{{{}}}'.format(','.join('{}="{}"'.format(
+                k, str(v).replace('\\', r'\\').replace('"', r'\"')
+            ) for k, v in labels))
+
+        lines = []
+        for kind, items in (('counter', self.counters.items()),
+                            ('gauge', self._gauge_values())):
+            typed = set()
+            for (name, labels), value in sorted(items):
+                if name not in typed:
+                    typed.add(name)
+                    lines.append('# TYPE {}{} {}'.format(PREFIX, name, kind))
+                lines.append('{}{}{} {}'.format(
+                    PREFIX, name, fmt_labels(labels), value))
+
+        typed = set()
+        for (name, labels), histogram in sorted(self.histograms.items(),
+                                                key=lambda t: t[0]):
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {}{} histogram'.format(PREFIX, name))
+            for bound, count in histogram.cumulative():
+                lines.append('{}{}_bucket{} {}'.format(
+                    PREFIX, name,
+                    fmt_labels(labels, (('le', '+Inf' if bound == float('inf')
+                                         else bound),)),
+                    count
+                ))
+            lines.append('{}{}_sum{} {}'.format(
+                PREFIX, name, fmt_labels(labels), histogram.sum))
+            lines.append('{}{}_count{} {}'.format(
+                PREFIX, name, fmt_labels(labels), histogram.count))
+
+        return '\n'.join(lines) + '\n'
+
+    def to_dict(self):
+        """Returns a JSON-serializable summary of the metrics."""
+        summary = {
+            'elapsed_seconds': time.time() - self.start_time,
+            'counters': defaultdict(list),
+            'gauges': defaultdict(list),
+            'histograms': defaultdict(list)
+        }
+        for (name, labels), value in self.counters.items():
+            summary['counters'][name].append(
+                {'labels': dict(labels), 'value': value})
+        for (name, labels), value in self._gauge_values():
+            summary['gauges'][name].append(
+                {'labels': dict(labels), 'value': value})
+        for (name, labels), histogram in self.histograms.items():
+            summary['histograms'][name].append({
+                'labels': dict(labels),
+                'count': histogram.count,
+                'sum': histogram.sum,
+                'mean': histogram.sum / histogram.count
+            })
+        return summary
+
+    def write_prometheus(self, path):
+        """
+        Writes the metrics into the given file in the Prometheus format.
+        The file is replaced atomically, as the textfile collectors expect.
+        """
+        with open(path + '.tmp', 'w') as file:
+            file.write(self.to_prometheus())
+        os.replace(path + '.tmp', path)
+
+    def write_summary(self, path):
+        """Writes the JSON summary of the metrics into the given file."""
+        with open(path, 'w') as file:
+            json.dump(self.to_dict(), file, indent=2, sort_keys=True)
+
+
+class FloodWaitCounter(logging.Filter):
+    """
+    A logging filter for telethon's client logger, counting the flood waits
+    that telethon sleeps on by itself (it only logs them). The logger must
+    let INFO through for this to work, so records below the original level
+    are dropped after being counted, and the output doesn't change.
+    """
+    MESSAGE = re.compile(r'Sleeping (?:early )?for %ds on flood wait')
+
+    def __init__(self, metrics, level):
+        super().__init__()
+        self.metrics = metrics
+        self.level = level
+
+    def filter(self, record):
+        if self.MESSAGE.match(str(record.msg)):
+            self.metrics.inc('flood_waits_total')
+            self.metrics.inc('flood_wait_seconds_total', record.args[0])
+        return record.levelno >= self.level
+
+
+class MetricsExporter:
+    """
+    Exports the metrics while running as configured in the Dumper section:
+    ``MetricsFile`` is periodically rewritten in the Prometheus format,
+    ``MetricsPort`` serves them over HTTP on localhost, and a JSON summary
+    is written to ``MetricsSummary`` once done. All are optional.
+    """
+    def __init__(self, metrics, config, loop=None):
+        self.metrics = metrics
+        self.loop = loop or asyncio.get_event_loop()
+
+        def path(option):
+            value = config.get(option)
+            if value:
+                return os.path.join(config['OutputDirectory'],
+                                    os.path.expanduser(value))
+
+        self.file = path('MetricsFile')
+        self.summary = path('MetricsSummary')
+        self.port = config.getint('MetricsPort', 0)
+        self._writer = None
+        self._server = None
+
+    async def start(self):
+        """Starts exporting the metrics and counting flood waits."""
+        logger = logging.getLogger('telethon.client.users')
+        level = logger.getEffectiveLevel()
+        logger.addFilter(FloodWaitCounter(self.metrics, level))
+        logger.setLevel(min(level, logging.INFO))
+
+        if self.file:
+            self._writer = self.loop.create_task(self._write_periodically())
+        if self.port:
+            self._server = await asyncio.start_server(
+                self._serve, '127.0.0.1', self.port)
+            __log__.info('Serving metrics on http://127.0.0.1:%d/metrics',
+                         self.port)
+
+    async def close(self):
+        """Stops exporting the metrics, writing them one last time."""
+        if self._writer:
+            self._writer.cancel()
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+        if self.file:
+            self.metrics.write_prometheus(self.file)
+        if self.summary:
+            self.metrics.write_summary(self.summary)
+
+    async def _write_periodically(self):
+        while True:
+            self.metrics.write_prometheus(self.file)
+            await asyncio.sleep(WRITE_INTERVAL)
+
+    async def _serve(self, reader, writer):
+        """Answers any HTTP request with the metrics in the text format."""
+        try:
+            while (await reader.readline()).strip():
+                pass  # Skip the request line and headers
+            body = self.metrics.to_prometheus().encode('utf-8')
+            writer.write(b'HTTP/1.0 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode()
+                         + b'\r\n\r\n' + body)
+            await writer.drain()
+        finally:
+            writer.close()
+
+
+# The metrics of this run, updated by the Dumper and Downloader.
+METRICS = Metrics()
@@ -0,0 +1,213 @@
+"""
+Estimates how much work dumping the configured dialogs would take, without
+dumping anything, so that big runs can be planned (and MaxChunks chosen).
+"""
+import math
+import sys
+from collections import namedtuple
+
+from telethon import utils
+from telethon.tl import functions, types
+
+from . import downloader
+
+# The speed at which media is assumed to be downloaded, in bytes per second
+DOWNLOAD_SPEED = 1000 ** 2
+
+# How many participants every request gets (see TelegramClient's iter)
+PARTICIPANTS_LIMIT = 200
+
+# Dialogs which have fewer messages dumped than this are assumed to be
+# like the rest of the database when estimating their media instead
+MIN_SAMPLE = 100
+
+DialogPlan = namedtuple('DialogPlan', (
+    'id', 'name', 'total', 'dumped', 'remaining', 'requests', 'media_files',
+    'media_bytes', 'seconds'
+))
+
+
+class Planner:
+    """
+    Estimates the messages, requests, media and time it would take to dump
+    a dialog, from how many messages Telegram says it has, the state saved
+    to resume it and what has been dumped before (from this dialog if
+    possible, or from all of them otherwise).
+
+    The time is a lower bound made of the delays the Downloader sleeps for
+    and the media transfers; flood waits and the full entities fetched
+    concurrently (usually done long before the history) are left out.
+    """
+    def __init__(self, client, dumper, downloader):
+        self.client = client
+        self.dumper = dumper
+        self.downloader = downloader
+        self._global_media = None
+
+    async def plan(self, target_id):
+        """Returns the `DialogPlan` for the given target ID."""
+        target_in = await self.client.get_input_entity(target_id)
+        target = await self.client.get_entity(target_in)
+        history = await self.client(functions.messages.GetHistoryRequest(
+            peer=target_in, offset_id=0, offset_date=None, add_offset=0,
+            limit=1, max_id=0, min_id=0, hash=0
+        ))
+        participants = None
+        if isinstance(target_in, types.InputPeerChat) or getattr(
+                target, 'megagroup', False):
+            participants = getattr(target, 'participants_count', None) or 0
+
+        return self.estimate(
+            utils.get_peer_id(target), utils.get_display_name(target),
+            getattr(history, 'count', len(history.messages)),
+            participants=participants,
+            admin_log=isinstance(target_in, types.InputPeerChannel)
+        )
+
+    def estimate(self, context_id, name, total, participants=None,
+                 admin_log=False):
+        """
+        Returns the `DialogPlan` for the given context, which has ``total``
+        messages in Telegram. Participants should be ``None`` if they can't
+        be retrieved, and admin_log whether it may be retrieved.
+        """
+        # The history is fetched from the offset ID of the Resume row (or
+        # the newest message) down to its stop_at (or the first message),
+        # so the messages left are those between both not dumped yet.
+        # When a dump finished before, stop_at is the newest message it
+        # dumped, and the newest chunk is fetched again until it's reached.
+        offset_id, _, stop_at = self.dumper.get_resume(context_id)
+        dumped, older, newer = self.dumper.conn.execute(
+            'SELECT COUNT(*), TOTAL(ID <= ?), TOTAL(? AND ID >= ?) '
+            'FROM Message WHERE ContextID = ?',
+            (stop_at, offset_id > 0, offset_id, context_id)
+        ).fetchone()
+        remaining = max(total - int(older) - int(newer), 0)
+        chunk_size = self.dumper.chunk_size
+
+        # The last chunk must be shorter than the limit to know it's the
+        # end, or it reaches stop_at and has messages already dumped
+        chunks = remaining // chunk_size + 1
+        if self.dumper.max_chunks:
+            chunks = min(chunks, self.dumper.max_chunks)
+            remaining = min(remaining, chunks * chunk_size)
+
+        if dumped < MIN_SAMPLE:
+            files, size = self.global_media_stats()
+        else:
+            files, size = self.media_stats(context_id)
+        media_files = remaining * files
+        media_bytes = remaining * size
+
+        # Media left over from an interrupted dump is downloaded as well
+        row = self.dumper.conn.execute(
+            'SELECT COUNT(*), TOTAL(Media.Size) FROM ResumeMedia JOIN Media '
+            'ON ResumeMedia.MediaID = Media.ID WHERE ContextID = ?',
+            (context_id,)
+        ).fetchone()
+        media_files += row[0]
+        media_bytes += row[1]
+
+        requests = chunks
+        if media_files:
+            requests += media_files * math.ceil(
+                media_bytes / media_files / downloader.DOWNLOAD_PART_SIZE)
+        if participants is not None:
+            requests += participants // PARTICIPANTS_LIMIT + 1
+        if admin_log:
+            requests += 1
+
+        # The media is downloaded while the history is being fetched, and
+        # every file takes MEDIA_DELAY seconds unless it's slower than that
+        history_seconds = chunks * downloader.HISTORY_DELAY
+        media_seconds = media_files * max(
+            downloader.MEDIA_DELAY, media_bytes / media_files / DOWNLOAD_SPEED
+        ) if media_files else 0
+        return DialogPlan(
+            context_id, name, total, dumped, remaining, int(requests),
+            round(media_files), round(media_bytes),
+            max(history_seconds, media_seconds)
+        )
+
+    def _media_stats(self, where, params):
+        files = size = 0
+        cur = self.dumper.conn.execute(
+            'SELECT Media.Type, COUNT(*), AVG(Media.Size) '
+            'FROM Message JOIN Media ON Message.MediaID = Media.ID {} '
+            'GROUP BY Media.Type'.format(where), params
+        )
+        for media_type, count, average in cur:
+            if self.downloader.should_download(media_type or ''):
+                files += count
+                size += count * (average or 0)
+
+        messages = self.dumper.conn.execute(
+            'SELECT COUNT(*) FROM Message {}'.format(where), params
+        ).fetchone()[0]
+        if not messages:
+            return 0, 0
+        return files / messages, size / messages
+
+    def media_stats(self, context_id):
+        """
+        Returns how many files that would be downloaded each message of the
+        given context has on average, and how many bytes.
+        """
+        return self._media_stats('WHERE ContextID = ?', (context_id,))
+
+    def global_media_stats(self):
+        """Like `media_stats` but for every message in the database."""
+        if self._global_media is None:
+            self._global_media = self._media_stats('', ())
+        return self._global_media
+
+
+def fmt_bytes(size):
+    """Formats the given size in bytes for humans to read."""
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1000:
+            break
+        size /= 1000
+    else:
+        unit = 'TB'
+    return '{:.1f} {}'.format(size, unit) if unit != 'B' \
+        else '{} B'.format(int(size))
+
+
+def fmt_duration(seconds):
+    """Formats the given seconds as hours, minutes and seconds."""
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{}:{:02}:{:02}'.format(hours, minutes, seconds)
+
+
+def print_plan(plans, file=None):
+    """Prints the given plans as a table, with their totals at the end."""
+    file = file or sys.stdout
+    rows = [('ID', 'Name', 'Messages', 'Remaining', 'Requests', 'Media',
+             'Media size', 'ETA')]
+    for plan in plans:
+        rows.append((
+            str(plan.id), plan.name, str(plan.total), str(plan.remaining),
+            str(plan.requests), str(plan.media_files),
+            fmt_bytes(plan.media_bytes), fmt_duration(plan.seconds)
+        ))
+    # The dialogs are dumped one after another, so the times add up
+    rows.append((
+        'Total', '{} dialogs'.format(len(plans)),
+        str(sum(p.total for p in plans)),
+        str(sum(p.remaining for p in plans)),
+        str(sum(p.requests for p in plans)),
+        str(sum(p.media_files for p in plans)),
+        fmt_bytes(sum(p.media_bytes for p in plans)),
+        fmt_duration(sum(p.seconds for p in plans))
+    ))
+
+    widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+    for i, row in enumerate(rows):
+        if i in (1, len(rows) - 1):
+            print('-+-'.join('-' * w for w in widths), file=file)
+        print(' | '.join(
+            cell.ljust(width) if j < 2 else cell.rjust(width)
+            for j, (cell, width) in enumerate(zip(row, widths))
+        ), file=file)
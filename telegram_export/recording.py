@@ -0,0 +1,429 @@
+"""
+Recording of the requests made by the exporter and their responses, so that
+real export sessions can be replayed offline (and deterministically) later.
+
+A recording is a gzip-compressed stream of records. Each one is keyed by the
+method called and its arguments (for requests, their serialized bytes), and
+holds the response (or error) and how long it took. Replaying looks up the
+responses by key, so it doesn't matter in which order the concurrent parts
+of the Downloader make their requests.
+"""
+import asyncio
+import gzip
+import hashlib
+import json
+import logging
+import os
+import struct
+import time
+from collections import defaultdict, deque
+
+from async_generator import yield_, async_generator
+from telethon import errors, utils
+from telethon.extensions import BinaryReader
+from telethon.tl import TLObject
+
+__log__ = logging.getLogger(__name__)
+
+VERSION = 1
+MAGIC = b'TGXREC'
+
+# The attributes replaced when scrubbing each kind of information.
+SCRUB_FIELDS = {
+    'text': {'message', 'about', 'caption', 'post_author', 'url',
+             'file_name', 'alt', 'prev_value', 'new_value'},
+    'names': {'first_name', 'last_name', 'username', 'title'},
+    'phones': {'phone', 'phone_number'},
+}
+
+# The Dumper settings that change which requests are made, which are saved
+# along the recording so that it can be replayed with the same ones.
+SETTINGS = ('ChunkSize', 'MaxChunks', 'MediaWhitelist', 'MaxSize',
+            'InvalidationTime')
+
+# How many records may be buffered before flushing them into the file, so
+# that the recordings of exports that crash badly are still useful.
+FLUSH_EVERY = 100
+
+_RECORD = struct.Struct('<HId')  # Key length, value length, duration
+_LENGTH = struct.Struct('<I')
+
+
+def scrub_string(value):
+    """
+    Replaces the given string with a meaningless one of the same length in
+    UTF-16 code units (which message entities are measured in), keeping
+    the whitespace. The same string is always replaced with the same one.
+    """
+    digest = hashlib.sha256(value.encode('utf-8')).digest()
+    result = []
+    for i, char in enumerate(value):
+        if char.isspace():
+            result.append(char)
+        else:
+            letter = chr(ord('a') + digest[i % len(digest)] % 26)
+            result.append(letter * (2 if ord(char) > 0xFFFF else 1))
+    return ''.join(result)
+
+
+def scrub(obj, fields):
+    """
+    Scrubs the given attributes from the TLObject (or list of them)
+    and all the objects it contains, in place.
+    """
+    if isinstance(obj, list):
+        for item in obj:
+            scrub(item, fields)
+    elif isinstance(obj, TLObject):
+        for name, value in vars(obj).items():
+            if isinstance(value, str):
+                if name in fields:
+                    setattr(obj, name, scrub_string(value))
+            elif isinstance(value, (TLObject, list)):
+                scrub(value, fields)
+
+
+def encode_value(value):
+    """
+    Encodes a response as bytes: TLObjects are serialized as Telegram
+    would, lists are encoded item by item, and anything else as JSON.
+    """
+    if isinstance(value, TLObject):
+        data = bytes(value)
+        return b'T' + _LENGTH.pack(len(data)) + data
+    if isinstance(value, list):
+        return b'L' + _LENGTH.pack(len(value)) + b''.join(map(encode_value,
+                                                              value))
+    data = json.dumps(value).encode('utf-8')
+    return b'J' + _LENGTH.pack(len(data)) + data
+
+
+def decode_value(data, offset=0):
+    """Decodes a value from data, returning it and the offset after it."""
+    kind = data[offset:offset + 1]
+    length, = _LENGTH.unpack_from(data, offset + 1)
+    offset += 1 + _LENGTH.size
+    if kind == b'L':
+        items = []
+        for _ in range(length):
+            item, offset = decode_value(data, offset)
+            items.append(item)
+        return items, offset
+
+    end = offset + length
+    if kind == b'T':
+        with BinaryReader(data[offset:end]) as reader:
+            return reader.tgread_object(), end
+    return json.loads(data[offset:end].decode('utf-8')), end
+
+
+def make_key(method, *args):
+    """
+    Returns the key under which a call to the given method with the given
+    arguments is recorded. Entities are identified by their ID only, since
+    they may have been scrubbed, and the rest hashed to keep keys small.
+    """
+    parts = [method.encode('ascii')]
+    for arg in args:
+        if isinstance(arg, TLObject):
+            try:
+                parts.append(b'peer:%d' % utils.get_peer_id(arg))
+                continue
+            except TypeError:
+                parts.append(bytes(arg))
+        else:
+            parts.append(repr(arg).encode('utf-8'))
+    return hashlib.sha1(b'\0'.join(parts)).digest()
+
+
+def error_to_dict(error):
+    """Returns a JSON-serializable description of an RPCError."""
+    return {
+        'error': type(error).__name__,
+        'code': error.code,
+        'message': error.message,
+        # The value captured from the message, such as seconds to wait
+        'capture': next((v for k, v in vars(error).items()
+                         if k != 'code' and isinstance(v, int)), None)
+    }
+
+
+def error_from_dict(error, request):
+    """Recreates the RPCError described by `error_to_dict`."""
+    cls = getattr(errors, error['error'], None)
+    if cls is None or not issubclass(cls, errors.RPCError):
+        return errors.RPCError(request, error['message'], error['code'])
+    try:
+        if error['capture'] is not None:
+            return cls(request, capture=error['capture'])
+        return cls(request)
+    except TypeError:
+        # Base errors (such as BadRequestError) also need their message
+        return cls(request, error['message'])
+
+
+class RecordingClient:
+    """
+    Wraps a TelegramClient to save the calls made by the exporter, and their
+    results, into a recording file. Anything else is forwarded untouched.
+
+    The responses are saved scrubbed from the kinds of information given
+    (see `SCRUB_FIELDS`), but the exporter still gets the real ones.
+    Media is never saved, only the size of the downloaded files. The
+    `SETTINGS` from the given Dumper config are saved too.
+    """
+    def __init__(self, client, path, scrub=(), config=None):
+        self.client = client
+        self.fields = set()
+        for kind in scrub:
+            self.fields |= SCRUB_FIELDS[kind]
+        self.file = gzip.open(path, 'wb')
+        self._unflushed = 0
+        self.file.write(MAGIC)
+        self._write(b'header', {
+            'version': VERSION,
+            'scrub': sorted(scrub),
+            'settings': {k: config[k] for k in SETTINGS
+                         if config and k in config}
+        }, 0)
+        __log__.info('Recording the session into %s', path)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def _write(self, key, value, duration):
+        if isinstance(value, (TLObject, list)) and self.fields:
+            # Scrub a copy, the exporter should still get the real value
+            value, _ = decode_value(encode_value(value))
+            scrub(value, self.fields)
+        data = encode_value(value)
+        self.file.write(_RECORD.pack(len(key), len(data), duration))
+        self.file.write(key)
+        self.file.write(data)
+        self._unflushed += 1
+        if self._unflushed >= FLUSH_EVERY:
+            self.file.flush()
+            self._unflushed = 0
+
+    async def _record(self, call, method, *args, saved=None):
+        """
+        Awaits the call and records its result (or what ``saved`` returns
+        for it) under the method and arguments, which are only keyed
+        afterwards since the client may resolve them in place.
+        """
+        start = time.time()
+        try:
+            result = await call
+        except errors.RPCError as e:
+            self._write(make_key(method, *args), error_to_dict(e),
+                        time.time() - start)
+            raise
+        self._write(make_key(method, *args),
+                    saved(result) if saved else result, time.time() - start)
+        return result
+
+    async def __call__(self, request):
+        return await self._record(self.client(request), 'call', request)
+
+    async def get_me(self, input_peer=False):
+        return await self._record(self.client.get_me(input_peer=input_peer),
+                                  'get_me', input_peer)
+
+    async def get_input_entity(self, peer):
+        if isinstance(peer, TLObject):
+            return utils.get_input_peer(peer)  # Doesn't need to be recorded
+
+        # The exporter only resolves the whitelisted entities. These may be
+        # usernames or phones, so they're also saved by ID for the replay.
+        result = await self._record(self.client.get_input_entity(peer),
+                                    'get_input_entity', peer)
+        peer_id = utils.get_peer_id(result)
+        self._write(make_key('get_input_entity', peer_id), result, 0)
+        self._write(b'Whitelist', peer_id, 0)
+        return result
+
+    async def get_entity(self, peer):
+        return await self._record(self.client.get_entity(peer),
+                                  'get_entity', peer)
+
+    async def get_peer_id(self, peer):
+        # Only used to find the IDs of the blacklisted entities
+        result = await self._record(self.client.get_peer_id(peer),
+                                    'get_peer_id', peer)
+        self._write(b'Blacklist', result, 0)
+        return result
+
+    async def get_dialogs(self, limit=None):
+        return await self._record(
+            self.client.get_dialogs(limit=limit), 'get_dialogs', limit,
+            saved=lambda dialogs: [d.entity for d in dialogs]
+        )
+
+    @async_generator
+    async def iter_dialogs(self):
+        for dialog in await self.get_dialogs():
+            await yield_(dialog)
+
+    async def get_participants(self, entity):
+        return await self._record(self.client.get_participants(entity),
+                                  'get_participants', entity)
+
+    async def download_file(self, location, file, file_size=None,
+                            part_size_kb=None, progress_callback=None):
+        return await self._record(
+            self.client.download_file(
+                location, file=file, file_size=file_size,
+                part_size_kb=part_size_kb,
+                progress_callback=progress_callback
+            ),
+            'download_file', location,
+            saved=lambda _: os.path.getsize(file)
+        )
+
+    async def disconnect(self):
+        self.close()
+        await self.client.disconnect()
+
+    def close(self):
+        """Closes the recording file, which must be done to use it."""
+        if not self.file.closed:
+            self.file.close()
+
+
+def read_recording(path):
+    """
+    Reads the recording at the given path, returning its header
+    and a dictionary of ``{key: [(value, duration)]}`` records.
+    """
+    chunks = []
+    with gzip.open(path, 'rb') as file:
+        try:
+            for chunk in iter(lambda: file.read(1024 * 1024), b''):
+                chunks.append(chunk)
+        except EOFError:
+            # The export was killed before closing the recording. Whatever
+            # was flushed until then can still be replayed.
+            __log__.warning('The recording %s is incomplete', path)
+    data = b''.join(chunks)
+
+    if not data.startswith(MAGIC):
+        raise ValueError('{} is not a recording'.format(path))
+
+    records = defaultdict(list)
+    offset = len(MAGIC)
+    header = None
+    while offset + _RECORD.size <= len(data):
+        key_len, value_len, duration = _RECORD.unpack_from(data, offset)
+        offset += _RECORD.size
+        end = offset + key_len + value_len
+        if end > len(data):
+            break  # Last record was cut in half
+
+        key = data[offset:offset + key_len]
+        value, offset = decode_value(data, offset + key_len)
+        if key == b'header':
+            header = value
+        else:
+            records[key].append((value, duration))
+
+    if not header or header.get('version') != VERSION:
+        raise ValueError('{} is not a recording this version can replay'
+                         .format(path))
+    return header, records
+
+
+class ReplayClient:
+    """
+    Answers the calls made by the exporter with the responses saved in a
+    recording, without any network. Identical calls get the responses in
+    the same order in which they were recorded, and the last one once
+    they run out. Calls that were never recorded raise ``KeyError``.
+
+    If ``realtime`` is set, every call takes as long as it originally did.
+    """
+    def __init__(self, path, realtime=False):
+        self.header, records = read_recording(path)
+        self.realtime = realtime
+        self.requests = 0
+        # The IDs of the entities that were white or blacklisted, if any
+        self.lists = {name: sorted({value for value, _ in records.pop(
+            name.encode('ascii'), ())}) for name in ('Whitelist', 'Blacklist')}
+        self._records = {key: deque(values) for key, values in records.items()}
+
+    async def _replay(self, key, request=None):
+        self.requests += 1
+        values = self._records.get(key)
+        if not values:
+            raise KeyError('Call not found in the recording ({})'
+                           .format(request or key.hex()))
+        value, duration = values.popleft() if len(values) > 1 else values[0]
+        if self.realtime and duration:
+            await asyncio.sleep(duration)
+        if isinstance(value, dict) and 'error' in value:
+            raise error_from_dict(value, request)
+        return value
+
+    async def __call__(self, request):
+        if hasattr(request, 'resolve'):
+            await request.resolve(self, utils)
+        return await self._replay(make_key('call', request),
+                                  type(request).__name__)
+
+    async def get_me(self, input_peer=False):
+        return await self._replay(make_key('get_me', input_peer), 'get_me')
+
+    async def get_input_entity(self, peer):
+        if isinstance(peer, TLObject):
+            return utils.get_input_peer(peer)
+        return await self._replay(make_key('get_input_entity', peer),
+                                  'get_input_entity')
+
+    async def get_entity(self, peer):
+        return await self._replay(make_key('get_entity', peer), 'get_entity')
+
+    async def get_peer_id(self, peer):
+        if isinstance(peer, int):
+            return peer
+        return await self._replay(make_key('get_peer_id', peer),
+                                  'get_peer_id')
+
+    async def get_dialogs(self, limit=None):
+        return [OfflineDialog(x) for x in
+                await self._replay(make_key('get_dialogs', limit),
+                                   'get_dialogs')]
+
+    @async_generator
+    async def iter_dialogs(self):
+        for dialog in await self.get_dialogs():
+            await yield_(dialog)
+
+    async def get_participants(self, entity):
+        return await self._replay(make_key('get_participants', entity),
+                                  'get_participants')
+
+    async def download_file(self, location, file, file_size=None,
+                            part_size_kb=64, progress_callback=None):
+        size = await self._replay(make_key('download_file', location),
+                                  'download_file')
+        part_size = part_size_kb * 1024
+        saved = 0
+        with open(file, 'wb') as fd:
+            while saved < size:
+                part = min(part_size, size - saved)
+                fd.write(bytes(part))
+                saved += part
+                if progress_callback:
+                    progress_callback(saved, file_size)
+        return file
+
+    async def disconnect(self):
+        pass
+
+
+class OfflineDialog:
+    """The few attributes of telethon's Dialog used by the exporter."""
+    def __init__(self, entity):
+        self.entity = entity
+        self.input_entity = utils.get_input_peer(entity)
+        self.id = utils.get_peer_id(entity)
+        self.name = utils.get_display_name(entity)
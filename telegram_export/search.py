@@ -0,0 +1,186 @@
+"""
+An index to quickly search for entities (users, chats and channels) by their
+name, username or phone, using either the dumped data or a list of dialogs.
+"""
+import json
+import os
+from collections import namedtuple, defaultdict, Counter
+
+Entity = namedtuple('Entity', ('id', 'name', 'username', 'phone'))
+
+# The tables the entities are dumped into, which are searched
+ENTITY_TABLES = ('User', 'Chat', 'Channel', 'Supergroup')
+
+# The file in the output directory where `EntityIndex.load` saves the index.
+# It's JSON rather than a pickle, which could run any code when loaded.
+INDEX_FILE = 'entity-index.json'
+
+# The score above which entities are a match. Dice's coefficient between
+# trigrams is harsher than difflib's ratio (which was used with 0.7), since
+# a single typo spoils up to three trigrams: "Pyhton Programers" scores 0.70
+# against "Python Programmers" (0.91 with difflib). Over names with a few
+# random typos, 0.35 is what agrees the most with difflib above 0.7.
+THRESHOLD = 0.35
+
+
+def trigrams(text):
+    """
+    Returns the set of trigrams for the given text, padded with spaces
+    so that words starting or ending the same way share some of them.
+    """
+    text = '  {} '.format(' '.join(text.lower().split()))
+    return set(map(''.join, zip(text, text[1:], text[2:])))
+
+
+class EntityIndex:
+    """
+    A trigram index over the name, username and phone of entities, which
+    can be searched for the ones that look the most like a given query.
+
+    Entities added later are considered more relevant (for instance, the
+    more recently updated ones) and rank slightly higher on similar scores.
+    """
+    def __init__(self, entities=()):
+        self.entities = []
+        # Every indexed name, username or phone is a "field", stored as
+        # (index of its entity, lowercase text, number of trigrams).
+        self._fields = []
+        self._postings = defaultdict(list)  # {trigram: [field index]}
+        for entity in entities:
+            self.add(entity)
+
+    @classmethod
+    def from_database(cls, conn):
+        """
+        Builds an index over all the entities dumped into the database of
+        the given connection, as they were last seen. This includes the
+        chats that have been left but are still present in the database.
+        """
+        rows = []
+        for query in (
+                "SELECT ID, MAX(DateUpdated), FirstName, LastName, "
+                "Username, Phone FROM User GROUP BY ID",
+                "SELECT ID, MAX(DateUpdated), Title, NULL, NULL, NULL "
+                "FROM Chat GROUP BY ID",
+                "SELECT ID, MAX(DateUpdated), Title, NULL, Username, NULL "
+                "FROM Channel GROUP BY ID",
+                "SELECT ID, MAX(DateUpdated), Title, NULL, Username, NULL "
+                "FROM Supergroup GROUP BY ID"):
+            rows.extend(conn.execute(query))
+
+        rows.sort(key=lambda row: row[1])
+        return cls(Entity(
+            row[0],
+            '{} {}'.format(row[2] or '', row[3] or '').strip(),
+            row[4],
+            row[5]
+        ) for row in rows)
+
+    @classmethod
+    def load(cls, conn, path, save=True):
+        """
+        Like `from_database`, but the index is saved into the file at the
+        given path, and loaded from there as long as no entity was dumped
+        into the database since, instead of being built again every time.
+        If save is False (e.g. if the output is read-only), the file is
+        only read, never written.
+        """
+        state = list(cls.database_state(conn))
+        try:
+            with open(path, encoding='utf-8') as f:
+                saved = json.load(f)
+            if saved['state'] == state:
+                return cls._from_json(saved)
+        except (OSError, ValueError, LookupError, TypeError):
+            pass
+
+        index = cls.from_database(conn)
+        if save:
+            try:
+                with open(path + '.tmp', 'w', encoding='utf-8') as f:
+                    json.dump(dict(index._to_json(), state=state), f)
+                os.replace(path + '.tmp', path)
+            except OSError:
+                pass  # It will just be built again next time
+        return index
+
+    def _to_json(self):
+        """Returns the index as a dictionary that can be saved as JSON."""
+        return {
+            'entities': self.entities,
+            'fields': self._fields,
+            'postings': self._postings
+        }
+
+    @classmethod
+    def _from_json(cls, saved):
+        """Makes an index out of the dictionary `_to_json` returned."""
+        index = cls()
+        index.entities = [Entity(*entity) for entity in saved['entities']]
+        index._fields = [(entity, text, grams)
+                         for entity, text, grams in saved['fields']]
+        index._postings.update(saved['postings'])
+        return index
+
+    @staticmethod
+    def database_state(conn):
+        """
+        Returns the last rowid of every entity table in the database of the
+        given connection, which changes whenever an entity is dumped (since
+        they are only ever inserted, or replaced with a new rowid).
+        """
+        return tuple(
+            conn.execute('SELECT MAX(rowid) FROM {}'.format(table))
+            .fetchone()[0] for table in ENTITY_TABLES
+        )
+
+    def __len__(self):
+        return len(self.entities)
+
+    def add(self, entity):
+        """Adds the given Entity namedtuple to the index."""
+        index = len(self.entities)
+        self.entities.append(entity)
+        for text in (entity.name, entity.username, entity.phone):
+            if not text:
+                continue
+            grams = trigrams(text)
+            field = len(self._fields)
+            self._fields.append((index, text.lower(), len(grams)))
+            for gram in grams:
+                self._postings[gram].append(field)
+
+    def search(self, query, top=25, threshold=THRESHOLD):
+        """
+        Returns a tuple consisting of the best (at most ``top``) matching
+        entities for the given query sorted by score, and how many other
+        entities scored above the threshold but were not returned.
+        """
+        grams = trigrams(query)
+        query = query.lower()
+        if len(query) < 3:
+            # Short queries share no inner trigrams with the text they're
+            # part of, so look at every field to find them as substrings.
+            common = Counter({i: 0 for i, field in enumerate(self._fields)
+                              if query in field[1]})
+        else:
+            common = Counter()
+        for gram in grams:
+            common.update(self._postings.get(gram, ()))
+
+        scores = {}
+        for field, count in common.items():
+            index, text, size = self._fields[field]
+            # Dice's coefficient between the trigrams of the query and field
+            score = 2 * count / (len(grams) + size)
+            if query in text:
+                # If query is a substring of the text, make it a good match.
+                # Slightly boost later entities (e.g. more recently active),
+                # so not all substring-matched ones have exactly the same score.
+                score = max(score, 0.75 + (index / len(self.entities)) / 25)
+            if score > scores.get(index, 0):
+                scores[index] = score
+
+        ranked = sorted(scores.items(), key=lambda t: t[1], reverse=True)
+        matches = [self.entities[i] for i, score in ranked if score > threshold]
+        return matches[:top], max(len(matches) - top, 0)
@@ -0,0 +1,119 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from telethon.tl import functions
+
+from telegram_export import utils
+from telegram_export.benchmarks.classification import \
+    baseline_action_to_name, baseline_get_media_type, make_messages, \
+    run_classify
+from telegram_export.benchmarks.database import DatabaseScenario, \
+    generate_database
+from telegram_export.benchmarks.export import make_config, run_export
+from telegram_export.benchmarks.fakeclient import FakeClient, Scenario
+from telegram_export.benchmarks.formatting import run_format
+from telegram_export.formatters import NAME_TO_FORMATTER, NlpFormatter, \
+    TextFormatter
+
+
+class TestExportBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.output)
+
+    def test_export(self):
+        scenario = Scenario(dialogs=4, messages=150, participants=20,
+                            admin_log=120)
+        client = FakeClient(scenario)
+        results = run_export(client, make_config(self.output))
+
+        self.assertEqual(results['messages'], 4 * 150)
+        self.assertEqual(results['requests'], client.requests)
+        self.assertGreater(results['db_bytes'], 0)
+        self.assertGreater(results['media_files'], 0)
+
+        # Generating the same chunk twice must produce the same messages
+        request = functions.messages.GetHistoryRequest(
+            peer=client.dialogs[1], offset_id=0, offset_date=None,
+            add_offset=0, limit=100, max_id=0, min_id=0, hash=0
+        )
+        self.assertEqual(
+            [m.to_dict() for m in client._get_history(request).messages],
+            [m.to_dict() for m in FakeClient(scenario)._get_history(
+                request).messages]
+        )
+
+    def test_classify(self):
+        results = run_classify(Scenario(dialogs=2, messages=500,
+                                        service_ratio=0.1), rounds=1)
+        self.assertEqual(results['messages'], 2 * 500)
+        self.assertGreater(results['media'], 0)
+        self.assertGreater(results['actions'], 0)
+        self.assertGreater(results['messages_per_second'], 0)
+        self.assertGreater(results['action_name_speedup'], 0)
+
+        # The classifier from before the registry is a faithful baseline
+        for message in make_messages(Scenario(dialogs=2, messages=500,
+                                              service_ratio=0.1)):
+            action = getattr(message, 'action', None)
+            if action:
+                self.assertEqual(baseline_action_to_name(action),
+                                 utils.action_to_name(action))
+            else:
+                self.assertEqual(baseline_get_media_type(message.media),
+                                 utils.get_media_type(message.media))
+
+    def test_generate_database(self):
+        path = os.path.join(self.output, 'synthetic.db')
+        results = generate_database(path, DatabaseScenario(
+            contexts=9, messages=3000, users=5, snapshots=2))
+        self.assertEqual(results['messages'], 3000)
+        with self.assertRaises(FileExistsError):
+            generate_database(path, DatabaseScenario())
+
+        formatter = TextFormatter(path)
+        contexts = list(formatter.iter_context_ids())
+        self.assertGreater(len(contexts), 1)
+        self.assertEqual(sum(formatter.dbconn.execute(
+            'SELECT COUNT(*) FROM Message WHERE ContextID = ?', (c,)
+        ).fetchone()[0] for c in contexts), 3000)
+        for context_id in contexts:
+            self.assertTrue(formatter.get_entity(context_id))
+
+        # The media has the same types the Dumper would save
+        self.assertEqual({row[0] for row in formatter.dbconn.execute(
+            'SELECT DISTINCT Type FROM Media')}, {'photo', 'document'})
+
+        # Users were saved twice and should have changed their name
+        user = formatter.get_user(1001)
+        old_user = formatter.get_user(1001, at_date=int(
+            user.date_updated.timestamp()) - 1)
+        self.assertNotEqual(user.first_name, old_user.first_name)
+
+        out = os.path.join(self.output, 'nlp.txt')
+        NlpFormatter(path).format(contexts[0], out)
+        self.assertGreater(os.path.getsize(out), 0)
+
+    def test_format(self):
+        # Every formatter, including those which write directories, has to
+        # work both discarding its output and saving it
+        path = os.path.join(self.output, 'synthetic.db')
+        generate_database(path, DatabaseScenario(
+            contexts=3, messages=300, users=5, snapshots=1))
+        for output in (None, os.path.join(self.output, 'formatted')):
+            results = run_format(path, output=output)
+            self.assertEqual(results['messages'], 300)
+            for name in NAME_TO_FORMATTER:
+                self.assertGreater(results[name + '_seconds'], 0)
+
+        columns = os.path.join(self.output, 'formatted', 'columns')
+        self.assertEqual(len(os.listdir(columns)), results['contexts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
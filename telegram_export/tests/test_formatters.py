@@ -0,0 +1,754 @@
+import configparser
+import gzip
+import io
+import json
+import os
+import shutil
+import socket
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from telethon.tl import types
+
+from telegram_export.benchmarks.database import DatabaseScenario, \
+    generate_database
+from telegram_export.benchmarks.export import make_config, run_export
+from telegram_export.benchmarks.fakeclient import FakeClient, Scenario
+from telegram_export.dumper import Dumper
+from telegram_export.formatters import BaseFormatter, ColumnFormatter, \
+    HtmlFormatter, JsonlFormatter, ManifestFormatter, StatsFormatter, \
+    TextFormatter
+from telegram_export.formatters import parallel, NlpFormatter
+from telegram_export.formatters.corpus import export_corpus, normalize
+from telegram_export.formatters.columnformatter import read_npy
+from telegram_export.formatters.entitycache import EntityCache
+from telegram_export.formatters.output import OutputWriter
+from telegram_export.formatters.reader import connect_reader
+from telegram_export.formatting import MessageEntity, encode_formatting
+
+
+def make_dumper():
+    config = configparser.ConfigParser()
+    config.read_dict({'Dumper': {
+        'OutputDirectory': '.', 'DBFileName': ':memory:',
+        'InvalidationTime': '0', 'ChunkSize': '100', 'MaxChunks': '0'
+    }})
+    return Dumper(config['Dumper'])
+
+
+def dump_user(dumper, user_id, name, timestamp):
+    dumper.dump_user(types.UserFull(
+        user=types.User(user_id, first_name=name),
+        link=None, notify_settings=None, common_chats_count=0
+    ), photo_id=None, timestamp=timestamp)
+
+
+class TestFormatters(unittest.TestCase):
+
+    def setUp(self):
+        self.dumper = make_dumper()
+        self.dumper.check_self_user(1)
+        self.context = 2
+        dump_user(self.dumper, 1, 'Me', 100)
+        dump_user(self.dumper, 2, 'Old name', 100)
+        dump_user(self.dumper, 2, 'Friend', 200)
+
+        date = datetime(2018, 1, 1)
+        for msg_id in range(1, 2501):
+            self.dumper.dump_message(types.Message(
+                msg_id, to_id=types.PeerUser(2),
+                date=date + timedelta(minutes=msg_id),
+                message='Message {}'.format(msg_id),
+                from_id=2 - msg_id % 2,
+                # Every message replies to the previous one in chains of ten
+                # (the first of which replies to a message never dumped).
+                reply_to_msg_id=msg_id - 1 if msg_id % 10 else 5000
+            ), self.context, forward_id=None, media_id=None)
+        self.dumper.commit()
+
+    def test_messages(self):
+        fmt = BaseFormatter(self.dumper.conn)
+        queries = []
+        fmt.dbconn.set_trace_callback(queries.append)
+        messages = list(fmt.get_messages_from_context(self.context,
+                                                      order='ASC'))
+        fmt.dbconn.set_trace_callback(None)
+
+        self.assertEqual([m.id for m in messages], list(range(1, 2501)))
+        self.assertLess(len(queries), 50)
+
+        message = messages[14]
+        self.assertEqual(message.text, 'Message 15')
+        self.assertEqual(message.from_user.first_name, 'Me')
+        self.assertTrue(message.out)
+        self.assertEqual(message.context.first_name, 'Friend')
+        self.assertEqual(message.reply_message.id, 14)
+        self.assertEqual(message.reply_message.from_user.first_name, 'Friend')
+        self.assertIsNone(message.reply_message.reply_message)
+        self.assertEqual(messages[9].reply_message, ())  # Not dumped
+        self.assertIsNone(messages[0].reply_message)
+
+        self.assertEqual(fmt.get_message_by_id(self.context, 15), message)
+        self.assertIsNone(fmt.get_message_by_id(self.context, 5000))
+
+    def test_reply_chains(self):
+        # A single chain as long as the whole context, and its last message
+        for msg_id in range(3000, 8001):
+            self.dumper.dump_message(types.Message(
+                msg_id, to_id=types.PeerUser(2), date=datetime(2018, 2, 1),
+                message=str(msg_id), reply_to_msg_id=msg_id - 1
+            ), self.context, forward_id=None, media_id=None)
+        self.dumper.commit()
+
+        fmt = BaseFormatter(self.dumper.conn, reply_depth=None)
+        message = fmt.get_message_by_id(self.context, 8000)
+        depth = 0
+        while message:
+            message = message.reply_message
+            depth += 1
+        self.assertEqual(depth, 8000 - 3000 + 1)
+        self.assertEqual(message, ())  # 2999 wasn't dumped
+
+        fmt = BaseFormatter(self.dumper.conn, reply_depth=3)
+        queries = []
+        fmt.dbconn.set_trace_callback(queries.append)
+        messages = list(fmt.get_messages_from_context(self.context,
+                                                      order='ASC'))
+        self.assertLess(len(queries), 50)
+        message = messages[-1].reply_message.reply_message.reply_message
+        self.assertEqual(message.id, 7997)
+        self.assertIsNone(message.reply_message)
+        self.assertEqual(message.reply_message_id, 7996)
+
+    def test_text(self):
+        fmt = TextFormatter(self.dumper.conn)
+        message = fmt.get_message_by_id(self.context, 22)
+        self.assertTrue(fmt.generate_message(message).startswith(
+            'Friend, [01.01.18 00.22.00]: (in reply to Me\'s: "Message 21")'))
+
+        # The URLs of the links are written after them
+        self.dumper.conn.execute(
+            'UPDATE Message SET Message = ?, Formatting = ? WHERE ID = 22',
+            ('\U0001f431 cats and dogs', encode_formatting([
+                MessageEntity('texturl', 3, 4, 'http://cats', None, None),
+                MessageEntity('bold', 12, 4, None, None, None)])))
+        fmt = TextFormatter(self.dumper.conn)
+        message = fmt.get_message_by_id(self.context, 22)
+        self.assertTrue(fmt.generate_message(message).endswith(
+            '\U0001f431 cats (http://cats) and dogs'))
+
+    def test_html(self):
+        self.dumper.conn.execute(
+            "INSERT INTO Media (ID, Name, MimeType, Type) "
+            "VALUES (7, 'cat.jpg', 'image/jpeg', 'photo')")
+        self.dumper.conn.execute(
+            'UPDATE Message SET MediaID = 7 WHERE ID >= 1500 AND ID < 1600')
+        directory = tempfile.mkdtemp()
+        try:
+            fmt = HtmlFormatter(self.dumper.conn, page_size=1000,
+                                media_fmt='media/{name}/{filename}',
+                                media_root=directory)
+            queries = []
+            fmt.dbconn.set_trace_callback(queries.append)
+            fmt.format(self.context, directory)
+            fmt.dbconn.set_trace_callback(None)
+            # The media of the 100 messages is fetched at once (and only the
+            # second page has any)
+            self.assertEqual(sum('FROM Media' in q for q in queries), 1)
+            fmt.format_index(directory)
+            pages = os.path.join(directory, str(self.context))
+            self.assertEqual(sorted(os.listdir(pages)), [
+                'index.html', 'page-1.html', 'page-2.html', 'page-3.html'])
+
+            with open(os.path.join(pages, 'page-2.html')) as f:
+                page = f.read()
+            self.assertEqual(page.count('class="message"'), 1000)
+            self.assertIn('id="m1001"', page)
+            self.assertIn('href="page-1.html"', page)
+            self.assertIn('href="page-3.html"', page)
+            self.assertIn('href="../media/Friend/cat.7.jpg"', page)
+            # Replies link to the messages on the same page only
+            self.assertIn('href="#m1001"', page)
+            self.assertNotIn('href="#m1000"', page)
+
+            with open(os.path.join(pages, 'page-3.html')) as f:
+                page = f.read()
+            self.assertEqual(page.count('class="message"'), 500)
+            self.assertNotIn('href="page-4.html"', page)
+
+            with open(os.path.join(directory, 'index.html')) as f:
+                self.assertIn('href="2/index.html">Friend</a>', f.read())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_html_entities(self):
+        text = '\U0001f431 cats & dogs\nfrom @owner'
+        self.assertEqual(HtmlFormatter.generate_text_html(text, [
+            MessageEntity('bold', 0, 14, None, None, None),
+            MessageEntity('texturl', 3, 4, 'http://cats', None, None),
+            MessageEntity('italic', 10, 4, None, None, None),
+            MessageEntity('mention', 20, 6, None, None, None),
+            MessageEntity('texturl', 15, 4, 'javascript:alert(1)', None, None)
+        ]), '<b>\U0001f431 <a href="http://cats">cats</a> &amp; <i>dogs</i>'
+            '</b><br>\nfrom <a href="https://t.me/owner">@owner</a>')
+
+    def test_manifest(self):
+        conn = self.dumper.conn
+        conn.execute("INSERT INTO Media (ID, Name, MimeType, Size, Type) "
+                     "VALUES (7, 'cat.jpg', 'image/jpeg', 10, 'photo'), "
+                     "(8, NULL, 'video/mp4', 20, 'document.video'), "
+                     "(9, NULL, NULL, NULL, 'geo'), "
+                     "(10, NULL, 'image/jpeg', 30, 'chatphoto'), "
+                     "(11, NULL, 'image/jpeg', 40, 'chatphoto')")
+        for msg_id, media_id in ((1500, 7), (1501, 8), (1502, 9)):
+            conn.execute('UPDATE Message SET MediaID = ? WHERE ID = ?',
+                         (media_id, msg_id))
+        # The pictures of users are in their context, even without messages
+        dump_user(self.dumper, 3, 'Stranger', 300)
+        conn.execute('UPDATE User SET PictureID = 10 WHERE ID = 2')
+        conn.execute('UPDATE User SET PictureID = 11 WHERE ID = 3')
+
+        directory = tempfile.mkdtemp()
+        try:
+            fmt = ManifestFormatter(conn, media_fmt='{name}/{type}-{filename}',
+                                    media_root=directory)
+            cat = os.path.join(directory, 'Friend', 'photo-cat.7.jpg')
+            os.makedirs(os.path.dirname(cat))
+            open(cat, 'w').close()
+
+            fmt.format_all(directory, [self.context])
+            with open(os.path.join(directory, str(self.context))) as a, \
+                    open(os.path.join(directory, 'manifest.csv')) as b:
+                rows = a.read().splitlines()
+                self.assertEqual(b.read().splitlines(), rows)
+            fmt.format(self.context, directory)
+            with open(os.path.join(directory, str(self.context))) as f:
+                self.assertEqual(f.read().splitlines(), rows)
+
+            # Unnamed media is named after the date it was sent, in UTC
+            date = datetime.utcfromtimestamp((datetime(2018, 1, 1) + timedelta(
+                minutes=1501)).timestamp())
+            video = os.path.join(directory, 'Friend', date.strftime(
+                'video-video_%Y-%m-%d_%H-%M-%S.8.mp4'))
+            self.assertEqual(rows, [
+                'context_id,message_id,media_id,type,path,size,present',
+                '2,,10,chatphoto,,30,0',  # Saved before any message
+                '2,1500,7,photo,{},10,1'.format(cat),
+                '2,1501,8,document.video,{},20,0'.format(video),
+                '2,1502,9,geo,,,0'
+            ])
+
+            # Every context with messages gets its own manifest, and all the
+            # media is in the manifest of all of them
+            fmt.format_all(directory)
+            self.assertFalse(os.path.exists(os.path.join(directory, '3')))
+            with open(os.path.join(directory, 'manifest.csv')) as f:
+                self.assertEqual(f.read().splitlines(),
+                                 rows + ['3,,11,chatphoto,,40,0'])
+
+            # The formatters link to the same paths
+            message = fmt.get_message_by_id(self.context, 1500)
+            self.assertEqual(fmt.get_media_path(
+                message, fmt.get_media(7)), cat)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_jsonl(self):
+        conn = self.dumper.conn
+        conn.execute("INSERT INTO Media (ID, Name, MimeType, Size, Type) "
+                     "VALUES (7, 'cat.jpg', 'image/jpeg', 10, 'photo')")
+        conn.execute("INSERT INTO Forward VALUES (3, 0, 2, NULL, NULL)")
+        conn.execute("UPDATE Message SET MediaID = 7, ForwardID = 3, "
+                     "Formatting = 'bold,0,7;texturl,0,3,http://a%2cb' "
+                     "WHERE ID = 20")
+
+        output = io.StringIO()
+        fmt = JsonlFormatter(conn)
+        fmt.format(self.context, output, from_user_id=2,
+                   end_date=datetime(2018, 1, 1, 0, 30))
+        messages = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual([m['id'] for m in messages], list(range(2, 30, 2)))
+        message = messages[9]
+        self.assertEqual(message['sender']['first_name'], 'Friend')
+        self.assertEqual(message['reply_to_id'], 5000)
+        self.assertEqual(message['media']['size'], 10)
+        self.assertEqual(message['forward']['from_id'], 2)
+        self.assertEqual(message['entities'], [
+            {'kind': 'bold', 'offset': 0, 'length': 7},
+            {'kind': 'texturl', 'offset': 0, 'length': 3,
+             'url': 'http://a%2cb'}  # Older versions left it escaped
+        ])
+
+        directory = tempfile.mkdtemp()
+        try:
+            JsonlFormatter(conn, shard_size=1000).format(
+                self.context, directory)
+            shards = os.path.join(directory, str(self.context))
+            self.assertEqual(sorted(os.listdir(shards)), [
+                'part-00000.jsonl', 'part-00001.jsonl', 'part-00002.jsonl'])
+            with open(os.path.join(shards, 'part-00002.jsonl')) as f:
+                self.assertEqual(len(f.readlines()), 500)
+
+            JsonlFormatter(conn, shard_size=2000).format(
+                self.context, directory)
+            self.assertEqual(len(os.listdir(shards)), 2)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_columns(self):
+        self.dumper.conn.execute(
+            "UPDATE Message SET Message = 'héllo', ViewCount = 3 "
+            "WHERE ID = 2")
+        self.dumper.conn.execute(
+            'UPDATE Message SET Message = NULL WHERE ID = 3')
+        directory = tempfile.mkdtemp()
+        try:
+            ColumnFormatter(self.dumper.conn).format(self.context, directory)
+            columns = os.path.join(directory, str(self.context))
+
+            def column(name):
+                return read_npy(os.path.join(columns, name + '.npy'))
+
+            self.assertEqual(list(column('id')), list(range(1, 2501)))
+            self.assertEqual(set(column('context_id')), {self.context})
+            self.assertEqual(column('date')[1] - column('date')[0], 60)
+            self.assertEqual(list(column('from_id')[:4]), [1, 2, 1, 2])
+            self.assertEqual(list(column('reply_message_id')[9:12]),
+                             [5000, 10, 11])
+            self.assertEqual(list(column('view_count')[:3]), [0, 3, 0])
+
+            text, offsets = column('text'), column('text_offsets')
+            self.assertEqual(len(offsets), 2501)
+
+            def message(i):
+                return bytes(text[offsets[i]:offsets[i + 1]]).decode()
+
+            self.assertEqual(message(0), 'Message 1')
+            self.assertEqual(message(1), 'héllo')
+            self.assertEqual(message(2), '')
+            self.assertEqual(message(2499), 'Message 2500')
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stats(self):
+        conn = self.dumper.conn
+        conn.execute("INSERT INTO Media (ID, Name, MimeType, Size, Type) "
+                     "VALUES (7, 'cat.jpg', 'image/jpeg', 10, 'photo')")
+        conn.execute("UPDATE Message SET MediaID = 7 WHERE ID <= 3")
+        conn.execute("UPDATE Message SET ForwardID = 1 WHERE ID > 2000")
+
+        output = io.StringIO()
+        fmt = StatsFormatter(conn, report='json', utc_offset=3600)
+        fmt.format(self.context, output)
+        stats = json.loads(output.getvalue())
+        self.assertEqual(stats['name'], 'Friend')
+        self.assertEqual(stats['messages'], 2500)
+        self.assertEqual(stats['reply_ratio'], 1)
+        self.assertEqual(stats['forward_ratio'], 0.2)
+        self.assertEqual(sorted((s['name'], s['messages'])
+                                for s in stats['top_senders']),
+                         [('Friend', 1250), ('Me', 1250)])
+        self.assertEqual(stats['media_types'], [
+            {'type': 'photo', 'messages': 3, 'bytes': 30}])
+        self.assertEqual(stats['growth'][-1]['total'], 2500)
+
+        # The bins are the same as with the dates of every message
+        heatmap = [[0] * 24 for _ in range(7)]
+        for (date,) in conn.execute('SELECT Date FROM Message'):
+            date = datetime.utcfromtimestamp(date + 3600)
+            heatmap[date.weekday()][date.hour] += 1
+        self.assertEqual(stats['heatmap'], heatmap)
+        self.assertEqual(sum(stats['hours']), 2500)
+
+        directory = tempfile.mkdtemp()
+        try:
+            fmt = StatsFormatter(conn)
+            fmt.format(self.context, directory)
+            fmt.format_index(directory)
+            with open(os.path.join(directory, str(self.context))) as a, \
+                    open(os.path.join(directory, 'stats.txt')) as b:
+                self.assertEqual(a.read().split('\n')[2:],
+                                 b.read().split('\n')[2:])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_corpus(self):
+        conn = self.dumper.conn
+        # Near-identical messages are left out, like every "Message <ID>"
+        conn.execute("UPDATE Message SET Message = 'Check https://t.me/' || "
+                     "ID || ' NOW!' WHERE ID <= 10")
+        conn.execute("UPDATE Message SET Message = 'Word ' || "
+                     "char(65 + (ID - 1001) % 26, 65 + (ID - 1001) / 26) "
+                     "WHERE ID > 1000 AND ID <= 1676")
+        directory = tempfile.mkdtemp()
+        try:
+            fmt = NlpFormatter(conn)
+            counts = fmt.export_corpus(directory, range_rows=1000,
+                                       shard_size=1000)
+            self.assertEqual(counts, {'written': 678, 'duplicate': 1822})
+            lines = []
+            for name in sorted(os.listdir(directory)):
+                with open(os.path.join(directory, name)) as f:
+                    text = f.read()
+                self.assertLessEqual(len(text), 1000)
+                lines.extend(text.splitlines())
+            self.assertEqual(len(lines), 678)
+            self.assertEqual(lines[:3], [
+                'Check https://t.me/1 NOW!', 'Message 11', 'Word AA'])
+
+            counts = fmt.export_corpus(directory, [self.context],
+                                       min_length=8)
+            self.assertEqual(counts, {'written': 2, 'duplicate': 1822,
+                                      'short': 676})
+            self.assertEqual(os.listdir(directory), ['part-00000-000.txt'])
+            self.assertFalse(fmt.export_corpus(directory, [3]))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_near_duplicates(self):
+        text = ('The meeting is moved to the {} room on the second floor, '
+                'bring your laptops and the printed slides please')
+        for i, size in enumerate(('big', 'small', 'big')):
+            self.dumper.conn.execute(
+                'UPDATE Message SET Message = ? WHERE ID = ?',
+                (text.format(size), 11 + i))
+        self.dumper.conn.execute(
+            "UPDATE Message SET Message = 'Lunch is at noon in the "
+            "cafeteria, and everyone is welcome to join us after the "
+            "meeting' WHERE ID = 14")
+        directory = tempfile.mkdtemp()
+        try:
+            NlpFormatter(self.dumper.conn).export_corpus(
+                directory, [self.context], min_length=20)
+            with open(os.path.join(directory, 'part-00000-000.txt')) as f:
+                self.assertEqual(f.read().splitlines()[:2], [
+                    text.format('big'), 'Lunch is at noon in the cafeteria, '
+                    'and everyone is welcome to join us after the meeting'])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_checkpoints(self):
+        directory = tempfile.mkdtemp()
+        try:
+            fmt = TextFormatter(self.dumper.conn, checkpoints=os.path.join(
+                directory, 'checkpoints.db'))
+            path = os.path.join(directory, str(self.context))
+            fresh = os.path.join(directory, 'fresh')
+
+            def check(resumed):
+                self.assertEqual(fmt._can_resume(
+                    self.context, path,
+                    fmt.checkpoints.get('text', self.context)
+                ), resumed)
+                fmt.format(self.context, path)
+                TextFormatter(self.dumper.conn).format(self.context, fresh)
+                with open(path) as a, open(fresh) as b:
+                    self.assertEqual(a.read(), b.read())
+
+            check(resumed=False)
+            check(resumed=True)
+
+            # New messages are appended to what was formatted before
+            date = datetime(2018, 1, 1)
+            for msg_id in (2501, 2502):
+                self.dumper.dump_message(types.Message(
+                    msg_id, to_id=types.PeerUser(2), message='New',
+                    date=date + timedelta(minutes=msg_id), from_id=2
+                ), self.context, forward_id=None, media_id=None)
+            check(resumed=True)
+
+            # Editing an old message (or the last one) formats all again
+            for msg_id in (10, 2502):
+                self.dumper.dump_message(types.Message(
+                    msg_id, to_id=types.PeerUser(2), message='Edited',
+                    date=date + timedelta(minutes=msg_id), from_id=2
+                ), self.context, forward_id=None, media_id=None)
+                check(resumed=False)
+            check(resumed=True)
+
+            # And so does changing the output
+            with open(path, 'a') as f:
+                f.write('\n')
+            check(resumed=False)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dump_again(self):
+        # Dumping the same message again keeps it (and its rowid) as it was,
+        # even if its forward header is saved again with a new ID, and its
+        # media (which can't be found by its location) is found as it was
+        def dump(views):
+            message = types.Message(
+                3000, to_id=types.PeerUser(2), date=datetime(2018, 2, 1),
+                message='', views=views, fwd_from=types.MessageFwdHeader(
+                    date=datetime(2018, 1, 1), from_id=1),
+                media=types.MessageMediaGeo(types.GeoPoint(1.5, 2.5, 0)))
+            self.dumper.dump_message(
+                message, self.context,
+                forward_id=self.dumper.dump_forward(message.fwd_from),
+                media_id=self.dumper.dump_media(message.media))
+            return self.dumper.conn.execute(
+                'SELECT rowid, ForwardID, MediaID FROM Message WHERE ID = 3000'
+            ).fetchone()
+
+        def count(table):
+            return self.dumper.conn.execute(
+                'SELECT COUNT(*) FROM {}'.format(table)).fetchone()[0]
+
+        first = dump(10)
+        self.assertEqual(dump(10), first)
+        self.assertEqual((count('Forward'), count('Media')), (1, 1))
+
+        # But it's replaced if anything changed
+        self.assertNotEqual(dump(11)[0], first[0])
+
+    def test_checkpoints_filters(self):
+        # Output formatted with some filters isn't continued with others
+        directory = tempfile.mkdtemp()
+        try:
+            fmt = JsonlFormatter(self.dumper.conn, checkpoints=os.path.join(
+                directory, 'checkpoints.db'))
+            path = os.path.join(directory, str(self.context))
+
+            def lines(**filters):
+                fmt.format(self.context, path, **filters)
+                with open(path) as f:
+                    return len(f.readlines())
+
+            self.assertEqual(lines(from_user_id=1), 1250)
+            self.assertEqual(lines(), 2500)
+            self.assertEqual(lines(start_date=datetime(2018, 1, 2)), 1060)
+            checkpoint = fmt.checkpoints.get('jsonl', self.context)
+            self.assertTrue(fmt._can_resume(
+                self.context, path, checkpoint, checkpoint.filters))
+            self.assertFalse(fmt._can_resume(self.context, path, checkpoint))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_checkpoints_redump(self):
+        # Every export fetches the newest chunk again, which mustn't count
+        # as the messages in it having changed if they didn't
+        directory = tempfile.mkdtemp()
+        try:
+            scenario = Scenario(dialogs=4, messages=150, participants=10,
+                                admin_log=0)
+            run_export(FakeClient(scenario), make_config(directory))
+            db = os.path.join(directory, 'export.db')
+            fmt = TextFormatter(db, checkpoints=os.path.join(
+                directory, 'checkpoints.db'))
+            contexts = list(fmt.iter_context_ids())
+            self.assertEqual(len(contexts), 4)
+            for context_id in contexts:
+                fmt.format(context_id, os.path.join(directory, str(context_id)))
+
+            scenario.messages = 155
+            run_export(FakeClient(scenario), make_config(directory))
+            for context_id in contexts:
+                path = os.path.join(directory, str(context_id))
+                self.assertTrue(fmt._can_resume(
+                    context_id, path, fmt.checkpoints.get('text', context_id)))
+                fmt.format(context_id, path)
+                fresh = io.StringIO()
+                TextFormatter(db).format(context_id, fresh)
+                with open(path) as f:
+                    self.assertEqual(f.read(), fresh.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+    def test_search(self):
+        fmt = BaseFormatter(self.dumper.conn)
+        with self.assertRaises(ValueError):
+            fmt.search('message')
+
+        # Messages dumped before the index existed need a rebuild
+        self.dumper.rebuild_search_index(batch_size=1000)
+        hit, = fmt.search('1234')
+        self.assertEqual(hit.message.id, 1234)
+        self.assertEqual(hit.snippet, 'Message [1234]')
+        hits = fmt.search('message', context_id=self.context, limit=5,
+                          start_date=datetime(2018, 1, 1, 1, 0),
+                          end_date=datetime(2018, 1, 1, 1, 10))
+        self.assertEqual(len(hits), 5)
+        self.assertTrue(all(60 < h.message.id < 70 for h in hits))
+        self.assertFalse(fmt.search('message', context_id=3))
+
+        # New and edited messages are indexed as they're dumped
+        self.dumper.search_index = True
+        date = datetime(2018, 1, 1)
+        for msg_id, text in ((2501, 'Needle'), (2501, 'Edited'),
+                             (1234, 'Needle')):
+            self.dumper.dump_message(types.Message(
+                msg_id, to_id=types.PeerUser(2), message=text,
+                date=date + timedelta(minutes=msg_id), from_id=2
+            ), self.context, forward_id=None, media_id=None)
+        self.assertEqual([h.message.id for h in fmt.search('needle')], [1234])
+        self.assertEqual([h.message.id for h in fmt.search('edited')], [2501])
+        self.assertFalse(fmt.search('1234'))
+        self.assertEqual(self.dumper.conn.execute(
+            'SELECT COUNT(*) FROM MessageSearch').fetchone()[0], 2501)
+
+    def test_output(self):
+        fmt = TextFormatter(self.dumper.conn)
+        text = io.StringIO()
+        fmt.format(self.context, text)
+        lines = text.getvalue().splitlines()
+        self.assertEqual(lines[0], '== Conversation with "Friend" ==')
+        self.assertEqual(len(lines), 2501)
+
+        binary = io.BytesIO()
+        fmt.format(self.context, binary)
+        self.assertEqual(binary.getvalue().decode(), text.getvalue())
+
+        compressed = io.BytesIO()
+        fmt.format(self.context, compressed, compression='gzip')
+        self.assertEqual(gzip.decompress(compressed.getvalue()).decode(),
+                         text.getvalue())
+
+        directory = tempfile.mkdtemp()
+        try:
+            fmt.format(self.context, directory, compression='gzip')
+            with gzip.open(os.path.join(directory, '2.gz'), 'rt') as f:
+                self.assertEqual(f.read(), text.getvalue())
+        finally:
+            shutil.rmtree(directory)
+
+        a, b = socket.socketpair()
+        with a, b:
+            fmt.format(self.context, a)
+            a.shutdown(socket.SHUT_WR)
+            received = b''.join(iter(lambda: b.recv(65536), b''))
+        self.assertEqual(received.decode(), text.getvalue())
+
+        with self.assertRaises(TypeError):
+            fmt.format(self.context, object())
+
+    def test_output_buffer(self):
+        writes = []
+        sink = io.BytesIO()
+        sink.write = writes.append
+        with OutputWriter(sink, buffer_size=10) as output:
+            output.writelines(['abc'] * 7)
+            self.assertEqual(writes, [b'abcabcabcabc'])
+            output.write('de')
+        self.assertEqual(writes, [b'abcabcabcabc', b'abcabcabcde'])
+        self.assertFalse(sink.closed)
+
+    def test_entity_versions(self):
+        chat = types.Chat(123, title='Title', photo=types.ChatPhotoEmpty(),
+                          participants_count=7, date=None, version=1)
+        for month in range(1, 13):
+            chat.title = 'Title {}'.format(month)
+            self.dumper.dump_chat(chat, None, timestamp=int(datetime(
+                year=2010, month=month, day=1).timestamp()))
+        self.dumper.commit()
+
+        fmt = BaseFormatter(self.dumper.conn)
+        queries = []
+        fmt.dbconn.set_trace_callback(queries.append)
+        self.assertEqual(fmt.get_chat(-123).title, 'Title 12')
+        self.assertEqual(fmt.get_chat(-123, datetime(2010, 6, 29)).title,
+                         'Title 6')
+        self.assertEqual(fmt.get_chat(-123, datetime(2010, 6, 1)).title,
+                         'Title 6')
+        self.assertEqual(fmt.get_chat(123, datetime(2009, 12, 1)).title,
+                         'Title 1')
+        self.assertIsNone(fmt.get_chat(-456))
+        self.assertIsNone(fmt.get_chat(-456))
+        self.assertEqual(len(queries), 2)
+
+        # Changes are seen only after invalidating the cache
+        chat.title = 'New'
+        self.dumper.dump_chat(chat, None, timestamp=int(datetime(
+            year=2011, month=1, day=1).timestamp()))
+        self.dumper.commit()
+        self.assertEqual(fmt.get_chat(-123).title, 'Title 12')
+        fmt.invalidate_cache(-123)
+        self.assertEqual(fmt.get_chat(-123).title, 'New')
+        self.assertEqual(fmt.get_user(2, 150).first_name, 'Old name')
+
+    def test_entity_cache(self):
+        cache = EntityCache(max_rows=4)
+        cache.put('a', [1, 2, 3], ['a1', 'a2', 'a3'])
+        cache.put('b', [], [])
+        self.assertEqual(cache.at_date(*cache.get('a'), at_date=2), 'a2')
+        cache.put('c', [5], ['c5'])  # Too many, "b" wasn't used recently
+        self.assertNotIn('b', cache)
+        self.assertIn('a', cache)
+        self.assertEqual((cache.hits, cache.misses), (1, 0))
+        cache.put('d', [1, 2, 3, 4], ['d1', 'd2', 'd3', 'd4'])
+        self.assertEqual(len(cache), 1)
+        self.assertIsNone(cache.get('a'))
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+
+
+class TestParallel(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.db = os.path.join(self.dir, 'export.db')
+        generate_database(self.db, DatabaseScenario(contexts=12,
+                                                    messages=5000))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_parallel(self):
+        sizes = parallel.context_sizes(self.db)
+        self.assertEqual(sum(count for _, count in sizes), 5000)
+        self.assertEqual([count for _, count in sizes],
+                         sorted((count for _, count in sizes), reverse=True))
+
+        one, many = os.path.join(self.dir, '1'), os.path.join(self.dir, '2')
+        os.mkdir(one)
+        os.mkdir(many)
+        formatter = TextFormatter(self.db)
+        for cid, _ in sizes:
+            formatter.format(cid, one)
+        done = list(parallel.format_contexts('text', self.db, many, sizes,
+                                             jobs=2))
+        self.assertEqual(sorted(done), sorted(sizes))
+        for cid, _ in sizes:
+            with open(os.path.join(one, str(cid))) as a, \
+                    open(os.path.join(many, str(cid))) as b:
+                self.assertEqual(a.read(), b.read())
+
+    def test_reader(self):
+        # Paths with characters that mean something else in an URI work too
+        path = os.path.join(self.dir, 'a #1?.db')
+        shutil.copy(self.db, path)
+        for immutable in (False, True):
+            conn = connect_reader(path, immutable=immutable)
+            self.assertEqual(conn.execute(
+                'SELECT COUNT(*) FROM Message').fetchone()[0], 5000)
+            self.assertEqual(conn.execute(
+                'PRAGMA query_only').fetchone()[0], 1)
+            with self.assertRaises(sqlite3.OperationalError):
+                conn.execute('DELETE FROM Message')
+            conn.close()
+
+        fmt = TextFormatter(path, immutable=True)
+        self.assertEqual(len(list(fmt.iter_context_ids())), 12)
+
+    def test_corpus(self):
+        one, many = os.path.join(self.dir, '1'), os.path.join(self.dir, '2')
+        counts = export_corpus(self.db, one, range_rows=500)
+        self.assertEqual(export_corpus(self.db, many, jobs=2, range_rows=500),
+                         counts)
+        self.assertEqual(counts['written'] + counts['duplicate'],
+                         sum(counts.values()))
+
+        def read(directory):
+            lines = []
+            for name in os.listdir(directory):
+                with open(os.path.join(directory, name)) as f:
+                    lines.extend(map(normalize, f.read().splitlines()))
+            return sorted(lines)
+        self.assertEqual(len(read(one)), counts['written'])
+        self.assertEqual(read(one), read(many))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import logging
+import unittest
+
+from telegram_export.metrics import Metrics, Histogram, FloodWaitCounter
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_histogram(self):
+        histogram = Histogram(buckets=(1, 5))
+        for value in (0.5, 1, 3, 10):
+            histogram.observe(value)
+        self.assertEqual(histogram.cumulative(),
+                         [(1, 2), (5, 3), (float('inf'), 4)])
+        self.assertEqual(histogram.count, 4)
+        self.assertEqual(histogram.sum, 14.5)
+
+    def test_prometheus(self):
+        metrics = Metrics()
+        metrics.inc('requests_total', request='GetHistoryRequest')
+        metrics.inc('requests_total', 2, request='GetHistoryRequest')
+        metrics.set('queue_size', lambda: 7, queue='media')
+        metrics.observe('commit_seconds', 0.2)
+
+        text = metrics.to_prometheus()
+        self.assertIn('# TYPE telegram_export_requests_total counter\n'
+                      'telegram_export_requests_total'
+                      '{request="GetHistoryRequest"} 3.0\n', text)
+        self.assertIn('telegram_export_queue_size{queue="media"} 7\n', text)
+        self.assertIn('telegram_export_commit_seconds_bucket{le="0.1"} 0\n',
+                      text)
+        self.assertIn('telegram_export_commit_seconds_bucket{le="+Inf"} 1\n',
+                      text)
+        self.assertIn('telegram_export_commit_seconds_count 1\n', text)
+
+        summary = metrics.to_dict()
+        self.assertEqual(summary['gauges']['queue_size'],
+                         [{'labels': {'queue': 'media'}, 'value': 7}])
+        self.assertEqual(summary['histograms']['commit_seconds'][0]['mean'],
+                         0.2)
+
+    def test_flood_wait_counter(self):
+        metrics = Metrics()
+        counter = FloodWaitCounter(metrics, logging.WARNING)
+        record = logging.LogRecord('telethon.client.users', logging.INFO, '',
+                                   0, 'Sleeping for %ds on flood wait',
+                                   (12,), None)
+        # Counted, but not let through since it's below the original level
+        self.assertFalse(counter.filter(record))
+        self.assertEqual(metrics.counters[('flood_waits_total', ())], 1)
+        self.assertEqual(metrics.counters[('flood_wait_seconds_total', ())],
+                         12)
+
+
+if __name__ == '__main__':
+    unittest.main()
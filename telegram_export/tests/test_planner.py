@@ -0,0 +1,81 @@
+import asyncio
+import io
+import shutil
+import tempfile
+import unittest
+
+from telegram_export.benchmarks.export import make_config, run_export
+from telegram_export.benchmarks.fakeclient import FakeClient, Scenario
+from telegram_export.dumper import Dumper
+from telegram_export.exporter import Exporter
+from telegram_export.planner import print_plan
+
+
+class TestPlanner(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.scenario = Scenario(dialogs=4, messages=1000, participants=450)
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self):
+        self.loop.close()
+        shutil.rmtree(self.output)
+
+    def plan(self, **settings):
+        config = make_config(self.output)
+        config['Dumper'].update(settings)
+        asyncio.set_event_loop(self.loop)
+        exporter = Exporter(FakeClient(self.scenario), config,
+                            Dumper(config['Dumper']), self.loop)
+        try:
+            return self.loop.run_until_complete(exporter.plan())
+        finally:
+            exporter.dumper.conn.close()
+
+    def test_plan(self):
+        plans = self.plan()
+        self.assertEqual([p.remaining for p in plans], [1000] * 4)
+        # Nothing dumped yet, so there's nothing to estimate the media from
+        self.assertEqual([p.media_files for p in plans], [0] * 4)
+        self.assertEqual(plans[0].requests, 1000 // 100 + 1)
+        # Participants of the chat (3 requests) and admin log of channels
+        self.assertEqual(plans[1].requests, 11 + 3)
+        self.assertEqual(plans[3].requests, 11 + 1)
+
+        config = make_config(self.output)
+        config['Dumper']['MaxChunks'] = '3'
+        run_export(FakeClient(self.scenario), config)
+
+        plans = self.plan()
+        self.assertEqual([p.dumped for p in plans], [300] * 4)
+        self.assertEqual([p.remaining for p in plans], [700] * 4)
+        self.assertTrue(all(p.media_files and p.media_bytes for p in plans))
+        self.assertTrue(all(p.seconds >= 8 for p in plans))
+
+        self.assertEqual([p.remaining for p in self.plan(MaxChunks='2')],
+                         [200] * 4)
+        self.assertEqual([p.media_files for p in self.plan(MaxSize='0')],
+                         [0] * 4)
+
+        out = io.StringIO()
+        print_plan(plans, file=out)
+        self.assertIn('2800', out.getvalue().splitlines()[-1])
+
+        # Once finished, what's left are the messages newer than the last
+        # dump, even those dumped since (e.g. while watching), because the
+        # newest chunks are fetched again down to where it finished
+        run_export(FakeClient(self.scenario), make_config(self.output))
+        self.assertEqual([p.remaining for p in self.plan()], [0] * 4)
+        dumper = Dumper(make_config(self.output)['Dumper'])
+        dumper.conn.execute('INSERT INTO Message (ID, ContextID, Date) '
+                            'VALUES (1001, ?, 0)', (plans[0].id,))
+        dumper.commit()
+        dumper.conn.close()
+
+        self.scenario.messages = 1030
+        self.assertEqual([p.remaining for p in self.plan()], [30] * 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
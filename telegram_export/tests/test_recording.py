@@ -0,0 +1,80 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from telethon.errors import FloodWaitError, ChatAdminRequiredError
+from telethon.tl import types
+
+from telegram_export.benchmarks.export import make_config, run_export
+from telegram_export.benchmarks.fakeclient import FakeClient, Scenario
+from telegram_export.recording import (
+    RecordingClient, ReplayClient, scrub, scrub_string, encode_value,
+    decode_value, error_to_dict, error_from_dict
+)
+
+
+class TestRecording(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_scrub(self):
+        text = 'Hello \U0001F600 world'
+        scrubbed = scrub_string(text)
+        self.assertNotIn('Hello', scrubbed)
+        self.assertEqual(scrubbed, scrub_string(text))
+        self.assertEqual(len(scrubbed.encode('utf-16-le')),
+                         len(text.encode('utf-16-le')))
+        self.assertEqual(scrubbed.index(' '), 5)
+
+        user = types.User(5, first_name='John', phone='123456')
+        message = types.Message(1, message='secret', entities=[
+            types.MessageEntityTextUrl(0, 6, 'https://example.com')])
+        scrub([user, message], {'first_name', 'message', 'url'})
+        self.assertNotEqual(user.first_name, 'John')
+        self.assertEqual(user.phone, '123456')
+        self.assertNotEqual(message.message, 'secret')
+        self.assertNotEqual(message.entities[0].url, 'https://example.com')
+
+    def test_values(self):
+        value = [types.User(5, first_name='John'), types.PeerChat(7)]
+        decoded, end = decode_value(encode_value(value))
+        self.assertEqual([bytes(x) for x in decoded],
+                         [bytes(x) for x in value])
+        self.assertEqual(decode_value(encode_value({'a': 1}))[0], {'a': 1})
+
+        error = error_from_dict(error_to_dict(FloodWaitError(None, capture=31)), None)
+        self.assertIsInstance(error, FloodWaitError)
+        self.assertEqual(error.seconds, 31)
+        self.assertIsInstance(error_from_dict(error_to_dict(
+            ChatAdminRequiredError(None)), None), ChatAdminRequiredError)
+
+    def test_record_replay(self):
+        path = os.path.join(self.dir, 'session.rec')
+        os.makedirs(os.path.join(self.dir, 'recorded'))
+        os.makedirs(os.path.join(self.dir, 'replayed'))
+
+        config = make_config(os.path.join(self.dir, 'recorded'), chunk_size=50)
+        client = RecordingClient(
+            FakeClient(Scenario(dialogs=4, messages=120, participants=10)),
+            path, scrub=['names'], config=config['Dumper']
+        )
+        recorded = run_export(client, config)
+
+        client = ReplayClient(path)
+        self.assertEqual(client.header['settings']['ChunkSize'], '50')
+        config = make_config(os.path.join(self.dir, 'replayed'))
+        config['Dumper'].update(client.header['settings'])
+        replayed = run_export(client, config)
+
+        self.assertEqual(replayed['messages'], recorded['messages'])
+        self.assertEqual(replayed['media_files'], recorded['media_files'])
+        self.assertEqual(replayed['media_bytes'], recorded['media_bytes'])
+
+
+if __name__ == '__main__':
+    unittest.main()
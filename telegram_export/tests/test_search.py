@@ -0,0 +1,107 @@
+import configparser
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from telegram_export.dumper import Dumper
+from telegram_export.search import EntityIndex, Entity, trigrams
+
+
+class TestEntityIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = EntityIndex([
+            Entity(1, 'John Smith', 'jsmith', '441234567'),
+            Entity(2, 'Jane Doe', None, None),
+            Entity(-1001234, 'Python Programmers', 'pythonprog', None),
+            Entity(-55, 'Weekend plans', None, None),
+        ])
+
+    def test_trigrams(self):
+        self.assertEqual(trigrams('Ab'), {'  a', ' ab', 'ab '})
+        self.assertEqual(trigrams(' a  B '), trigrams('a b'))
+
+    def test_search(self):
+        found, not_shown = self.index.search('smith')
+        self.assertEqual([e.id for e in found], [1])
+        self.assertEqual(not_shown, 0)
+
+        # Usernames and phones are searched too
+        self.assertEqual(self.index.search('pythonprog')[0][0].id, -1001234)
+        self.assertEqual(self.index.search('4412345')[0][0].id, 1)
+
+        # Queries too short to share trigrams still match as substrings
+        self.assertEqual([e.id for e in self.index.search('nd')[0]], [-55])
+
+        # Slight typos still rank the right entity first
+        self.assertEqual(self.index.search('Pyhton Programers')[0][0].id,
+                         -1001234)
+
+        self.assertEqual(self.index.search('zzzzz'), ([], 0))
+
+    def test_search_top(self):
+        found, not_shown = self.index.search('j', top=1)
+        self.assertEqual(len(found), 1)
+        self.assertEqual(not_shown, 1)
+
+    def make_dumper(self):
+        config = configparser.ConfigParser()
+        config.read_dict({'Dumper': {'DBFileName': ':memory:',
+                                     'InvalidationTime': '0'}})
+        return Dumper(config['Dumper'])
+
+    def test_from_database(self):
+        dumper = self.make_dumper()
+        dumper.conn.executemany(
+            'INSERT INTO User VALUES (?,?,?,?,?,?,?,?,?,?)', (
+                (1, 100, 'Old', 'Name', None, None, None, 0, 0, None),
+                (1, 200, 'New', 'Name', 'newname', None, None, 0, 0, None),
+            ))
+        dumper.conn.execute('INSERT INTO Chat VALUES (?,?,?,?,?)',
+                            (-55, 150, 'Left chat', None, None))
+
+        index = EntityIndex.from_database(dumper.conn)
+        self.assertEqual(len(index), 2)
+        self.assertEqual(index.search('new name')[0],
+                         [Entity(1, 'New Name', 'newname', None)])
+        self.assertEqual(index.search('left chat')[0][0].id, -55)
+        self.assertEqual(index.search('old name')[0][0].name, 'New Name')
+
+    def test_load(self):
+        dumper = self.make_dumper()
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'index')
+            dump = 'INSERT INTO Chat VALUES (?,?,?,?,?)'
+            dumper.conn.execute(dump, (-55, 150, 'Weekend plans', None, None))
+            self.assertEqual(len(EntityIndex.load(dumper.conn, path)), 1)
+
+            # It's loaded from the file while nothing is dumped
+            with open(path) as f:
+                saved = json.load(f)
+            grams = trigrams('Not dumped')
+            saved['entities'].append([1, 'Not dumped', None, None])
+            saved['fields'].append([1, 'not dumped', len(grams)])
+            for gram in grams:
+                saved['postings'].setdefault(gram, []).append(
+                    len(saved['fields']) - 1)
+            with open(path, 'w') as f:
+                json.dump(saved, f)
+            index = EntityIndex.load(dumper.conn, path)
+            self.assertEqual(len(index), 2)
+            self.assertEqual(index.search('not dumped')[0],
+                             [Entity(1, 'Not dumped', None, None)])
+
+            # But built again once something is, and only saved if asked
+            dumper.conn.execute(dump, (-55, 250, 'New plans', None, None))
+            index = EntityIndex.load(dumper.conn, path, save=False)
+            self.assertEqual(len(index), 1)
+            self.assertEqual(index.search('new plans')[0][0].id, -55)
+            self.assertEqual(len(EntityIndex.load(dumper.conn, path)), 1)
+            os.remove(path)
+            EntityIndex.load(dumper.conn, path, save=False)
+            self.assertFalse(os.path.exists(path))
+        finally:
+            shutil.rmtree(directory)
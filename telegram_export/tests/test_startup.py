@@ -0,0 +1,37 @@
+import os
+import subprocess
+import sys
+import unittest
+
+# How long importing the command line entry point may take, in seconds.
+# Offline commands are often run in bulk so their startup time matters.
+IMPORT_TIME_BUDGET = 0.15
+
+# Modules which are only needed to talk to Telegram, and which are slow
+# to import, so they must not be imported by the offline commands.
+NETWORK_MODULES = ('telethon', 'tqdm', 'asyncio')
+
+MEASURE_IMPORT = '''
+import sys, time
+start = time.perf_counter()
+import telegram_export.__main__
+print(time.perf_counter() - start)
+print(','.join(m for m in {} if m in sys.modules))
+'''.format(NETWORK_MODULES)
+
+
+class TestStartup(unittest.TestCase):
+
+    def test_import_time(self):
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        # Take the best of a few runs to be less sensitive to a busy machine
+        timings = []
+        for _ in range(3):
+            output = subprocess.check_output(
+                [sys.executable, '-c', MEASURE_IMPORT], cwd=root
+            ).decode().split('\n')
+            timings.append(float(output[0]))
+            self.assertEqual(output[1], '')
+
+        self.assertLess(min(timings), IMPORT_TIME_BUDGET)
@@ -0,0 +1,67 @@
+import asyncio
+import unittest
+
+from telegram_export.tracing import Tracer, NO_DIALOG
+
+
+class TestTracer(unittest.TestCase):
+
+    def test_disabled(self):
+        tracer = Tracer()
+        with tracer.dialog(1), tracer.span('fetch'):
+            pass
+        self.assertEqual(tracer.events, [])
+        self.assertEqual(dict(tracer.summaries), {})
+
+    def test_summaries(self):
+        tracer = Tracer()
+        tracer.enable()
+        with tracer.dialog(-100123, 'Some channel'):
+            with tracer.span('fetch', offset_id=0):
+                pass
+            for _ in range(3):
+                with tracer.span('hydrate', event=False):
+                    pass
+        with tracer.span('commit'):
+            pass
+
+        summary = tracer.summaries['Some channel (-100123)']
+        self.assertEqual(summary['fetch'][0], 1)
+        self.assertEqual(summary['hydrate'][0], 3)
+        self.assertEqual(summary['dialog'][0], 1)
+        self.assertEqual(tracer.summaries[NO_DIALOG]['commit'][0], 1)
+
+        # Spans with event=False don't make it into the trace
+        trace = tracer.to_chrome_trace()
+        names = [e['name'] for e in trace['traceEvents'] if e['ph'] == 'X']
+        self.assertEqual(sorted(names), ['commit', 'dialog', 'fetch'])
+        self.assertIn('Some channel (-100123)',
+                      trace['otherData']['summaries'])
+
+    def test_tracks(self):
+        tracer = Tracer()
+        tracer.enable()
+
+        async def consumer():
+            tracer.set_track('consumer')
+            with tracer.span('download'):
+                await asyncio.sleep(0)
+
+        async def main():
+            task = asyncio.ensure_future(consumer())
+            with tracer.span('fetch'):
+                await asyncio.sleep(0)
+            await task
+
+        asyncio.run(main())
+        trace = tracer.to_chrome_trace()
+        tracks = {e['args']['name']: e['tid']
+                  for e in trace['traceEvents'] if e['ph'] == 'M'}
+        tids = {e['name']: e['tid']
+                for e in trace['traceEvents'] if e['ph'] == 'X'}
+        self.assertEqual(tids, {'fetch': tracks['main'],
+                                'download': tracks['consumer']})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,12 @@
+import datetime
 import unittest
 import socks
-from telegram_export.utils import parse_proxy_str
+from telethon.tl import types
+from telegram_export.formatting import MessageEntity, decode_formatting, \
+    decode_formatting_many, encode_formatting
+from telegram_export.utils import parse_proxy_str, action_to_name, \
+    get_media_type, media_to_row, encode_msg_entities, decode_msg_entities, \
+    ENTITY_TO_TEXT
 
 
 class TestUtils(unittest.TestCase):
@@ -42,3 +48,77 @@ class TestUtils(unittest.TestCase):
         proxy_str = "127.0.0.1:1080"
         with self.assertRaises(ValueError):
             parse_proxy_str(proxy_str)
+
+    def test_classify(self):
+        self.assertEqual(action_to_name(
+            types.MessageActionChatEditTitle('title')), 'chat.edittitle')
+        self.assertEqual(action_to_name(
+            types.ChannelAdminLogEventActionToggleInvites(True)),
+            'toggle.invites')
+        self.assertIsNone(action_to_name(types.MessageMediaEmpty()))
+        self.assertIsNone(action_to_name(None))
+
+        small = types.PhotoSize('s', types.FileLocation(2, 10, 1, 7), 90, 90,
+                                100)
+        large = types.PhotoSize('x', types.FileLocation(2, 11, 2, 8), 800,
+                                600, 5000)
+        photo = types.MessageMediaPhoto(photo=types.Photo(
+            id=1, access_hash=1, date=datetime.datetime(2018, 1, 1),
+            sizes=[small, large]))
+        self.assertEqual(get_media_type(photo), 'photo')
+        self.assertEqual(get_media_type(photo.photo), 'chatphoto')
+        self.assertEqual(get_media_type(types.MessageMediaEmpty()), 'unknown')
+        self.assertEqual(get_media_type(None), '')
+
+        # The row continues with the largest size and then its location,
+        # saving the smallest as the thumbnail
+        dumped = []
+        row = media_to_row(photo, lambda m, t=None: dumped.append((m, t)))
+        self.assertEqual(dumped, [(small, 'thumbnail')])
+        self.assertEqual((row['type'], row['mime_type'], row['size']),
+                         ('photo', 'image/jpeg', 5000))
+        self.assertEqual((row['local_id'], row['volume_id'], row['secret']),
+                         (2, 11, 8))
+        self.assertIsNone(media_to_row(types.MessageMediaEmpty(),
+                                       dumped.append)['type'])
+        self.assertEqual(media_to_row(types.MessageMediaGeo(
+            types.GeoPoint(1.5, 2.5, 0)), dumped.append)['name'], '(2.5, 1.5)')
+
+    def test_msg_entities(self):
+        entities = []
+        for offset, cls in enumerate(ENTITY_TO_TEXT):
+            if cls == types.MessageEntityTextUrl:
+                entities.append(cls(offset, 3, 'http://a,b;c'))
+            elif cls == types.MessageEntityMentionName:
+                entities.append(cls(offset, 3, 2 ** 40))
+            elif cls == types.MessageEntityPre:
+                entities.append(cls(offset, 3, 'python'))
+            else:
+                entities.append(cls(offset, 3))
+
+        encoded = encode_msg_entities(entities)
+        self.assertIsInstance(encoded, bytes)
+        self.assertEqual([e.to_dict() for e in decode_msg_entities(encoded)],
+                         [e.to_dict() for e in entities])
+        self.assertEqual(decode_formatting(encoded)[-4:-1], [
+            MessageEntity('texturl', 10, 3, 'http://a,b;c', None, None),
+            MessageEntity('mentionname', 11, 3, None, 2 ** 40, None),
+            MessageEntity('phone', 12, 3, None, None, None)
+        ])
+        self.assertIsNone(encode_msg_entities([]))
+
+        # What older versions saved can still be read
+        self.assertEqual(decode_formatting('bold,0,7;texturl,1,3,a%2cb'), [
+            MessageEntity('bold', 0, 7, None, None, None),
+            MessageEntity('texturl', 1, 3, 'a%2cb', None, None)
+        ])
+        self.assertEqual(decode_msg_entities('mentionname,2,5,9')[0].user_id, 9)
+
+        # Decoding many at once is the same as decoding them one by one
+        values = [encoded, None, 'bold,0,7', b'', encode_formatting([
+            MessageEntity('italic', 0, 2 ** 20, None, None, None)])]
+        values += [encode_formatting([
+            MessageEntity('bold', i, 3, None, None, None)] * i)
+            for i in range(1, 4)]
+        self.assertEqual(decode_formatting_many(values),
+                         [decode_formatting(value) for value in values])
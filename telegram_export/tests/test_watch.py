@@ -0,0 +1,116 @@
+import asyncio
+import datetime
+import shutil
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from telethon import utils
+from telethon.tl import types
+
+from telegram_export import exporter
+from telegram_export.benchmarks.export import make_config, downloader_delays
+from telegram_export.benchmarks.fakeclient import FakeClient, Scenario
+from telegram_export.dumper import Dumper
+from telegram_export.exporter import Exporter
+
+
+class TestWatch(unittest.TestCase):
+
+    def setUp(self):
+        self.output = tempfile.mkdtemp()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.client = FakeClient(Scenario(dialogs=2, messages=30,
+                                          participants=5, admin_log=0))
+        config = make_config(self.output)
+        self.dumper = Dumper(config['Dumper'])
+        self.exporter = Exporter(self.client, config, self.dumper, self.loop)
+
+    def tearDown(self):
+        self.loop.run_until_complete(self.exporter.close())
+        self.loop.close()
+        shutil.rmtree(self.output)
+
+    async def _until(self, condition, timeout=10):
+        for _ in range(int(timeout / 0.01)):
+            if condition():
+                return
+            await asyncio.sleep(0.01)
+        self.fail('Timed out waiting while watching')
+
+    def _messages(self):
+        return self.dumper.conn.execute(
+            'SELECT COUNT(*) FROM Message').fetchone()[0]
+
+    def _watching(self):
+        return self.exporter.downloader._running and self.client.requests \
+            and self._messages() >= 60
+
+    async def _watch(self):
+        task = self.loop.create_task(self.exporter.watch())
+        try:
+            await self._until(lambda: self._watching() and not task.done())
+            self.assertEqual(len(self.client.event_handlers), 2)
+
+            # New messages from updates are dumped while watching
+            dialog = self.client.dialogs[0]
+            message = types.Message(
+                id=31, to_id=utils.get_peer(dialog), message='live',
+                date=datetime.datetime(2018, 2, 1), from_id=dialog.id)
+            await self.exporter.downloader.dump_update(SimpleNamespace(
+                chat_id=utils.get_peer_id(dialog), chat=dialog,
+                sender=dialog, message=message))
+            self.assertEqual(self.dumper.conn.execute(
+                'SELECT Message FROM Message WHERE ID = 31').fetchone()[0],
+                'live')
+
+            # Reconnecting on its own has everything dumped again
+            requests = self.client.requests
+            self.client.reconnect()
+            await self._until(lambda: self.client.requests > requests
+                              and self._watching())
+            self.assertEqual(self.client.connects, 0)
+
+            # Losing the connection for good has it connect again
+            self.client.lose_connection()
+            await self._until(lambda: self.client.connects == 1
+                              and self._watching())
+            self.assertFalse(task.done())
+        finally:
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    def test_watch(self):
+        exporter.RECONNECT_DELAY, delay = 0, exporter.RECONNECT_DELAY
+        try:
+            with downloader_delays(False):
+                self.loop.run_until_complete(self._watch())
+        finally:
+            exporter.RECONNECT_DELAY = delay
+
+    def test_missing_media(self):
+        # Media which isn't saved (anymore) is skipped rather than stopping
+        # the consumer and leaving the queue waiting forever
+        self.assertIsNone(self.loop.run_until_complete(
+            self.exporter.downloader._download_media(12345, 1, 1, 0, None)))
+
+    def test_picture_date(self):
+        # Pictures are saved with the date of the first row with them, the
+        # one the manifest expects, rather than with the time of every dump
+        downloader = self.exporter.downloader
+        location = types.FileLocation(1, 2, 3, 4)
+        chat = types.Chat(7, 'chat', types.ChatPhoto(location, location),
+                          1, datetime.datetime(2018, 1, 1), 1)
+        downloader._dump_full_entity(chat)
+        date = downloader._media_queue.get_nowait()[3]
+        self.assertEqual(date, self.dumper.conn.execute(
+            'SELECT DateUpdated FROM Chat').fetchone()[0])
+
+        self.dumper.conn.execute(
+            'UPDATE Chat SET DateUpdated = DateUpdated - 1000')
+        downloader._dump_full_entity(chat)
+        self.assertEqual(downloader._media_queue.get_nowait()[3], date - 1000)
@@ -0,0 +1,200 @@
+"""
+Optional tracing of where the time goes, enabled through --profile. Timed
+spans are saved as Chrome trace events (which chrome://tracing, Perfetto or
+speedscope can show as a flame graph) along with a summary of the time spent
+on every stage for each dialog.
+"""
+import json
+import logging
+import os
+import sys
+import time
+import weakref
+from collections import defaultdict
+from contextlib import contextmanager
+
+__log__ = logging.getLogger(__name__)
+
+MAIN_TRACK = 'main'
+NO_DIALOG = '(no dialog)'
+
+
+class _NullSpan:
+    """What `Tracer.span` returns while disabled, which does nothing."""
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """A span being timed, recorded into its tracer when exited."""
+    __slots__ = ('tracer', 'name', 'args', 'event', 'start')
+
+    def __init__(self, tracer, name, args, event):
+        self.tracer = tracer
+        self.name = name
+        self.args = args
+        self.event = event
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.tracer._record(self.name, self.start, time.perf_counter(),
+                            self.args, self.event)
+        return False
+
+
+class Tracer:
+    """
+    Records timed spans while enabled, and does (almost) nothing otherwise.
+
+    Concurrent coroutines (such as the Downloader's consumers) should call
+    `set_track` when they start, so that their spans are shown separately
+    instead of being mixed with the ones from the main dump.
+    """
+    def __init__(self):
+        self.enabled = False
+        self.reset()
+
+    def reset(self):
+        """Forgets all the recorded spans."""
+        self.origin = time.perf_counter()
+        self.events = []
+        # {dialog: {span name: [count, seconds]}}
+        self.summaries = defaultdict(dict)
+        self._dialog = NO_DIALOG
+        self._tracks = {MAIN_TRACK: 0}  # {track name: thread ID in trace}
+        self._task_tracks = weakref.WeakKeyDictionary()  # {task: track name}
+
+    def enable(self):
+        """Starts recording spans from scratch."""
+        self.reset()
+        self.enabled = True
+
+    def span(self, name, event=True, **args):
+        """
+        Returns a context manager timing its body as a span with the given
+        name and arguments. Spans with ``event=False`` only count towards
+        the summaries, which is meant for those occurring for every single
+        message and that would otherwise make the trace huge.
+        """
+        if not self.enabled:
+            return _NULL_SPAN
+        return Span(self, name, args, event)
+
+    @contextmanager
+    def dialog(self, dialog_id, name=None):
+        """
+        Attributes the spans recorded within the ``with`` block to the
+        given dialog in the summaries, timing the whole block as well.
+        """
+        if not self.enabled:
+            yield
+            return
+
+        previous = self._dialog
+        self._dialog = '{} ({})'.format(name, dialog_id) if name \
+            else str(dialog_id)
+        try:
+            with self.span('dialog', dialog_id=dialog_id, title=name):
+                yield
+        finally:
+            self._dialog = previous
+
+    def set_track(self, name):
+        """Shows the spans of the current asyncio task under ``name``."""
+        task = self._current_task()
+        if self.enabled and task is not None:
+            self._task_tracks[task] = name
+
+    @staticmethod
+    def _current_task():
+        asyncio = sys.modules.get('asyncio')
+        if asyncio is None:
+            return None
+        current_task = getattr(asyncio, 'current_task', None) \
+            or asyncio.Task.current_task
+        try:
+            return current_task()
+        except RuntimeError:  # No running event loop
+            return None
+
+    def _track_id(self):
+        track = MAIN_TRACK
+        if self._task_tracks:
+            task = self._current_task()
+            if task is not None:
+                track = self._task_tracks.get(task, MAIN_TRACK)
+        tid = self._tracks.get(track)
+        if tid is None:
+            tid = self._tracks[track] = len(self._tracks)
+        return tid
+
+    def _record(self, name, start, end, args, event):
+        stats = self.summaries[self._dialog].get(name)
+        if stats is None:
+            stats = self.summaries[self._dialog][name] = [0, 0.0]
+        stats[0] += 1
+        stats[1] += end - start
+        if event:
+            self.events.append({
+                'name': name,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': (end - start) * 1e6,
+                'pid': 1,
+                'tid': self._track_id(),
+                'args': args
+            })
+
+    def to_chrome_trace(self):
+        """
+        Returns the recorded spans in Chrome's trace event format, with
+        the per-dialog summaries under ``otherData``.
+        """
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+                     'args': {'name': track}}
+                    for track, tid in self._tracks.items()]
+        return {
+            'traceEvents': metadata + self.events,
+            'displayTimeUnit': 'ms',
+            'otherData': {
+                'summaries': {
+                    dialog: {name: {'count': count, 'seconds': seconds}
+                             for name, (count, seconds) in stats.items()}
+                    for dialog, stats in self.summaries.items()
+                }
+            }
+        }
+
+    def save(self, directory):
+        """
+        Saves the trace for this run into a new file in the given
+        directory, named after the current time, and returns its path.
+        """
+        path = os.path.join(directory, 'profile-{}.json'.format(
+            time.strftime('%Y%m%d-%H%M%S')))
+        with open(path, 'w') as file:
+            json.dump(self.to_chrome_trace(), file, default=str)
+        return path
+
+    def log_summary(self, top=8):
+        """Logs where most of the time went for every dialog."""
+        for dialog, stats in self.summaries.items():
+            __log__.info('Profile of %s:', dialog)
+            ranked = sorted(stats.items(), key=lambda t: t[1][1], reverse=True)
+            for name, (count, seconds) in ranked[:top]:
+                __log__.info('  %-16s %10.3fs in %d spans',
+                             name, seconds, count)
+
+
+# The tracer of this run, which is enabled by --profile.
+TRACER = Tracer()
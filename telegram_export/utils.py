@@ -1,5 +1,5 @@
 """Utility functions for telegram-export which aren't specific to one purpose"""
-import mimetypes
+from collections import namedtuple
 
 from telethon.tl import types
 from urllib.parse import urlparse
@@ -8,89 +8,277 @@ try:
 except ImportError:
     socks = None
 
+# These live with the media paths, which are also needed without telethon
+from .mediapath import COMMON_MIME_TO_EXTENSION, get_extension  # noqa
+from .formatting import MessageEntity, decode_formatting, encode_formatting
+
 ENTITY_TO_TEXT = {
-    types.MessageEntityPre: 'pre',
-    types.MessageEntityCode: 'code',
+    types.MessageEntityUnknown: 'unknown',
+    types.MessageEntityMention: 'mention',
+    types.MessageEntityHashtag: 'hashtag',
+    types.MessageEntityBotCommand: 'botcommand',
+    types.MessageEntityUrl: 'url',
+    types.MessageEntityEmail: 'email',
     types.MessageEntityBold: 'bold',
     types.MessageEntityItalic: 'italic',
+    types.MessageEntityCode: 'code',
+    types.MessageEntityPre: 'pre',
     types.MessageEntityTextUrl: 'texturl',
-    types.MessageEntityUrl: 'url',
-    types.MessageEntityMentionName: 'mentionname'
+    types.MessageEntityMentionName: 'mentionname',
+    types.MessageEntityPhone: 'phone',
+    types.MessageEntityCashtag: 'cashtag'
 }
 
 TEXT_TO_ENTITY = {v: k for k, v in ENTITY_TO_TEXT.items()}
 
-# The mimetypes module has many extension for the same mimetype and it will
-# return the one that happens to be first (e.g. ".bat" for "text/plain").
-# This map contains a few common mimetypes and their most common extension.
-#
-# The following code can be use to find out which mimetypes have several ext:
-'''
-import mimetypes
-from collections import defaultdict
-d = defaultdict(list)
-for k, v in mimetypes.types_map.items():
-    d[v].append(k)
-
-d = {k: v for k, v in d.items() if len(v) > 1}
-'''
-COMMON_MIME_TO_EXTENSION = {
-    'text/plain': '.txt',  # To avoid ".bat"
-    'image/jpeg': '.jpg',  # To avoid ".jpe"
-    'image/bmp': '.bmp',  # To avoid ".dib"
-    'video/mp4': '.mp4',  # To avoid ".m4v"
-}
-
 
 def encode_msg_entities(entities):
     """
-    Encodes a list of MessageEntity into a string so it
-    can easily be dumped into e.g. Dumper's database.
+    Encodes a list of MessageEntity into bytes so it can easily be
+    dumped into e.g. Dumper's database (see ``formatting``).
     """
     if not entities:
         return None
-    parsed = []
-    for entity in entities:
-        if entity.__class__ in ENTITY_TO_TEXT:
-            if isinstance(entity, types.MessageEntityTextUrl):
-                extra = ',{}'.format(
-                    entity.url.replace(',', '%2c').replace(';', '%3b')
-                )
-            elif isinstance(entity, types.MessageEntityMentionName):
-                extra = ',{}'.format(entity.user_id)
-            else:
-                extra = ''
-            parsed.append('{},{},{}{}'.format(
-                ENTITY_TO_TEXT[type(entity)],
-                entity.offset, entity.length, extra
-            ))
-    return ';'.join(parsed)
+    return encode_formatting([
+        MessageEntity(ENTITY_TO_TEXT[type(entity)],
+                      entity.offset, entity.length,
+                      getattr(entity, 'url', None),
+                      getattr(entity, 'user_id', None),
+                      getattr(entity, 'language', None))
+        for entity in entities if type(entity) in ENTITY_TO_TEXT
+    ])
 
 
-def decode_msg_entities(string):
+def decode_msg_entities(value):
     """
-    Reverses the transformation made by ``utils.encode_msg_entities``.
+    Reverses the transformation made by ``utils.encode_msg_entities``
+    (or the text it made in older versions).
     """
-    if not string:
+    if not value:
         return None
     parsed = []
-    for part in string.split(';'):
-        split = part.split(',')
-        kind, offset, length = split[0], int(split[1]), int(split[2])
-        if kind in TEXT_TO_ENTITY:
-            if kind == 'texturl':
-                parsed.append(types.MessageEntityTextUrl(
-                    offset, length, split[-1]
-                ))
-            elif kind == 'mentionname':
-                parsed.append(types.MessageEntityMentionName(
-                    offset, length, int(split[-1])
-                ))
-            else:
-                parsed.append(TEXT_TO_ENTITY[kind](offset, length))
+    for entity in decode_formatting(value):
+        if entity.kind == 'texturl':
+            parsed.append(types.MessageEntityTextUrl(
+                entity.offset, entity.length, entity.url
+            ))
+        elif entity.kind == 'mentionname':
+            parsed.append(types.MessageEntityMentionName(
+                entity.offset, entity.length, entity.user_id
+            ))
+        elif entity.kind == 'pre':
+            parsed.append(types.MessageEntityPre(
+                entity.offset, entity.length, entity.language or ''
+            ))
+        else:
+            parsed.append(TEXT_TO_ENTITY[entity.kind](
+                entity.offset, entity.length
+            ))
     return parsed
 
 
+def _extract_contact(media, row, dump_media):
+    row['type'] = 'contact'
+    row['name'] = '{} {}'.format(media.first_name, media.last_name)
+    row['local_id'] = media.user_id
+    try:
+        row['secret'] = int(media.phone_number or '0')
+    except ValueError:
+        row['secret'] = 0
+
+
+def _extract_document(media, row, dump_media):
+    row['type'] = get_media_type(media)
+    doc = media.document
+    if isinstance(doc, types.Document):
+        row['mime_type'] = doc.mime_type
+        row['size'] = doc.size
+        row['thumbnail_id'] = dump_media(doc.thumb)
+        row['local_id'] = doc.id
+        row['volume_id'] = doc.version
+        row['secret'] = doc.access_hash
+        for attr in doc.attributes:
+            if isinstance(attr, types.DocumentAttributeFilename):
+                row['name'] = attr.file_name
+
+
+def _extract_nothing(media, row, dump_media):
+    # Nothing is saved of these (and rows without a type aren't)
+    row['type'] = None
+
+
+def _extract_game(media, row, dump_media):
+    row['type'] = 'game'
+    game = media.game
+    if isinstance(game, types.Game):
+        row['name'] = game.short_name
+        row['thumbnail_id'] = dump_media(game.photo)
+        row['local_id'] = game.id
+        row['secret'] = game.access_hash
+
+
+def _extract_geo(media, row, dump_media):
+    row['type'] = 'geo' if isinstance(media, types.MessageMediaGeo) \
+        else 'geolive'
+    geo = media.geo
+    if isinstance(geo, types.GeoPoint):
+        row['name'] = '({}, {})'.format(repr(geo.lat), repr(geo.long))
+
+
+def _extract_invoice(media, row, dump_media):
+    row['type'] = 'invoice'
+    row['name'] = media.title
+    row['thumbnail_id'] = dump_media(media.photo)
+
+
+def _extract_message_photo(media, row, dump_media):
+    row['type'] = 'photo'
+    row['mime_type'] = 'image/jpeg'
+    return media.photo
+
+
+def _extract_venue(media, row, dump_media):
+    row['type'] = 'venue'
+    row['name'] = '{} - {} ({}, {} {})'.format(
+        media.title, media.address,
+        media.provider, media.venue_id, media.venue_type
+    )
+    geo = media.geo
+    if isinstance(geo, types.GeoPoint):
+        row['name'] += ' at ({}, {})'.format(
+            repr(geo.lat), repr(geo.long)
+        )
+
+
+def _extract_webpage(media, row, dump_media):
+    row['type'] = 'webpage'
+    web = media.webpage
+    if isinstance(web, types.WebPage):
+        row['name'] = web.title
+        row['thumbnail_id'] = dump_media(web.photo, 'thumbnail')
+        row['local_id'] = web.id
+        row['secret'] = web.hash
+
+
+def _extract_photo(media, row, dump_media):
+    row['type'] = 'photo'
+    row['mime_type'] = 'image/jpeg'
+    row['name'] = str(media.date)
+    sizes = [x for x in media.sizes
+             if isinstance(x, (types.PhotoSize, types.PhotoCachedSize))]
+    if sizes:
+        small = min(sizes, key=lambda s: s.w * s.h)
+        large = max(sizes, key=lambda s: s.w * s.h)
+        if small != large:
+            row['thumbnail_id'] = dump_media(small, 'thumbnail')
+        return large
+
+
+def _extract_photo_size(media, row, dump_media):
+    row['type'] = 'photo'
+    row['mime_type'] = 'image/jpeg'
+    if isinstance(media, types.PhotoSizeEmpty):
+        row['size'] = 0
+    else:
+        if isinstance(media, types.PhotoSize):
+            row['size'] = media.size
+        else:
+            row['size'] = len(media.bytes)
+        if isinstance(media.location, types.FileLocation):
+            return media.location
+
+
+def _extract_profile_photo(media, row, dump_media):
+    row['type'] = 'photo'
+    row['mime_type'] = 'image/jpeg'
+    row['thumbnail_id'] = dump_media(media.photo_small, 'thumbnail')
+    return media.photo_big
+
+
+def _extract_file_location(media, row, dump_media):
+    row['local_id'] = media.local_id
+    row['volume_id'] = media.volume_id
+    row['secret'] = media.secret
+
+
+# What is known of every TL type that has to be told apart from the rest,
+# by its class: the friendly type of media for `get_media_type`, the name
+# for `action_to_name`, and how `media_to_row` fills a Media row from it.
+#
+# The extract functions take (media, row, dump_media), fill what they can
+# of the row and return the part of the media to continue with, if any
+# (e.g. a Photo continues with its largest PhotoSize, and this with its
+# FileLocation). They run for every message, so these are only looked up.
+TLType = namedtuple('TLType', ('media_type', 'action_name', 'extract'))
+
+TL_TYPES = {
+    types.MessageMediaContact: TLType(None, None, _extract_contact),
+    types.MessageMediaDocument:
+        TLType('document', None, _extract_document),
+    types.MessageMediaEmpty: TLType(None, None, _extract_nothing),
+    types.MessageMediaGame: TLType(None, None, _extract_game),
+    types.MessageMediaGeo: TLType(None, None, _extract_geo),
+    types.MessageMediaGeoLive: TLType(None, None, _extract_geo),
+    types.MessageMediaInvoice: TLType(None, None, _extract_invoice),
+    types.MessageMediaPhoto: TLType('photo', None, _extract_message_photo),
+    types.MessageMediaUnsupported: TLType(None, None, _extract_nothing),
+    types.MessageMediaVenue: TLType(None, None, _extract_venue),
+    types.MessageMediaWebPage: TLType(None, None, _extract_webpage),
+
+    types.Photo: TLType('chatphoto', None, _extract_photo),
+    types.PhotoSize: TLType(None, None, _extract_photo_size),
+    types.PhotoCachedSize: TLType(None, None, _extract_photo_size),
+    types.PhotoSizeEmpty: TLType(None, None, _extract_photo_size),
+    types.UserProfilePhoto:
+        TLType('chatphoto', None, _extract_profile_photo),
+    types.ChatPhoto: TLType('chatphoto', None, _extract_profile_photo),
+    types.FileLocation: TLType(None, None, _extract_file_location),
+}
+
+TL_TYPES.update((cls, TLType(None, name, None)) for cls, name in {
+    types.MessageActionChannelCreate: 'channel.create',
+    types.MessageActionChannelMigrateFrom: 'channel.migratefrom',
+    types.MessageActionChatAddUser: 'chat.adduser',
+    types.MessageActionChatCreate: 'chat.create',
+    types.MessageActionChatDeletePhoto: 'chat.deletephoto',
+    types.MessageActionChatDeleteUser: 'chat.deleteuser',
+    types.MessageActionChatEditPhoto: 'chat.editphoto',
+    types.MessageActionChatEditTitle: 'chat.edittitle',
+    types.MessageActionChatJoinedByLink: 'chat.joinedbylink',
+    types.MessageActionChatMigrateTo: 'chat.migrateto',
+    types.MessageActionCustomAction: 'custom',
+    types.MessageActionEmpty: 'empty',
+    types.MessageActionGameScore: 'game.score',
+    types.MessageActionHistoryClear: 'history.clear',
+    types.MessageActionPaymentSent: 'payment.sent',
+    types.MessageActionPaymentSentMe: 'payment.sentme',
+    types.MessageActionPhoneCall: 'phone.call',
+    types.MessageActionPinMessage: 'pin.message',
+    types.MessageActionScreenshotTaken: 'screenshottaken',
+
+    types.ChannelAdminLogEventActionChangeAbout: 'change.about',
+    types.ChannelAdminLogEventActionChangePhoto: 'change.photo',
+    types.ChannelAdminLogEventActionChangeStickerSet: 'change.stickerset',
+    types.ChannelAdminLogEventActionChangeTitle: 'change.title',
+    types.ChannelAdminLogEventActionChangeUsername: 'change.username',
+    types.ChannelAdminLogEventActionDeleteMessage: 'delete.message',
+    types.ChannelAdminLogEventActionEditMessage: 'edit.message',
+    types.ChannelAdminLogEventActionParticipantInvite: 'participant.invite',
+    types.ChannelAdminLogEventActionParticipantJoin: 'participant.join',
+    types.ChannelAdminLogEventActionParticipantLeave: 'participant.leave',
+    types.ChannelAdminLogEventActionParticipantToggleAdmin: 'participant.toggleadmin',
+    types.ChannelAdminLogEventActionParticipantToggleBan: 'participant.toggleban',
+    types.ChannelAdminLogEventActionToggleInvites: 'toggle.invites',
+    types.ChannelAdminLogEventActionTogglePreHistoryHidden: 'toggle.prehistoryhidden',
+    types.ChannelAdminLogEventActionToggleSignatures: 'toggle.signatures',
+    types.ChannelAdminLogEventActionUpdatePinned: 'update.pinned',
+}.items())
+
+# The columns of the Media table that `media_to_row` fills
+MEDIA_COLUMNS = ('name', 'mime_type', 'size', 'thumbnail_id',
+                 'local_id', 'volume_id', 'secret', 'type')
+
+
 def get_media_type(media):
     """
     Returns a friendly type for the given media.
@@ -98,44 +286,25 @@ def get_media_type(media):
     if not media:
         return ''
 
-    if isinstance(media, types.MessageMediaPhoto):
-        return 'photo'
+    kind = TL_TYPES.get(type(media))
+    return kind and kind.media_type or 'unknown'
 
-    elif isinstance(media, types.MessageMediaDocument):
-        if isinstance(media, types.Document):
-            for attr in media.attributes:
-                if isinstance(attr, types.DocumentAttributeSticker):
-                    return 'document.sticker'
-                elif isinstance(attr, types.DocumentAttributeVideo):
-                    return 'document.video'
-                elif isinstance(attr, types.DocumentAttributeAnimated):
-                    return 'document.animated'
-                elif isinstance(attr, types.DocumentAttributeAudio):
-                    if attr.voice:
-                        return 'document.voice'
-                    return 'document.audio'
-        return 'document'
-
-    if isinstance(media, (types.Photo,
-                          types.UserProfilePhoto, types.ChatPhoto)):
-        return 'chatphoto'
-
-    return 'unknown'
-
-
-def get_extension(mime):
+
+def media_to_row(media, dump_media, media_type=None):
     """
-    Returns the most common extension for the given mimetype, or '.bin' if
-    none can be found to indicate that it contains arbitrary binary data.
+    Returns the given media as a row of the Media table (a dictionary with
+    the `MEDIA_COLUMNS`), whose type is None if it shouldn't be saved. The
+    media inside of it (such as thumbnails) are saved with the given
+    dump_media(media, media_type=None), which returns their Media ID.
     """
-    if not mime:
-        mime = ''
-    
-    return (
-        COMMON_MIME_TO_EXTENSION.get(mime)
-        or mimetypes.guess_extension(mime)
-        or '.bin'
-    )
+    row = dict.fromkeys(MEDIA_COLUMNS)
+    row['type'] = media_type
+    while media is not None:
+        kind = TL_TYPES.get(type(media))
+        if kind is None or kind.extract is None:
+            break
+        media = kind.extract(media, row, dump_media)
+    return row
 
 
 def get_file_location(media):
@@ -182,44 +351,8 @@ def action_to_name(action):
     Returns a namespace'd "friendly" name for the given
     ``MessageAction`` or ``ChannelAdminLogEventAction``.
     """
-    return {
-        types.MessageActionChannelCreate: 'channel.create',
-        types.MessageActionChannelMigrateFrom: 'channel.migratefrom',
-        types.MessageActionChatAddUser: 'chat.adduser',
-        types.MessageActionChatCreate: 'chat.create',
-        types.MessageActionChatDeletePhoto: 'chat.deletephoto',
-        types.MessageActionChatDeleteUser: 'chat.deleteuser',
-        types.MessageActionChatEditPhoto: 'chat.editphoto',
-        types.MessageActionChatEditTitle: 'chat.edittitle',
-        types.MessageActionChatJoinedByLink: 'chat.joinedbylink',
-        types.MessageActionChatMigrateTo: 'chat.migrateto',
-        types.MessageActionCustomAction: 'custom',
-        types.MessageActionEmpty: 'empty',
-        types.MessageActionGameScore: 'game.score',
-        types.MessageActionHistoryClear: 'history.clear',
-        types.MessageActionPaymentSent: 'payment.sent',
-        types.MessageActionPaymentSentMe: 'payment.sentme',
-        types.MessageActionPhoneCall: 'phone.call',
-        types.MessageActionPinMessage: 'pin.message',
-        types.MessageActionScreenshotTaken: 'screenshottaken',
-
-        types.ChannelAdminLogEventActionChangeAbout: 'change.about',
-        types.ChannelAdminLogEventActionChangePhoto: 'change.photo',
-        types.ChannelAdminLogEventActionChangeStickerSet: 'change.stickerset',
-        types.ChannelAdminLogEventActionChangeTitle: 'change.title',
-        types.ChannelAdminLogEventActionChangeUsername: 'change.username',
-        types.ChannelAdminLogEventActionDeleteMessage: 'delete.message',
-        types.ChannelAdminLogEventActionEditMessage: 'edit.message',
-        types.ChannelAdminLogEventActionParticipantInvite: 'participant.invite',
-        types.ChannelAdminLogEventActionParticipantJoin: 'participant.join',
-        types.ChannelAdminLogEventActionParticipantLeave: 'participant.leave',
-        types.ChannelAdminLogEventActionParticipantToggleAdmin: 'participant.toggleadmin',
-        types.ChannelAdminLogEventActionParticipantToggleBan: 'participant.toggleban',
-        types.ChannelAdminLogEventActionToggleInvites: 'toggle.invites',
-        types.ChannelAdminLogEventActionTogglePreHistoryHidden: 'toggle.prehistoryhidden',
-        types.ChannelAdminLogEventActionToggleSignatures: 'toggle.signatures',
-        types.ChannelAdminLogEventActionUpdatePinned: 'update.pinned',
-    }.get(type(action), None)
+    kind = TL_TYPES.get(type(action))
+    return kind and kind.action_name
 
 
 def parse_proxy_str(proxy_str):